@@ -0,0 +1,245 @@
+"""Benchmarks subscription churn and notification for growing counts.
+
+Run from the repository root with ``python -m benchmarks.subscriptions``.
+
+Subscriptions are made through a `SubscriptionHandler` with the server
+schema, so each of them listens to the `Reloadable` and re-queries the
+kernel through `switch_map` after a reload, as on the server. A raw
+`Broadcast` is measured for comparison.
+
+Garbage collection stays enabled. Its pauses are reported separately
+from the other event loop stalls, since a full collection takes time
+proportional to all objects in the process, which the objects retained
+per subscription drive.
+
+The cost per subscription should stay flat as the number of
+subscriptions grows. The benchmark fails if, at the largest count:
+
+* the time per subscription to subscribe, notify or unsubscribe exceeds
+  `MAX_GROWTH` times the time at the smallest count,
+* a subscription retains more than `MAX_OBJECTS` objects,
+* the event loop stalls longer than `MAX_STALL` seconds during a
+  notification,
+* or a garbage collection pauses the event loop longer than `MAX_STALL`
+  seconds during a notification.
+
+Notification times and the other stalls exclude garbage collection.
+"""
+
+import asyncio
+from collections import namedtuple
+import gc
+import json
+import time
+from unittest import mock
+
+from nengonized_server.app import SubscriptionHandler
+from nengonized_server.gql.schema import Context, schema
+from nengonized_server.kernel_management import Reloadable
+from nengonized_server.streams import Broadcast
+
+
+COUNTS = (100, 1000, 10000)
+MAX_GROWTH = 3.
+MAX_OBJECTS = 250
+MAX_STALL = 0.25
+
+QUERY = 'subscription { kernel { model { label } } }'
+
+Result = namedtuple('Result', [
+    'subscribe', 'unsubscribe', 'notify', 'stall', 'gc_pause', 'n_objects'])
+
+
+class DummyKernel(object):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def query(self, query_text, variables=None, **kwargs):
+        return json.dumps({'model': {'label': 'model'}})
+
+
+class MessageCounter(object):
+    """Counts the messages written by a handler."""
+
+    def __init__(self):
+        self.n_messages = 0
+        self._target = None
+        self._reached = asyncio.Event()
+
+    def write_message(self, message, binary=False):
+        self.n_messages += 1
+        if self._target is not None and self.n_messages >= self._target:
+            self._reached.set()
+
+    async def wait_for(self, n_messages):
+        self._target = n_messages
+        if self.n_messages < n_messages:
+            self._reached.clear()
+            await self._reached.wait()
+
+
+class GcTimer(object):
+    """Times garbage collections while used as a context manager."""
+
+    def __init__(self):
+        self.total = 0.
+        self.longest = 0.
+        self._start = None
+
+    def _callback(self, phase, info):
+        if phase == 'start':
+            self._start = time.perf_counter()
+        elif self._start is not None:
+            pause = time.perf_counter() - self._start
+            self.total += pause
+            self.longest = max(self.longest, pause)
+            self._start = None
+
+    def __enter__(self):
+        gc.callbacks.append(self._callback)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        gc.callbacks.remove(self._callback)
+
+
+def count_objects():
+    gc.collect()
+    return len(gc.get_objects())
+
+
+async def measure_stall(coro):
+    """Runs `coro` and returns its duration and the longest loop stall,
+    both without garbage collection, and the longest collection pause.
+    """
+    stalls = []
+    running = True
+
+    async def tick(gc_timer):
+        last, last_gc = time.perf_counter(), gc_timer.total
+        while running:
+            await asyncio.sleep(0)
+            now = time.perf_counter()
+            stalls.append((now - last) - (gc_timer.total - last_gc))
+            last, last_gc = now, gc_timer.total
+
+    gc.collect()
+    with GcTimer() as gc_timer:
+        ticker = asyncio.ensure_future(tick(gc_timer))
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        await coro
+        duration = time.perf_counter() - start - gc_timer.total
+        running = False
+        await ticker
+    return duration, max(stalls), gc_timer.longest
+
+
+async def bench_handler(n):
+    reloadable = Reloadable(DummyKernel())
+    async with reloadable:
+        handler = SubscriptionHandler(
+                mock.MagicMock(), mock.MagicMock(),
+                context=Context(reloadable, reloadable.wrapped),
+                schema=schema)
+        counter = MessageCounter()
+        handler.write_message = counter.write_message
+        n_objects = count_objects()
+
+        start = time.perf_counter()
+        for i in range(n):
+            handler.subscribe(str(i), QUERY, None)
+        await counter.wait_for(n)
+        subscribe = time.perf_counter() - start
+
+        async def notify_all():
+            await reloadable.reload()
+            await counter.wait_for(2 * n)
+        notify, stall, gc_pause = await measure_stall(notify_all())
+        n_objects = count_objects() - n_objects
+
+        start = time.perf_counter()
+        for i in range(n):
+            handler.unsubscribe(str(i))
+        await asyncio.sleep(0)
+        unsubscribe = time.perf_counter() - start
+    return Result(subscribe, unsubscribe, notify, stall, gc_pause, n_objects)
+
+
+async def bench_broadcast(n):
+    broadcast = Broadcast()
+    n_objects = count_objects()
+    start = time.perf_counter()
+    channels = [broadcast.listen() for _ in range(n)]
+    subscribe = time.perf_counter() - start
+
+    notify, stall, gc_pause = await measure_stall(
+            broadcast.publish_in_chunks(None))
+    n_objects = count_objects() - n_objects
+
+    start = time.perf_counter()
+    for channel in channels:
+        channel.close()
+    unsubscribe = time.perf_counter() - start
+    return Result(subscribe, unsubscribe, notify, stall, gc_pause, n_objects)
+
+
+def check_bounds(name, results):
+    """Returns the violated bounds for the `results` of a benchmark."""
+    failures = []
+    smallest, largest = min(results), max(results)
+    for measure in ('subscribe', 'unsubscribe', 'notify'):
+        growth = (
+            (getattr(results[largest], measure) / largest) /
+            (getattr(results[smallest], measure) / smallest))
+        if growth > MAX_GROWTH:
+            failures.append(
+                f"{name} {measure} time per subscription grew by "
+                f"{growth:.1f}x from {smallest} to {largest}.")
+    objects = results[largest].n_objects / largest
+    if objects > MAX_OBJECTS:
+        failures.append(
+            f"{name} retained {objects:.0f} objects per subscription.")
+    stall = results[largest].stall
+    if stall > MAX_STALL:
+        failures.append(
+            f"{name} stalled the event loop for {stall * 1e3:.1f} ms "
+            f"with {largest} subscriptions.")
+    gc_pause = results[largest].gc_pause
+    if gc_pause > MAX_STALL:
+        failures.append(
+            f"{name} garbage collection paused the event loop for "
+            f"{gc_pause * 1e3:.1f} ms with {largest} subscriptions.")
+    return failures
+
+
+async def main():
+    print(
+        f"{'':<10} {'n':>6} {'subscribe':>12} {'unsubscribe':>12} "
+        f"{'notify':>12} {'max stall':>10} {'gc pause':>10} "
+        f"{'objects':>8}")
+    failures = []
+    for name, bench in (
+            ('Handler', bench_handler),
+            ('Broadcast', bench_broadcast)):
+        results = {}
+        for n in COUNTS:
+            results[n] = result = await bench(n)
+            print(
+                f"{name:<10} {n:>6} {result.subscribe / n * 1e6:>9.2f} us "
+                f"{result.unsubscribe / n * 1e6:>9.2f} us "
+                f"{result.notify / n * 1e6:>9.2f} us "
+                f"{result.stall * 1e3:>7.2f} ms "
+                f"{result.gc_pause * 1e3:>7.2f} ms "
+                f"{result.n_objects / n:>8.1f}")
+        failures.extend(check_bounds(name, results))
+    for failure in failures:
+        print(failure)
+    return not failures
+
+
+if __name__ == '__main__':
+    raise SystemExit(0 if asyncio.run(main()) else 1)
@@ -1,30 +1,170 @@
+import time
+STARTUP_BEGIN = time.perf_counter()
+
 import asyncio
 import json
+import logging
 import os
+import signal
 import sys
 
 from tornado.ioloop import IOLoop
 
-from .app import make_app
+from .admission import (
+        AdmissionController, CLIENT_QUERY_BUDGET, QUERY_MAX_COST,
+        QUERY_MAX_DEPTH)
+from .app import close_connections, make_app
 from .filesystem import FileWatcher
-from .kernel_management import ConnectedKernel, Kernel, Reloadable
-from .gql.schema import Context, schema
+from .kernel_management import (
+        ActiveQueries, ConnectedKernel, Kernel, KERNEL_LIMITS, Reloadable)
+from .memory import MemorySampler
+from .model_cache import ModelCache
+from .probes import ProbeFeed
+from .recording import RecordingKernel, TraceRecorder
+from .result_store import file_hash, ResultStore
+from .scheduling import QueryScheduler, ScheduledKernel
+from .supervision import Supervisor
+from .workers import PlacementScheduler, RemoteKernel
+from .gql.schema import Context, get_snapshot_query
+
 
+PORT = 8998
+KEEP_ALIVE_TIMEOUT = 60.
+DRAIN_TIMEOUT = 5.
+KERNEL_TERMINATE_TIMEOUT = 5.
+KERNEL_SHARED_BUFFER_SIZE = 64 * 1024**2
+RESULT_STORE_PATH = os.path.expanduser('~/.cache/nengonized/results.bin')
+MODEL_CACHE_PATH = os.path.expanduser('~/.cache/nengonized/models')
+MODEL_CACHE_SIZE = 2 * 1024**3
+MEMORY_SAMPLE_INTERVAL = 30.
+CONNECTION_MEMORY_BUDGET = 256 * 1024**2
+PROCESS_MEMORY_BUDGET = 4 * 1024**3
+# Comma separated base URLs of worker agents to run the kernel on.
+WORKERS = [
+    url for url in os.environ.get('NENGONIZED_WORKERS', '').split(',') if url]
+# Token shared with the worker agents.
+WORKER_TOKEN = os.environ.get('NENGONIZED_WORKER_TOKEN')
+# Allow expensive allocation tracing and object counts on /memory.
+MEMORY_DIAGNOSTICS = bool(os.environ.get('NENGONIZED_MEMORY_DIAGNOSTICS'))
+# File to record a trace of the server traffic to for offline replay.
+TRACE_PATH = os.environ.get('NENGONIZED_TRACE')
 
+logger = logging.getLogger('nengonized_server')
 requestShutdown = asyncio.Event()
 
 async def start_nengonized():
     filename = sys.argv[1]
     fw = FileWatcher(filename)  # start first to not miss any changes
     fw.start_watching()
-    kernel = ConnectedKernel(Kernel(filename))
-    async with Reloadable(kernel) as reloadable:
-        fw.callback = reloadable.reload
-        context = Context(reloadable, kernel)
-        app = make_app(context)
-        app.listen(8998)
+    if WORKERS:
+        kernel_process = RemoteKernel(
+                filename, PlacementScheduler(WORKERS, WORKER_TOKEN),
+                memory=KERNEL_LIMITS.memory)
+    else:
+        kernel_process = Kernel(
+                filename, terminate_timeout=KERNEL_TERMINATE_TIMEOUT,
+                limits=KERNEL_LIMITS, local_link='socketpair',
+                shared_buffer_size=KERNEL_SHARED_BUFFER_SIZE,
+                model_cache=ModelCache(MODEL_CACHE_PATH, MODEL_CACHE_SIZE))
+    active_queries = ActiveQueries()
+    kernel = ConnectedKernel(kernel_process, active_queries=active_queries)
+    reloadable = Reloadable(kernel, in_place=True)
+    supervisor = Supervisor(reloadable, kernel)
+    recorder = TraceRecorder(TRACE_PATH) if TRACE_PATH else None
+    scheduler = QueryScheduler()
+    scheduled_kernel = ScheduledKernel(
+            kernel if recorder is None else RecordingKernel(kernel, recorder),
+            scheduler)
+    probes = ProbeFeed(
+            reloadable, scheduled_kernel,
+            shared_buffers=kernel_process.shared_buffers)
+    admission = AdmissionController(
+            max_depth=QUERY_MAX_DEPTH, max_cost=QUERY_MAX_COST,
+            client_budget=CLIENT_QUERY_BUDGET, kernel=kernel)
+    context = Context(
+            reloadable, scheduled_kernel, log=kernel_process.log,
+            supervisor=supervisor, probes=probes, admission=admission,
+            active_queries=active_queries)
+    os.makedirs(os.path.dirname(RESULT_STORE_PATH), exist_ok=True)
+    result_store = ResultStore(RESULT_STORE_PATH, tag=file_hash(filename))
+    memory = MemorySampler(
+            interval=MEMORY_SAMPLE_INTERVAL,
+            connection_budget=CONNECTION_MEMORY_BUDGET,
+            process_budget=PROCESS_MEMORY_BUDGET,
+            diagnostics=MEMORY_DIAGNOSTICS, scheduler=scheduler,
+            gate=reloadable.gate)
+    app = make_app(
+            context, shared_buffers=kernel_process.shared_buffers,
+            result_store=result_store, recorder=recorder,
+            memory_sampler=memory)
+    server = app.listen(PORT, idle_connection_timeout=KEEP_ALIVE_TIMEOUT)
+    logger.info(
+            "Listening on port %d after %.3f seconds.", PORT,
+            time.perf_counter() - STARTUP_BEGIN)
+
+    # Building the query may import the kernel schema, which would block
+    # the connections accepted meanwhile.
+    kernel.snapshot_query = await loop.run_in_executor(
+            None, get_snapshot_query)
+    async with reloadable:
+        supervisor.notify_started()
+        logger.info(
+                "Kernel started after %.3f seconds.",
+                time.perf_counter() - STARTUP_BEGIN)
+
+        async def reload():
+            if recorder is not None:
+                recorder.record('file_change', filename=filename)
+            try:
+                tag = await loop.run_in_executor(None, file_hash, filename)
+            except OSError as err:
+                logger.warning("Not storing results: %s", err)
+                tag = None
+
+            # Tag while the gate is closed, so that results are stored with
+            # the hash of the model that produced them.
+            def retag(changes):
+                result_store.tag = tag
+            changes = await reloadable.reload(on_reloaded=retag)
+            if recorder is not None:
+                recorder.record_reload(changes)
+        fw.callback = reload
+        probes.start()
+        memory.start()
         await requestShutdown.wait()
 
+        logger.info("Shutting down.")
+        server.stop()
+        await fw.stop_watching()
+        await supervisor.stop()
+        await probes.stop()
+        await memory.stop()
+        await reloadable.drain(DRAIN_TIMEOUT)
+        await close_connections(app.connections, DRAIN_TIMEOUT)
+    if kernel_process.shared_buffers is not None:
+        kernel_process.shared_buffers.close()
+    await result_store.flush()
+    result_store.close()
+    if recorder is not None:
+        await recorder.flush()
+        recorder.close()
+
+
+def shutdown_on_signals(loop):
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, requestShutdown.set)
+
+
+def stop_on_exit(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Server failed.", exc_info=task.exception())
+    IOLoop.current().stop()
+
 
-asyncio.get_event_loop().create_task(start_nengonized())
+loop = asyncio.get_event_loop()
+shutdown_on_signals(loop)
+main_task = loop.create_task(start_nengonized())
+main_task.add_done_callback(stop_on_exit)
 IOLoop.current().start()
+if main_task.cancelled() or main_task.exception() is not None:
+    sys.exit(1)
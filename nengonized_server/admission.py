@@ -0,0 +1,95 @@
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+
+from .gql.cost import DEFAULT_LIST_SIZE, estimate_cost, model_list_sizes
+
+
+logger = logging.getLogger(__name__)
+
+# Limits of the server, also applied when replaying traces.
+QUERY_MAX_DEPTH = 16
+QUERY_MAX_COST = 1000000
+CLIENT_QUERY_BUDGET = 200000
+
+
+class QueryRejected(Exception):
+    pass
+
+
+class AdmissionController(object):
+    """Rejects or queues kernel queries by their estimated cost.
+
+    Queries nested deeper than `max_depth` or with an estimated cost above
+    `max_cost` are rejected. Each client may have queries with a total cost
+    of `client_budget` running at the same time; further queries are queued
+    until enough of the budget has been released. A query exceeding the
+    budget on its own is admitted once the client has nothing else running.
+    Limits of ``None`` are not applied.
+
+    List sizes for the cost estimation are taken from the snapshot of the
+    `kernel` (a `ConnectedKernel`), if any.
+    """
+
+    def __init__(
+            self, max_depth=None, max_cost=None, client_budget=None,
+            kernel=None, default_list_size=DEFAULT_LIST_SIZE):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.max_depth = max_depth
+        self.max_cost = max_cost
+        self.client_budget = client_budget
+        self.kernel = kernel
+        self.default_list_size = default_list_size
+        self.n_rejected = 0
+        self._in_flight = {}
+        self._released = asyncio.Condition()
+        self._snapshot = None
+        self._list_sizes = {}
+
+    def list_sizes(self):
+        snapshot = getattr(self.kernel, 'snapshot', None)
+        if snapshot is not self._snapshot:
+            self._snapshot = snapshot
+            self._list_sizes = model_list_sizes(snapshot)
+        return self._list_sizes
+
+    def admit_query(self, info):
+        """Admits the kernel query of the field resolved by `info`."""
+        estimate = estimate_cost(
+                info, self.list_sizes(), self.default_list_size)
+        return self.admit(info.context.client, estimate)
+
+    def check(self, estimate):
+        if self.max_depth is not None and estimate.depth > self.max_depth:
+            self.n_rejected += 1
+            raise QueryRejected(
+                    f"Query depth {estimate.depth} exceeds the limit of "
+                    f"{self.max_depth}.")
+        if self.max_cost is not None and estimate.cost > self.max_cost:
+            self.n_rejected += 1
+            raise QueryRejected(
+                    f"Query cost {estimate.cost} exceeds the limit of "
+                    f"{self.max_cost}.")
+
+    @asynccontextmanager
+    async def admit(self, client, estimate):
+        self.check(estimate)
+        cost = estimate.cost
+        async with self._released:
+            await self._released.wait_for(
+                    lambda: self._has_budget(client, cost))
+            self._in_flight[client] = self._in_flight.get(client, 0) + cost
+        try:
+            yield
+        finally:
+            async with self._released:
+                self._in_flight[client] -= cost
+                if self._in_flight[client] <= 0:
+                    del self._in_flight[client]
+                self._released.notify_all()
+
+    def _has_budget(self, client, cost):
+        in_flight = self._in_flight.get(client, 0)
+        return (
+            self.client_budget is None or in_flight == 0 or
+            in_flight + cost <= self.client_budget)
@@ -1,84 +1,555 @@
+import asyncio
 import json
 import logging
+import secrets
 
-import rx
-from tornado.web import Application
+from graphql.error import format_error
+from graphql.execution.executors.asyncio import AsyncioExecutor
+from promise import is_thenable
+from tornado.routing import PathMatches, Rule
+from tornado.web import Application, HTTPError, RequestHandler
 from tornado.websocket import WebSocketHandler
 
 from .gql.schema import schema
+from .incremental import chunk_deferred, split_lists
+from .kernel_logs import entry_to_dict
+from .memory import MemoryHandler
+from .probes import Downsampler, ProbeSubscription
+from .result_store import normalize_query
+from .shared_buffers import extract_buffers
 
 
 logger = logging.getLogger(__name__)
 
+# Distinguishes ETags of this process from those of earlier processes, in
+# which the model generations counted from zero as well.
+ETAG_EPOCH = secrets.token_hex(4)
 
-class GraphQlHandler(WebSocketHandler):
-    def initialize(self, context, schema):
+
+async def execute_query(schema, query, variables, context):
+    result = schema.execute(
+            query, variables=variables, context=context,
+            executor=AsyncioExecutor(asyncio.get_running_loop()),
+            return_promise=True)
+    if is_thenable(result):
+        result = await result
+    return result
+
+
+class BaseHandler(WebSocketHandler):
+    """Base class for websocket handlers.
+
+    With a `recorder` (a `TraceRecorder`), the connection and the messages
+    passed to `record_message` are recorded. `pending_bytes` approximates
+    the size of the messages not yet written to the network.
+    """
+
+    def initialize(self, context, connections=None, recorder=None):
         self.logger = logger.getChild(self.__class__.__name__)
         self.context = context
-        self.schema = schema
+        self.connections = connections
+        self.recorder = recorder
+        self.trace_id = None
+        self.pending_writes = set()
+        self.pending_bytes = 0
 
     def check_origin(self, origin):
         return True  # FIXME
 
+    def open(self):
+        if self.connections is not None:
+            self.connections.add(self)
+        if self.recorder is not None:
+            self.trace_id = self.recorder.open_connection(self.request.path)
+
+    def on_close(self):
+        if self.connections is not None:
+            self.connections.discard(self)
+        if self.trace_id is not None:
+            self.recorder.record('close', connection=self.trace_id)
+            self.trace_id = None
+
+    def record_message(self, message):
+        if self.trace_id is not None:
+            self.recorder.record(
+                    'message', connection=self.trace_id, message=message)
+
+    def send(self, message, binary=False):
+        if binary:
+            future = self.write_message(message, binary=True)
+        else:
+            future = self.write_message(message)
+        if asyncio.isfuture(future):
+            size = len(message)
+            self.pending_writes.add(future)
+            self.pending_bytes += size
+            future.add_done_callback(
+                    lambda f, size=size: self._write_done(f, size))
+        return len(message)
+
+    def _write_done(self, future, size):
+        self.pending_writes.discard(future)
+        self.pending_bytes -= size
+
+    def memory_usage(self):
+        """Returns the memory attributed to this connection."""
+        return {
+            'type': self.__class__.__name__,
+            'outboundBytes': self.pending_bytes,
+            'pendingWrites': len(self.pending_writes),
+            'lastResultBytes': 0,
+        }
+
+    async def flush_writes(self, timeout=None):
+        if self.pending_writes:
+            await asyncio.wait(self.pending_writes, timeout=timeout)
+
+
+class GraphQlHandler(BaseHandler):
+    """Base class for handlers sending GraphQL results.
+
+    If a `shared_buffers` area is given, buffer handles in result data are
+    resolved against it. Each referenced buffer is sent as a binary message
+    directly following the JSON message, which refers to it by index.
+    Buffers the kernel overwrote before they were sent are sent as
+    ``null``.
+    """
+
+    def initialize(
+            self, context, schema, connections=None, shared_buffers=None,
+            recorder=None):
+        super().initialize(context, connections, recorder)
+        self.schema = schema
+        self.shared_buffers = shared_buffers
+
+    def open(self):
+        super().open()
+        self.context = self.context.for_client(self)
+
+    def send_data(self, data):
+        """Sends `data` and returns the number of bytes sent."""
+        buffers = []
+        if self.shared_buffers is not None:
+            data, buffers = extract_buffers(data, self.shared_buffers)
+        size = self.send(json.dumps(data))
+        for buffer in buffers:
+            size += self.send(buffer, binary=True)
+        return size
+
 
 class QueryHandler(GraphQlHandler):
-    def on_message(self, message):
+    """Executes GraphQL queries.
+
+    A message is either a single operation ``{query, variables}`` or a batch
+    of operations. A batch is given as list of operations, or as
+    ``{batch: [...], stream: bool}``. The operations of a batch are executed
+    concurrently. Their results are sent as a single list, or, if `stream`
+    is set, one message ``{id, data}`` per operation as soon as it
+    completes. The `id` defaults to the index of the operation in the batch.
+
+    A single operation with ``incremental: {initialCount, chunkSize}`` is
+    delivered incrementally: the first message ``{data, hasNext}`` only
+    contains the first `initialCount` items of each list. The remaining
+    items follow in messages ``{path, items, hasNext}`` of at most
+    `chunkSize` items, where `path` points to the first item.
+    """
+
+    async def on_message(self, message):
+        self.record_message(message)
         data = json.loads(message)
-        result = self.schema.execute(
-                data['query'], variables=data['variables'],
-                context=self.context)
+        if isinstance(data, list):
+            data = {'batch': data}
+        if 'batch' in data:
+            await self.execute_batch(
+                    data['batch'], stream=data.get('stream', False))
+        elif 'incremental' in data:
+            await self.execute_incremental(
+                    data['query'], data.get('variables'),
+                    data['incremental'].get('initialCount', 20),
+                    data['incremental'].get('chunkSize', 100))
+        else:
+            result = await self.execute(data['query'], data['variables'])
+            self.send_data(result.data)
+
+    async def execute(self, query, variables):
+        result = await execute_query(
+                self.schema, query, variables, self.context)
         if result.errors:
             for error in result.errors:
                 self.logger.error(error)
-        self.write_message(json.dumps(result.data))
+        return result
 
+    async def execute_batch(self, operations, stream=False):
+        if stream:
+            await asyncio.gather(*(
+                self._execute_and_send(op.get('id', i), op)
+                for i, op in enumerate(operations)))
+        else:
+            results = await asyncio.gather(*(
+                self.execute(op['query'], op.get('variables'))
+                for op in operations))
+            self.send_data([result.data for result in results])
+
+    async def execute_incremental(
+            self, query, variables, initial_count, chunk_size):
+        """Executes a query and delivers its result in chunks.
+
+        The query is executed in full before the first message, because
+        connection fields are forwarded to the kernel as plain lists and
+        limiting them would not save a kernel round trip. What incremental
+        delivery bounds is the size of each message: the client can render
+        the first message before the remaining items arrive, and each
+        chunk is only sent once the previous message was written, so that
+        a slow client does not buffer the whole result at once.
+        """
+        result = await self.execute(query, variables)
+        data, deferred = split_lists(result.data, initial_count)
+        chunks = list(chunk_deferred(deferred, chunk_size))
+        self.send_data({'data': data, 'hasNext': len(chunks) > 0})
+        for i, (path, items) in enumerate(chunks):
+            await self.flush_writes()
+            self.send_data({
+                'path': path, 'items': items,
+                'hasNext': i + 1 < len(chunks)})
+
+    async def _execute_and_send(self, operation_id, operation):
+        result = await self.execute(
+                operation['query'], operation.get('variables'))
+        self.send_data({'id': operation_id, 'data': result.data})
+
+
+class HttpQueryHandler(RequestHandler):
+    """Executes GraphQL queries sent as plain HTTP requests.
+
+    Queries are either given as ``query`` and JSON ``variables`` arguments
+    of a GET request, or as JSON body ``{query, variables}`` (or as plain
+    query with content type ``application/graphql``) of a POST request.
+    The ETag of a response is derived from the `ETAG_EPOCH`, the model
+    generation and the normalized query, so that an ``If-None-Match``
+    request is answered with 304 without executing the query while the
+    model is unchanged. Responses with errors have no ETag.
+
+    Requests from the same remote address count as the same client for
+    scheduling and admission control.
+    """
 
-class SubscriptionHandler(GraphQlHandler):
     def initialize(self, context, schema):
-        super().initialize(context, schema)
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.context = context
+        self.schema = schema
+
+    async def get(self):
+        try:
+            variables = json.loads(self.get_query_argument('variables', 'null'))
+        except ValueError:
+            raise HTTPError(400, "Variables are not valid JSON.")
+        await self.execute(self.get_query_argument('query'), variables)
+
+    async def post(self):
+        content_type = self.request.headers.get('Content-Type', '')
+        if content_type.startswith('application/graphql'):
+            await self.execute(self.request.body.decode(), None)
+            return
+        try:
+            data = json.loads(self.request.body)
+            query = data['query']
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(400, "Expected JSON body with query.")
+        await self.execute(query, data.get('variables'))
+
+    def compute_etag(self):
+        return None
+
+    async def execute(self, query, variables):
+        key = normalize_query(query, variables)
+        etag = None
+        if key is not None:
+            etag = (
+                f'"{ETAG_EPOCH}-{self.context.reloadable.generation}-{key}"')
+            self.set_header('Etag', etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+            self.clear_header('Etag')
+
+        result = await execute_query(
+                self.schema, query, variables,
+                self.context.for_client(('http', self.request.remote_ip)))
+        response = {'data': result.data}
+        if result.errors:
+            for error in result.errors:
+                self.logger.error(error)
+            response['errors'] = [format_error(e) for e in result.errors]
+        elif etag is not None:
+            self.set_header('Etag', etag)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(response))
+
+
+class WebSocketPathMatches(PathMatches):
+    """Matches websocket upgrade requests to a path."""
+
+    def match(self, request):
+        if request.headers.get('Upgrade', '').lower() != 'websocket':
+            return None
+        return super().match(request)
+
+
+class UpdateBatcher(object):
+    """Coalesces subscription updates into a single message.
+
+    Updates are collected by subscription id, with later updates replacing
+    earlier ones, and sent as one JSON object at the end of the current
+    event loop iteration or after `flush_interval` seconds. `send` is called
+    with a dict mapping subscription ids to data.
+    """
+
+    def __init__(self, send, flush_interval=None):
+        self.send = send
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self._flush_handle = None
+
+    def add(self, subscription_id, data):
+        self.pending[subscription_id] = data
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            if self.flush_interval is None:
+                self._flush_handle = loop.call_soon(self.flush)
+            else:
+                self._flush_handle = loop.call_later(
+                        self.flush_interval, self.flush)
+
+    def discard(self, subscription_id):
+        self.pending.pop(subscription_id, None)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self.pending:
+            pending, self.pending = self.pending, {}
+            self.send(pending)
+
+
+class SubscriptionHandler(GraphQlHandler):
+    """Manages GraphQL subscriptions.
+
+    By default each update is sent as a separate message with the result
+    data. After a ``configure`` action with ``multiplex`` set, updates are
+    instead coalesced per event loop iteration, or per ``flushInterval``
+    seconds, into messages mapping subscription ids to result data.
+
+    A ``subscribeProbe`` action streams the samples of a `probe` as binary
+    messages (see `encode_frame`), downsampled in ``decimate`` or
+    ``minmax`` `mode` so that `window` simulation steps are covered by
+    `resolution` points. Subscribing again with the same id changes these.
+
+    With a `result_store`, the latest result of each subscription query is
+    persisted. A new subscription immediately receives the stored result,
+    if any, wrapped as ``{stale: message}`` where `message` is what would
+    have been sent for a fresh result.
+
+    `result_sizes` holds the size of the latest result sent for each
+    subscription as an indication of the size of its updates; the results
+    themselves are not retained. For multiplexed updates, the size of a
+    message is split evenly among its subscriptions.
+    """
+
+    def initialize(
+            self, context, schema, connections=None, shared_buffers=None,
+            recorder=None, result_store=None):
+        super().initialize(
+                context, schema, connections, shared_buffers, recorder)
+        self.result_store = result_store
         self.subscriptions = {}
+        self.result_keys = {}
+        self.result_sizes = {}
+        self.batcher = None
 
     def on_message(self, message):
+        self.record_message(message)
         data = json.loads(message)
         if data['action'] == 'subscribe':
             self.subscribe(
                 data.get('subscriptionId', None), data['query'], data['variables'])
+        elif data['action'] == 'subscribeProbe':
+            self.subscribe_probe(
+                data['subscriptionId'], data['probe'], data['window'],
+                data['resolution'], data.get('mode', Downsampler.DECIMATE))
         elif data['action'] == 'unsubscribe':
             self.unsubscribe(data['subscriptionId'])
+        elif data['action'] == 'configure':
+            self.configure(
+                data.get('multiplex', False), data.get('flushInterval', None))
         else:
             self.logger.error("Invalid action: %s", data['action'])
 
+    def configure(self, multiplex, flush_interval=None):
+        if self.batcher is not None:
+            self.batcher.flush()
+        if multiplex:
+            self.batcher = UpdateBatcher(self.send_updates, flush_interval)
+        else:
+            self.batcher = None
+
     def subscribe(self, subscription_id, query, variables):
         result = self.schema.execute(
                 query, variables=variables,
-                context=self.context, allow_subscriptions=True)
+                context=self.context, allow_subscriptions=True,
+                executor=AsyncioExecutor(asyncio.get_running_loop()))
         if hasattr(result, 'subscribe'):
             if subscription_id in self.subscriptions:
                 self.unsubscribe(subscription_id)
-            self.subscriptions[subscription_id] = result.subscribe(self.update)
+            if self.result_store is not None:
+                self.send_stored_result(
+                        subscription_id, normalize_query(query, variables))
+            self.subscriptions[subscription_id] = result.subscribe(
+                    lambda update, subscription_id=subscription_id: (
+                        self.update(update, subscription_id)))
         if hasattr(result, 'errors'):
             for error in result.errors:
                 self.logger.error(error)
 
+    def subscribe_probe(
+            self, subscription_id, probe, window, resolution,
+            mode=Downsampler.DECIMATE):
+        if subscription_id in self.subscriptions:
+            self.unsubscribe(subscription_id)
+        self.subscriptions[subscription_id] = ProbeSubscription(
+                str(subscription_id), self.context.probes, probe,
+                Downsampler.for_window(window, resolution, mode), self.send)
+
+    def send_stored_result(self, subscription_id, key):
+        if key is None:
+            return
+        self.result_keys[subscription_id] = key
+        data = self.result_store.get(key)
+        if data is None:
+            return
+        if self.batcher is None:
+            self.send_data({'stale': data})
+        else:
+            self.send_data({'stale': {subscription_id: data}})
+
     def unsubscribe(self, subscription_id):
         self.subscriptions[subscription_id].dispose()
         del self.subscriptions[subscription_id]
+        self.result_keys.pop(subscription_id, None)
+        self.result_sizes.pop(subscription_id, None)
+        if self.batcher is not None:
+            self.batcher.discard(subscription_id)
 
-    def update(self, result):
+    def update(self, result, subscription_id=None):
         if result.errors:
             for error in result.errors:
                 self.logger.error(error)
-        self.write_message(json.dumps(result.data))
+        elif subscription_id in self.result_keys:
+            self.result_store.put(
+                    self.result_keys[subscription_id], result.data)
+        if self.batcher is None:
+            size = self.send_data(result.data)
+            if subscription_id in self.subscriptions:
+                self.result_sizes[subscription_id] = size
+        else:
+            self.batcher.add(subscription_id, result.data)
+
+    def send_updates(self, updates):
+        size = self.send_data(updates) // len(updates)
+        for subscription_id in updates:
+            if subscription_id in self.subscriptions:
+                self.result_sizes[subscription_id] = size
+
+    def memory_usage(self):
+        usage = super().memory_usage()
+        usage['lastResultBytes'] = sum(self.result_sizes.values())
+        usage['pendingUpdates'] = (
+            len(self.batcher.pending) if self.batcher is not None else 0)
+        usage['subscriptions'] = {
+            str(subscription_id): {
+                'lastResultBytes': self.result_sizes.get(subscription_id, 0)}
+            for subscription_id in self.subscriptions}
+        return usage
 
-    def close(self):
+    async def flush_writes(self, timeout=None):
+        if self.batcher is not None:
+            self.batcher.flush()
+        await super().flush_writes(timeout)
+
+    def on_close(self):
+        super().on_close()
+        self.dispose_subscriptions()
+
+    def close(self, code=None, reason=None):
+        self.dispose_subscriptions()
+        super().close(code, reason)
+
+    def dispose_subscriptions(self):
         for subscription in self.subscriptions.values():
             subscription.dispose()
         self.subscriptions.clear()
+        self.result_keys.clear()
+        self.result_sizes.clear()
+
+
+class LogHandler(BaseHandler):
+    def initialize(self, context, connections=None):
+        super().initialize(context, connections)
+        self.channel = None
+        self.task = None
+
+    def open(self):
+        super().open()
+        self.send_entries(self.context.log.recent)
+        self.channel = self.context.log.listen()
+        self.task = asyncio.get_running_loop().create_task(self._forward())
+
+    async def _forward(self):
+        async for entries in self.channel:
+            self.send_entries(entries)
+
+    def on_close(self):
+        super().on_close()
+        if self.channel is not None:
+            self.channel.close()
+            self.task.cancel()
+            self.channel = None
+            self.task = None
+
+    def send_entries(self, entries):
+        self.send(json.dumps({'entries': [entry_to_dict(e) for e in entries]}))
+
+
+def make_app(
+        context, shared_buffers=None, result_store=None, recorder=None,
+        memory_sampler=None):
+    connections = set()
+    args = {
+        'context': context, 'schema': schema, 'connections': connections,
+        'shared_buffers': shared_buffers, 'recorder': recorder,
+    }
+    routes = [
+        Rule(WebSocketPathMatches(r"/graphql"), QueryHandler, args),
+        (r"/graphql", HttpQueryHandler, {
+            'context': context, 'schema': schema}),
+        (r"/subscription", SubscriptionHandler, dict(
+            args, result_store=result_store)),
+    ]
+    if context.log is not None:
+        routes.append((r"/logs", LogHandler, {
+            'context': context, 'connections': connections}))
+    if memory_sampler is not None:
+        memory_sampler.connections = connections
+        routes.append((r"/memory", MemoryHandler, {
+            'sampler': memory_sampler}))
+    app = Application(routes, compress_response=True)
+    app.connections = connections
+    return app
 
 
-def make_app(context):
-    args = {'context': context, 'schema': schema}
-    return Application([
-        (r"/graphql", QueryHandler, args),
-        (r"/subscription", SubscriptionHandler, args),
-    ])
+async def close_connections(connections, timeout=None):
+    """Flushes pending writes and closes all given websocket connections."""
+    connections = list(connections)
+    await asyncio.gather(*(c.flush_writes(timeout) for c in connections))
+    for connection in connections:
+        connection.close(1001, "Server shutting down.")
@@ -0,0 +1,120 @@
+# Pseudo node id for the data of a snapshot outside of any relay node. It
+# cannot clash with relay ids, which are never empty.
+ROOT_ID = ''
+
+# Key selected in place of the objects left out of a truncated snapshot.
+TRUNCATED = 'snapshotTruncated'
+
+
+class ChangeSet(object):
+    """Relay node ids that were added, removed, or changed by a reload."""
+
+    def __init__(self, added=(), removed=(), changed=()):
+        self.added = frozenset(added)
+        self.removed = frozenset(removed)
+        self.changed = frozenset(changed)
+
+    @property
+    def ids(self):
+        return self.added | self.removed | self.changed
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ChangeSet) and self.added == other.added and
+            self.removed == other.removed and self.changed == other.changed)
+
+    def __repr__(self):
+        return (
+            f'ChangeSet(added={set(self.added)}, '
+            f'removed={set(self.removed)}, changed={set(self.changed)})')
+
+
+def merge_changes(a, b):
+    """Combines two change sets; ``None`` stands for unknown changes."""
+    if a is None or b is None:
+        return None
+    return ChangeSet(
+        added=a.added | b.added, removed=a.removed | b.removed,
+        changed=a.changed | b.changed)
+
+
+def collect_nodes(data, root=False):
+    """Maps each relay node id in a query result to the node's own fields.
+
+    Nested nodes are replaced by their id, so that a change to a child node
+    does not mark its parents as changed as well. With `root`, the data
+    outside of any node is included as a pseudo node with `ROOT_ID`.
+    """
+    nodes = {}
+    own = _collect(data, nodes)
+    if root:
+        nodes[ROOT_ID] = own
+    return nodes
+
+
+def is_truncated(data):
+    """Returns whether a snapshot left out objects below its depth limit."""
+    if isinstance(data, dict):
+        return TRUNCATED in data or any(
+            is_truncated(v) for v in data.values())
+    elif isinstance(data, list):
+        return any(is_truncated(x) for x in data)
+    return False
+
+
+def _collect(data, nodes):
+    if isinstance(data, dict):
+        own = {k: _collect(v, nodes) for k, v in data.items()}
+        if 'id' in data:
+            nodes[data['id']] = own
+            return {'id': data['id']}
+        return own
+    elif isinstance(data, list):
+        return [_collect(x, nodes) for x in data]
+    else:
+        return data
+
+
+def diff_snapshots(old, new):
+    """Compares two query results on the level of relay nodes.
+
+    Returns ``None`` for unknown changes if either snapshot is truncated.
+    """
+    if is_truncated(old) or is_truncated(new):
+        return None
+    old_nodes = collect_nodes(old, root=True)
+    new_nodes = collect_nodes(new, root=True)
+    return ChangeSet(
+        added=new_nodes.keys() - old_nodes.keys(),
+        removed=old_nodes.keys() - new_nodes.keys(),
+        changed=(
+            k for k in old_nodes.keys() & new_nodes.keys()
+            if old_nodes[k] != new_nodes[k]))
+
+
+class NodeScope(object):
+    """Tracks the relay node ids contained in the latest result of a query.
+
+    Used to decide whether a `ChangeSet` requires re-executing the query.
+    As long as no ids are known, every non-empty change touches the scope.
+    Changes to the data outside of any node touch every scope.
+    """
+
+    def __init__(self):
+        self.ids = None
+
+    def update(self, data):
+        self.ids = frozenset(collect_nodes(data)) or None
+        return data
+
+    def is_touched_by(self, changes):
+        if changes is None:
+            return True
+        if not changes:
+            return False
+        if self.ids is None or ROOT_ID in changes.ids:
+            return True
+        return not self.ids.isdisjoint(changes.ids)
@@ -0,0 +1,59 @@
+import asyncio
+import struct
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class FramedConnection(object):
+    """Message connection over a local stream socket.
+
+    Each message is UTF-8 encoded and prefixed with its length as 4-byte
+    big-endian unsigned integer. The connection is either established on
+    an existing socket `sock` (e.g., one end of a socket pair) or to the
+    Unix domain socket at `path`.
+    """
+
+    header = struct.Struct('>I')
+
+    def __init__(self, sock=None, path=None):
+        assert (sock is None) != (path is None)
+        self.sock = sock
+        self.path = path
+        self.reader = None
+        self.writer = None
+
+    async def __aenter__(self):
+        if self.sock is not None:
+            self.reader, self.writer = await asyncio.open_connection(
+                    sock=self.sock)
+        else:
+            self.reader, self.writer = await asyncio.open_unix_connection(
+                    self.path)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    async def send(self, message):
+        payload = message.encode()
+        self.writer.write(self.header.pack(len(payload)))
+        self.writer.write(payload)
+        try:
+            await self.writer.drain()
+        except (ConnectionError, OSError) as err:
+            raise ConnectionClosed(str(err)) from err
+
+    async def recv(self):
+        try:
+            header = await self.reader.readexactly(self.header.size)
+            (length,) = self.header.unpack(header)
+            payload = await self.reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError) as err:
+            raise ConnectionClosed(str(err)) from err
+        return payload.decode()
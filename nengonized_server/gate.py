@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from .scheduling import QueueTimeStats
+
+
+class RwGate(object):
+    """Reader/writer gate that prefers writers.
+
+    Any number of readers may pass the gate at the same time, but a writer
+    needs exclusive access. Once a writer is waiting, new readers have to
+    wait until all pending writers are done, so that writers cannot be
+    starved by a steady stream of readers. Entering as a reader without a
+    pending writer only increments a counter. Wait times of readers and
+    writers are recorded in `read_wait` and `write_wait`.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.n_readers = 0
+        self.n_writers = 0
+        self.read_wait = QueueTimeStats()
+        self.write_wait = QueueTimeStats()
+        self._readers_may_enter = asyncio.Event()
+        self._readers_may_enter.set()
+        self._no_readers = asyncio.Event()
+        self._no_readers.set()
+        self._writer_lock = asyncio.Lock()
+
+    async def acquire_read(self):
+        if not self._readers_may_enter.is_set():
+            start = self.clock()
+            while not self._readers_may_enter.is_set():
+                await self._readers_may_enter.wait()
+            self.read_wait.add(self.clock() - start)
+        self.n_readers += 1
+        self._no_readers.clear()
+
+    def release_read(self):
+        self.n_readers -= 1
+        if self.n_readers == 0:
+            self._no_readers.set()
+
+    async def acquire_write(self):
+        start = self.clock()
+        self.n_writers += 1
+        self._readers_may_enter.clear()
+        try:
+            await self._writer_lock.acquire()
+            try:
+                await self._no_readers.wait()
+            except BaseException:
+                self._writer_lock.release()
+                raise
+        except BaseException:
+            self._leave_writer()
+            raise
+        self.write_wait.add(self.clock() - start)
+
+    def release_write(self):
+        self._writer_lock.release()
+        self._leave_writer()
+
+    def _leave_writer(self):
+        self.n_writers -= 1
+        if self.n_writers == 0:
+            self._readers_may_enter.set()
+
+    def metrics(self):
+        return {
+            'readers': self.n_readers,
+            'writers': self.n_writers,
+            'read_wait': self.read_wait.to_dict(),
+            'write_wait': self.write_wait.to_dict(),
+        }
+
+    async def wait_for_readers(self):
+        await self._no_readers.wait()
@@ -0,0 +1,111 @@
+"""Pre-serialized kernel schema.
+
+Importing the kernel schema pulls in the kernel with all its dependencies.
+To start faster, the introspection result of the kernel schema can be
+written to an artifact at build time with::
+
+    python -m nengonized_server.gql.artifact
+
+The kernel types are then rebuilt from the artifact instead. The artifact
+is ignored if it was built for another version of the kernel.
+"""
+
+from importlib import metadata
+import json
+import os
+
+from graphene import (
+        Boolean, Field, Float, ID, Int, List, NonNull, ObjectType, relay,
+        Schema, String)
+from graphene.types.generic import GenericScalar
+from graphene.utils.str_converters import to_snake_case
+
+
+ARTIFACT_PATH = os.path.join(os.path.dirname(__file__), 'kernel_schema.json')
+
+_scalars = {
+    'Boolean': Boolean, 'Float': Float, 'ID': ID, 'Int': Int,
+    'String': String,
+}
+
+
+def kernel_version():
+    try:
+        return metadata.version('nengonized-kernel')
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def write_artifact(path=ARTIFACT_PATH):
+    from nengonized_kernel.gql.schema import RootQuery
+    introspection = Schema(query=RootQuery).introspect()
+    with open(path, 'w') as f:
+        json.dump({
+            'kernelVersion': kernel_version(),
+            'schema': introspection['__schema'],
+        }, f)
+
+
+def load_artifact(path=ARTIFACT_PATH):
+    """Returns the introspected kernel schema or ``None`` if unusable."""
+    try:
+        with open(path) as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if artifact.get('kernelVersion') != kernel_version():
+        return None
+    return artifact['schema']
+
+
+def build_root_query(introspection):
+    """Rebuilds the query type of an introspected schema.
+
+    Only the parts of the schema that `stitch` supports are rebuilt: object
+    types, scalars, lists, and the Relay node interface. Field arguments
+    are dropped except for the Relay node field. Raises `ValueError` for
+    anything else.
+    """
+    types = {t['name']: t for t in introspection['types']}
+    built = {}
+
+    def get_type(name):
+        if name not in built:
+            built[name] = _build_object_type(types[name], get_type)
+        return built[name]
+
+    return get_type(introspection['queryType']['name'])
+
+
+def _build_object_type(type_data, get_type):
+    if type_data['kind'] != 'OBJECT':
+        raise ValueError(f"Unsupported kind {type_data['kind']}.")
+    is_node = any(i['name'] == 'Node' for i in type_data['interfaces'])
+    attrs = {}
+    for field in type_data['fields']:
+        if field['type'].get('name') == 'Node':
+            attrs[to_snake_case(field['name'])] = relay.Node.Field()
+        elif not (is_node and field['name'] == 'id'):
+            attrs[to_snake_case(field['name'])] = Field(
+                    _build_type_ref(field['type'], get_type))
+    return type(ObjectType)(
+            type_data['name'], (ObjectType,), attrs,
+            interfaces=(relay.Node,) if is_node else ())
+
+
+def _build_type_ref(type_ref, get_type):
+    kind = type_ref['kind']
+    if kind == 'NON_NULL':
+        return NonNull(_build_type_ref(type_ref['ofType'], get_type))
+    elif kind == 'LIST':
+        return List(_build_type_ref(type_ref['ofType'], get_type))
+    elif kind == 'SCALAR':
+        return _scalars.get(type_ref['name'], GenericScalar)
+    elif kind == 'OBJECT':
+        return lambda name=type_ref['name']: get_type(name)
+    else:
+        raise ValueError(f"Unsupported kind {kind}.")
+
+
+if __name__ == '__main__':
+    write_artifact()
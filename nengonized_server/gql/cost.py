@@ -0,0 +1,137 @@
+import math
+
+from graphql.language import ast
+from graphql.type import GraphQLList, GraphQLNonNull, get_named_type
+
+from .pagination import connection_list_name
+
+
+DEFAULT_LIST_SIZE = 10
+
+
+class CostEstimate(object):
+    def __init__(self, cost, depth):
+        self.cost = cost
+        self.depth = depth
+
+    def __repr__(self):
+        return f'CostEstimate(cost={self.cost}, depth={self.depth})'
+
+
+def model_list_sizes(data):
+    """Returns the mean length of the lists under each field name in `data`.
+
+    `data` is a query result like a model snapshot.
+    """
+    lengths = {}
+    _collect_list_lengths(data, None, lengths)
+    return {
+        name: math.ceil(sum(ls) / len(ls)) for name, ls in lengths.items()}
+
+
+def _collect_list_lengths(data, name, lengths):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            _collect_list_lengths(value, key, lengths)
+    elif isinstance(data, list):
+        lengths.setdefault(name, []).append(len(data))
+        for item in data:
+            _collect_list_lengths(item, name, lengths)
+
+
+def estimate_cost(info, list_sizes, default_list_size=DEFAULT_LIST_SIZE):
+    """Estimates the cost of the selection of the field resolved by `info`.
+
+    The cost is the expected number of resolved fields. Lists are expected
+    to have the length given in `list_sizes` for their field name, or
+    `default_list_size`. Connection fields are expected to return at most
+    ``first`` or ``last`` edges.
+    """
+    estimator = _Estimator(info, list_sizes, default_list_size)
+    return estimator.estimate(
+            info.field_asts[0].selection_set, get_named_type(info.return_type))
+
+
+class _Estimator(object):
+    def __init__(self, info, list_sizes, default_list_size):
+        self.schema = info.schema
+        self.fragments = info.fragments
+        self.variables = info.variable_values
+        self.list_sizes = list_sizes
+        self.default_list_size = default_list_size
+
+    def estimate(self, selection_set, type_, n_edges=None):
+        cost = 0
+        depth = 0
+        for selection, selection_type in self._fields(selection_set, type_):
+            estimate = self._estimate_field(selection, selection_type, n_edges)
+            cost += estimate.cost
+            depth = max(depth, estimate.depth)
+        return CostEstimate(cost, depth)
+
+    def _fields(self, selection_set, type_):
+        if selection_set is None:
+            return
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                yield selection, type_
+            else:
+                if isinstance(selection, ast.FragmentSpread):
+                    fragment = self.fragments[selection.name.value]
+                else:
+                    fragment = selection
+                if fragment.type_condition is not None:
+                    fragment_type = self.schema.get_type(
+                            fragment.type_condition.name.value)
+                else:
+                    fragment_type = type_
+                yield from self._fields(fragment.selection_set, fragment_type)
+
+    def _estimate_field(self, selection, type_, n_edges):
+        name = selection.name.value
+        field_def = getattr(type_, 'fields', {}).get(name)
+        if field_def is None or selection.selection_set is None:
+            return CostEstimate(1, 1)
+
+        multiplier = 1
+        if _is_list(field_def.type):
+            if name == 'edges' and n_edges is not None:
+                multiplier = n_edges
+            else:
+                multiplier = self.list_sizes.get(name, self.default_list_size)
+
+        child_edges = None
+        list_name = connection_list_name(type_.name, name)
+        if list_name is not None:
+            child_edges = self.list_sizes.get(
+                    list_name, self.default_list_size)
+            limit = self._page_size(selection)
+            if limit is not None:
+                child_edges = min(child_edges, limit)
+
+        children = self.estimate(
+                selection.selection_set, get_named_type(field_def.type),
+                child_edges)
+        return CostEstimate(
+                multiplier * (1 + children.cost), 1 + children.depth)
+
+    def _page_size(self, selection):
+        sizes = []
+        for argument in selection.arguments or []:
+            if argument.name.value not in ('first', 'last'):
+                continue
+            if isinstance(argument.value, ast.Variable):
+                value = (self.variables or {}).get(argument.value.name.value)
+            elif isinstance(argument.value, ast.IntValue):
+                value = int(argument.value.value)
+            else:
+                value = None
+            if value is not None:
+                sizes.append(value)
+        return min(sizes) if sizes else None
+
+
+def _is_list(type_):
+    if isinstance(type_, GraphQLNonNull):
+        type_ = type_.of_type
+    return isinstance(type_, GraphQLList)
@@ -0,0 +1,60 @@
+from graphql.language import ast
+from graphql.type import get_named_type, GraphQLID
+
+
+def has_node_id(type_):
+    """Returns whether objects of `type_` have a relay node ``id`` field."""
+    fields = getattr(type_, 'fields', {})
+    return 'id' in fields and get_named_type(fields['id'].type) is GraphQLID
+
+
+def select_node_ids(selection_set, type_, schema):
+    """Adds an ``id`` field to every selection of a type with node ids.
+
+    This makes all relay nodes in the result of a query visible to a
+    `NodeScope`, also those for which the client did not ask for the id.
+    Selections with another field under the ``id`` response key are left
+    alone.
+    """
+    if selection_set is None:
+        return None
+    selections = [
+        _select_node_ids(s, type_, schema) for s in selection_set.selections]
+    if has_node_id(type_) and not any(
+            isinstance(s, ast.Field) and (s.alias or s.name).value == 'id'
+            for s in selections):
+        selections.insert(0, ast.Field(name=ast.Name(value='id')))
+    return ast.SelectionSet(selections=selections)
+
+
+def select_fragment_node_ids(fragment, schema):
+    type_ = schema.get_type(fragment.type_condition.name.value)
+    return ast.FragmentDefinition(
+            name=fragment.name, type_condition=fragment.type_condition,
+            directives=fragment.directives,
+            selection_set=select_node_ids(
+                fragment.selection_set, type_, schema))
+
+
+def _select_node_ids(selection, type_, schema):
+    if isinstance(selection, ast.InlineFragment):
+        if selection.type_condition is not None:
+            type_ = schema.get_type(selection.type_condition.name.value)
+        return ast.InlineFragment(
+                type_condition=selection.type_condition,
+                directives=selection.directives,
+                selection_set=select_node_ids(
+                    selection.selection_set, type_, schema))
+    elif not isinstance(selection, ast.Field) or (
+            selection.selection_set is None):
+        return selection
+
+    fields = getattr(type_, 'fields', {})
+    if selection.name.value not in fields:
+        return selection
+    return ast.Field(
+            alias=selection.alias, name=selection.name,
+            arguments=selection.arguments, directives=selection.directives,
+            selection_set=select_node_ids(
+                selection.selection_set,
+                get_named_type(fields[selection.name.value].type), schema))
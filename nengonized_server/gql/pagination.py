@@ -0,0 +1,149 @@
+from graphene import Field, List, NonNull, ObjectType, relay
+from graphene.utils.str_converters import to_camel_case
+from graphql.language import ast
+from graphql.type import get_named_type
+
+
+# Maps (type name, connection field name) to the name of the list field the
+# connection pages through, all as GraphQL names.
+_connection_fields = {}
+_connection_types = {}
+
+
+def object_list_type(type_):
+    """Returns the object type of a list field or ``None``."""
+    if isinstance(type_, Field):
+        type_ = type_.type
+    if isinstance(type_, NonNull):
+        type_ = type_.of_type
+    if not isinstance(type_, List):
+        return None
+    of_type = type_.of_type
+    if isinstance(of_type, NonNull):
+        of_type = of_type.of_type
+    if isinstance(of_type, type) and issubclass(of_type, ObjectType):
+        return of_type
+    return None
+
+
+def connection_type(node_type):
+    if node_type not in _connection_types:
+        meta = type('Meta', (), {'node': node_type})
+        _connection_types[node_type] = type(relay.Connection)(
+                f'{node_type._meta.name}Connection', (relay.Connection,),
+                {'Meta': meta})
+    return _connection_types[node_type]
+
+
+def connection_field(type_name, list_name, get_node_type):
+    """Creates a Relay connection field paging through a list field.
+
+    The connection field is named like the list field with a
+    ``_connection`` suffix. `get_node_type` returns the node type once
+    the schema is built, to allow for recursive types.
+    """
+    name = list_name + '_connection'
+    _connection_fields[(type_name, to_camel_case(name))] = (
+            to_camel_case(list_name))
+    return name, relay.ConnectionField(
+            lambda: connection_type(get_node_type()))
+
+
+def connection_list_name(type_name, field_name):
+    """Returns the list field paged by a connection field or ``None``."""
+    return _connection_fields.get((type_name, field_name))
+
+
+def response_key(field_ast):
+    return (field_ast.alias or field_ast.name).value
+
+
+def rewrite_connections(selection_set, type_, schema):
+    """Rewrites connection fields to the list fields known by the kernel.
+
+    A connection field ``key: xsConnection(first: 10) { edges { node {
+    ... } } }`` becomes ``key: xs { ... }``, so that the kernel response
+    can be paged through by the connection field resolver.
+    """
+    if selection_set is None:
+        return None
+    return ast.SelectionSet(selections=[
+        _rewrite_selection(s, type_, schema)
+        for s in selection_set.selections])
+
+
+def rewrite_fragment(fragment, schema):
+    type_ = schema.get_type(fragment.type_condition.name.value)
+    return ast.FragmentDefinition(
+            name=fragment.name, type_condition=fragment.type_condition,
+            directives=fragment.directives,
+            selection_set=rewrite_connections(
+                fragment.selection_set, type_, schema))
+
+
+def _rewrite_selection(selection, type_, schema):
+    if isinstance(selection, ast.InlineFragment):
+        if selection.type_condition is not None:
+            type_ = schema.get_type(selection.type_condition.name.value)
+        return ast.InlineFragment(
+                type_condition=selection.type_condition,
+                directives=selection.directives,
+                selection_set=rewrite_connections(
+                    selection.selection_set, type_, schema))
+    elif not isinstance(selection, ast.Field):
+        return selection  # fragment definitions are rewritten separately
+
+    fields = getattr(type_, 'fields', {})
+    list_name = connection_list_name(type_.name, selection.name.value)
+    if list_name is not None:
+        return _to_list_field(selection, list_name, fields, schema)
+    elif selection.name.value in fields:
+        field_type = get_named_type(fields[selection.name.value].type)
+        return ast.Field(
+                alias=selection.alias, name=selection.name,
+                arguments=selection.arguments,
+                directives=selection.directives,
+                selection_set=rewrite_connections(
+                    selection.selection_set, field_type, schema))
+    else:
+        return selection
+
+
+def _to_list_field(selection, list_name, fields, schema):
+    node_selections = [
+        node_selection
+        for edges in _subfields(selection, 'edges')
+        for node in _subfields(edges, 'node')
+        for node_selection in node.selection_set.selections]
+    if not node_selections:
+        node_selections = [ast.Field(name=ast.Name(value='__typename'))]
+    node_type = get_named_type(fields[list_name].type)
+    return ast.Field(
+            alias=ast.Name(value=response_key(selection)),
+            name=ast.Name(value=list_name), directives=selection.directives,
+            selection_set=rewrite_connections(
+                ast.SelectionSet(selections=node_selections), node_type,
+                schema))
+
+
+def _subfields(field, name):
+    if field.selection_set is None:
+        return []
+    return [
+        s for s in field.selection_set.selections
+        if isinstance(s, ast.Field) and s.name.value == name]
+
+
+def used_variables(node):
+    """Returns the names of all variables referenced in an AST `node`."""
+    names = set()
+    if isinstance(node, ast.Variable):
+        names.add(node.name.value)
+    elif isinstance(node, list):
+        for child in node:
+            names.update(used_variables(child))
+    elif isinstance(node, ast.Node):
+        for slot in node.__slots__:
+            if slot != 'loc':
+                names.update(used_variables(getattr(node, slot)))
+    return names
@@ -1,64 +1,198 @@
-import asyncio
+from contextlib import asynccontextmanager
+import copy
 import json
-import os
-from subprocess import PIPE
-import sys
-import time
+import logging
+import threading
 
-from graphene import Field, List, NonNull, ObjectType, relay, Scalar, Schema
+from graphene import Field, Int, ObjectType, relay, Schema, String
 from graphql.language.printer import print_ast
-from nengonized_kernel.gql.schema import RootQuery as KernelRootQuery
-from nengonized_kernel.gql.nengo_model_schema import NengoNetwork
-import rx
-import websockets
-
+from graphql.type import get_named_type
+
+from ..changes import NodeScope
+from ..scheduling import Priority
+from ..streams import switch_map
+from .artifact import build_root_query, load_artifact
+from .node_ids import select_fragment_node_ids, select_node_ids
+from .pagination import rewrite_connections, rewrite_fragment, used_variables
+from .snapshot import build_snapshot_query
 from .stitching import stitch
 
 
-def construct_stitched_query(info):
-    if len(info.operation.variable_definitions) > 0:
+logger = logging.getLogger(__name__)
+
+
+def _load_kernel_root_query():
+    introspection = load_artifact()
+    if introspection is not None:
+        try:
+            return build_root_query(introspection)
+        except (KeyError, ValueError) as err:
+            logger.warning("Ignoring kernel schema artifact: %s", err)
+    from nengonized_kernel.gql.schema import RootQuery
+    return RootQuery
+
+
+_stitched_kernel_root = None
+_stitched_kernel_root_lock = threading.Lock()
+
+
+def stitched_kernel_root():
+    """Returns the stitched kernel query type, building it on first use.
+
+    Safe to call from an executor while the schema is built on the loop.
+    """
+    global _stitched_kernel_root
+    with _stitched_kernel_root_lock:
+        if _stitched_kernel_root is None:
+            _stitched_kernel_root = stitch(_load_kernel_root_query())
+    return _stitched_kernel_root
+
+
+def construct_stitched_query(info, node_ids=False):
+    """Builds the query forwarded to the kernel for the field of `info`.
+
+    With `node_ids`, the ``id`` of every relay node in the result is
+    selected, even if the client did not ask for it.
+    """
+    type_ = get_named_type(info.return_type)
+    selection_set = rewrite_connections(
+            info.field_asts[0].selection_set, type_, info.schema)
+    fragments = [
+        rewrite_fragment(x, info.schema) for x in info.fragments.values()]
+    if node_ids:
+        selection_set = select_node_ids(selection_set, type_, info.schema)
+        fragments = [
+            select_fragment_node_ids(x, info.schema) for x in fragments]
+    used = used_variables([selection_set] + fragments)
+    variable_definitions = [
+        x for x in info.operation.variable_definitions or []
+        if x.variable.name.value in used]
+    if variable_definitions:
         variable_defs = '(' + ','.join(
-                print_ast(info.operation.variable_definitions)) + ')'
+                print_ast(variable_definitions)) + ')'
     else:
         variable_defs = ''
-    query = print_ast(info.field_asts[0].selection_set)
-    fragments = [print_ast(x) for x in info.fragments.values()]
+    query = print_ast(selection_set)
+    fragments = [print_ast(x) for x in fragments]
+    name = info.operation.name.value if info.operation.name else ''
     return '\n'.join([
-        f'''query {info.operation.name.value}{variable_defs} {query}''']
-        + fragments)
+        f'''query {name}{variable_defs} {query}'''] + fragments)
 
 
 class Context(object):
-    def __init__(self, reloadable, kernel):
+    def __init__(
+            self, reloadable, kernel, log=None, supervisor=None, probes=None,
+            admission=None, active_queries=None, client=None):
         self.reloadable = reloadable
         self.kernel = kernel
+        self.log = log
+        self.supervisor = supervisor
+        self.probes = probes
+        self.admission = admission
+        self.active_queries = active_queries
+        self.client = client
+
+    def for_client(self, client):
+        context = copy.copy(self)
+        context.client = client
+        return context
+
+
+@asynccontextmanager
+async def _admitted_anyway():
+    yield
+
+
+def admit_kernel_query(info):
+    if info.context.admission is None:
+        return _admitted_anyway()
+    return info.context.admission.admit_query(info)
+
+
+class KernelHealth(ObjectType):
+    status = String(required=True)
+    restarts = Int(required=True)
+    last_crash_reason = String()
 
 
 class ServerRootQuery(ObjectType):
     node = relay.Node.Field()
+    kernel = Field(stitched_kernel_root)
 
+    async def resolve_kernel(self, info):
+        async with admit_kernel_query(info):
+            result = await info.context.reloadable.call(
+                    info.context.kernel.query, construct_stitched_query(info),
+                    variables=info.variable_values,
+                    priority=Priority.INTERACTIVE, client=info.context.client)
+        return stitched_kernel_root()(json.loads(result))
 
-class Subscription(ObjectType):
-    kernel = Field(stitch(KernelRootQuery))
 
-    def resolve_kernel(self, info):
+class Subscription(ObjectType):
+    kernel = Field(stitched_kernel_root)
+    kernel_health = Field(KernelHealth)
+
+    async def resolve_kernel_health(self, info):
+        updates = info.context.supervisor.listen()
+        try:
+            async for health in updates:
+                yield KernelHealth(
+                    status=health.status, restarts=health.restarts,
+                    last_crash_reason=health.last_crash_reason)
+        finally:
+            updates.close()
+
+    async def resolve_kernel(self, info):
         assert len(info.field_asts) == 1
         assert info.field_asts[0].name.value == 'kernel'
 
-        return rx.Observable.merge(
-                rx.Observable.just(True),  # Send data at least once
-                info.context.reloadable
-            ).flat_map(
-                lambda _: rx.Observable.from_future(
-                    asyncio.get_running_loop().create_task(
-                        info.context.reloadable.call(
-                            info.context.kernel.query,
-                            construct_stitched_query(info),
-                            variables=info.variable_values)))
-            ).map(lambda result: stitch(KernelRootQuery)(json.loads(result)))
-
-
-schema = Schema(query=ServerRootQuery, subscription=Subscription)
+        scope = NodeScope()
+        query = construct_stitched_query(info, node_ids=True)
+        priority = Priority.INTERACTIVE
+
+        async def refresh(changes):
+            async with admit_kernel_query(info):
+                result = await info.context.reloadable.call(
+                        info.context.kernel.query, query,
+                        variables=info.variable_values, priority=priority,
+                        client=info.context.client)
+            return stitched_kernel_root()(scope.update(json.loads(result)))
+
+        active_queries = info.context.active_queries
+        if active_queries is not None:
+            active_queries.add(query, info.variable_values)
+        updates = info.context.reloadable.listen(initial=None)
+        try:
+            async for result in switch_map((
+                    changes async for changes in updates
+                    if scope.is_touched_by(changes)), refresh):
+                priority = Priority.SUBSCRIPTION
+                yield result
+        finally:
+            updates.close()
+            if active_queries is not None:
+                active_queries.discard(query, info.variable_values)
+
+
+class LazySchema(object):
+    """Proxy building a schema on first use."""
+
+    def __init__(self, build):
+        self._build = build
+        self._schema = None
+
+    def __getattr__(self, name):
+        if self._schema is None:
+            self._schema = self._build()
+        return getattr(self._schema, name)
+
+
+schema = LazySchema(
+        lambda: Schema(query=ServerRootQuery, subscription=Subscription))
+
+
+def get_snapshot_query():
+    return build_snapshot_query(stitched_kernel_root())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,57 @@
+from graphene import List, NonNull, ObjectType, relay
+from graphene.utils.str_converters import to_camel_case
+
+from ..changes import TRUNCATED
+from .pagination import connection_list_name
+
+
+def build_snapshot_query(type_, max_depth=8):
+    """Builds a query selecting all fields of `type_` without arguments.
+
+    Object fields are followed up to `max_depth` levels deep to cope with
+    recursive types like nested networks. Below that, and in place of
+    fields with required arguments, only a `TRUNCATED` marker is selected,
+    so that a result leaving out any objects can be recognized. Connection
+    fields and the relay node field are skipped, since they only expose
+    objects selected elsewhere. The result can be diffed with
+    `nengonized_server.changes.diff_snapshots`.
+    """
+    return 'query Snapshot ' + _build_selection(type_, max_depth)
+
+
+def _build_selection(type_, depth):
+    selections = []
+    truncated = False
+    for name, field in type_._meta.fields.items():
+        field_name = field.name or to_camel_case(name)
+        if isinstance(field, relay.node.NodeField) or connection_list_name(
+                type_._meta.name, field_name) is not None:
+            continue
+        if any(_is_required(arg) for arg in field.args.values()):
+            truncated = True
+            continue
+        field_type = _unwrap(field.type)
+        if isinstance(field_type, type) and issubclass(field_type, ObjectType):
+            if depth > 0:
+                selection = _build_selection(field_type, depth - 1)
+            else:
+                selection = f'{{ {TRUNCATED}: __typename }}'
+            if selection:
+                selections.append(f'{field_name} {selection}')
+        else:
+            selections.append(field_name)
+    if truncated:
+        selections.append(f'{TRUNCATED}: __typename')
+    if len(selections) == 0:
+        return ''
+    return '{ ' + ' '.join(selections) + ' }'
+
+
+def _is_required(arg):
+    return isinstance(arg.type, NonNull) and arg.default_value is None
+
+
+def _unwrap(type_):
+    while isinstance(type_, (List, NonNull)):
+        type_ = type_.of_type
+    return type_
@@ -1,6 +1,8 @@
 from graphql_relay import from_global_id
 from graphene import Field, ID, List, NonNull, ObjectType, relay, Scalar
 
+from .pagination import connection_field, object_list_type, response_key
+
 
 _stitched = {}
 
@@ -40,6 +42,11 @@ def _create_resolver(new_type, name):
         _cast(new_type, self.data[name]))
 
 
+def _create_connection_resolver(new_type):
+    return lambda self, info, new_type=new_type, **kwargs: (
+        _cast(new_type, self.data[response_key(info.field_asts[0])]))
+
+
 class StitchedRelayNodeField(relay.node.NodeField):
     def __init__(self, name, *args, **kwargs):
         super().__init__(relay.node.Node, *args, **kwargs)
@@ -76,6 +83,13 @@ def stitch(type_):
             new_type = to_stitched_type(attr)
             cls_dict[name] = new_type
             cls_dict['resolve_' + name] = _create_resolver(new_type, name)
+            node_type = object_list_type(attr)
+            if node_type is not None:
+                connection_name, cls_dict[connection_name] = connection_field(
+                        type_._meta.name, name,
+                        lambda node_type=node_type: stitch(node_type))
+                cls_dict['resolve_' + connection_name] = (
+                        _create_connection_resolver(new_type))
     if relay.Node in type_._meta.interfaces:
         cls_dict['resolve_id'] = _create_resolver(ID(), 'id')
     cls = type(ObjectType)(
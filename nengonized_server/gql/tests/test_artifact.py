@@ -0,0 +1,64 @@
+import json
+
+from graphene import Field, Int, List, ObjectType, relay, Schema, String
+from nengonized_kernel.gql.testing import assert_gql_data_equals
+
+from nengonized_server.gql import artifact
+from nengonized_server.gql.artifact import build_root_query, load_artifact
+from nengonized_server.gql.stitching import stitch
+
+
+class Ensemble(ObjectType, interfaces=[relay.Node]):
+    label = String()
+    n_neurons = Int()
+
+
+class Network(ObjectType, interfaces=[relay.Node]):
+    label = String()
+    ensembles = List(Ensemble)
+    networks = List(lambda: Network)
+
+
+class Root(ObjectType):
+    model = Field(Network)
+    node = relay.Node.Field()
+
+
+def introspect(query_type):
+    return Schema(query=query_type).introspect()['__schema']
+
+
+def field_names(introspection):
+    return {
+        t['name']: sorted(f['name'] for f in t['fields'] or [])
+        for t in introspection['types']}
+
+
+def test_rebuilds_stitchable_root_query():
+    root = build_root_query(introspect(Root))
+    assert field_names(introspect(root)) == field_names(introspect(Root))
+
+    schema = Schema(query=stitch(root))
+    result = schema.execute(
+            '{ model { label networks { label } ensembles { nNeurons } } }',
+            root=stitch(root)({'model': {
+                'label': 'a', 'networks': [{'label': 'b'}],
+                'ensembles': [{'n_neurons': 10}]}}))
+    assert_gql_data_equals(result, {'model': {
+        'label': 'a', 'networks': [{'label': 'b'}],
+        'ensembles': [{'nNeurons': 10}]}})
+
+
+def test_ignores_artifact_for_other_kernel_version(tmpdir, monkeypatch):
+    path = str(tmpdir.join('kernel_schema.json'))
+    with open(path, 'w') as f:
+        json.dump({'kernelVersion': '1.0', 'schema': {}}, f)
+
+    monkeypatch.setattr(artifact, 'kernel_version', lambda: '1.0')
+    assert load_artifact(path) == {}
+    monkeypatch.setattr(artifact, 'kernel_version', lambda: '2.0')
+    assert load_artifact(path) is None
+
+
+def test_ignores_missing_artifact(tmpdir):
+    assert load_artifact(str(tmpdir.join('missing.json'))) is None
@@ -0,0 +1,82 @@
+import asyncio
+from contextlib import asynccontextmanager
+from unittest import mock
+
+from graphql.execution.executors.asyncio import AsyncioExecutor
+import pytest
+
+from nengonized_server.admission import AdmissionController
+from nengonized_server.gql.cost import estimate_cost, model_list_sizes
+from nengonized_server.gql.schema import schema
+
+
+async def kernel_query(*args, **kwargs):
+    return '{ "model": null }'
+
+
+class AdmissionSpy(object):
+    def __init__(self, list_sizes):
+        self.list_sizes = list_sizes
+        self.estimates = []
+
+    @asynccontextmanager
+    async def admit_query(self, info):
+        self.estimates.append(estimate_cost(info, self.list_sizes))
+        yield
+
+
+async def estimate(query, list_sizes, variables=None):
+    context = mock.MagicMock()
+    context.reloadable.call = mock.MagicMock(side_effect=kernel_query)
+    context.admission = AdmissionSpy(list_sizes)
+    result = await schema.execute(
+            query, context=context, variables=variables,
+            executor=AsyncioExecutor(asyncio.get_running_loop()),
+            return_promise=True)
+    assert not result.errors, result.errors
+    return context.admission.estimates[0]
+
+
+def test_computes_mean_list_sizes():
+    assert model_list_sizes({'model': {'ensembles': [{}, {}], 'networks': [
+        {'ensembles': [{}, {}, {}, {}]}, {'ensembles': []}]}}) == {
+            'ensembles': 2, 'networks': 2}
+
+
+@pytest.mark.asyncio
+async def test_weights_lists_by_model_sizes():
+    result = await estimate('''{ kernel { model {
+        label
+        ensembles { label }
+        networks { label networks { label } }
+    } } }''', {'ensembles': 5, 'networks': 2})
+    assert result.cost == 24
+    assert result.depth == 4
+
+
+@pytest.mark.asyncio
+async def test_limits_connections_to_page_size():
+    result = await estimate('''query Q($n: Int) { kernel { model {
+        ensemblesConnection(first: $n) { edges { node { label } } }
+    } } }''', {'ensembles': 5}, variables={'n': 2})
+    assert result.cost == 8
+
+
+@pytest.mark.asyncio
+async def test_follows_fragments():
+    result = await estimate('''{ kernel { model { ...f } } }
+        fragment f on NengoNetwork { ensembles { label } }''', {})
+    assert result.cost == 21
+
+
+@pytest.mark.asyncio
+async def test_rejects_expensive_queries():
+    context = mock.MagicMock()
+    context.reloadable.call = mock.MagicMock(side_effect=kernel_query)
+    context.admission = AdmissionController(max_depth=2)
+    result = await schema.execute(
+            '{ kernel { model { networks { label } } } }', context=context,
+            executor=AsyncioExecutor(asyncio.get_running_loop()),
+            return_promise=True)
+    assert "depth 3 exceeds" in str(result.errors[0])
+    context.reloadable.call.assert_not_called()
@@ -2,12 +2,16 @@ import asyncio
 from unittest import mock
 import re
 
+from graphql.execution.executors.asyncio import AsyncioExecutor
 from nengonized_kernel.gql.testing import assert_gql_data_equals
 import pytest
-import rx
 
 from nengonized_server.async_testing import mock_coroutine
-from nengonized_server.gql.schema import schema
+from nengonized_server.changes import ChangeSet, merge_changes
+from nengonized_server.gql.schema import Context, schema
+from nengonized_server.kernel_management import ActiveQueries
+from nengonized_server.streams import Broadcast
+from nengonized_server.supervision import Health
 
 
 pytestmark = pytest.mark.asyncio
@@ -18,27 +22,43 @@ async def dummy_coro(*args, **kwargs):
 
 
 async def complete_other_tasks():
-    current_task = asyncio.current_task()
-    other_tasks = (
-            task for task in asyncio.all_tasks() if task is not current_task)
-    await asyncio.gather(*other_tasks)
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+class ReloadableStub(object):
+    def __init__(self):
+        self.reloads = Broadcast(merge=merge_changes)
+
+    def listen(self, **kwargs):
+        return self.reloads.listen(**kwargs)
+
+    def on_next(self, changes):
+        self.reloads.publish(changes)
+
+
+def subscribe(query, context, observer, variables=None):
+    obs = schema.execute(
+            query, context=context, variables=variables,
+            allow_subscriptions=True,
+            executor=AsyncioExecutor(asyncio.get_running_loop()))
+    return obs.subscribe(observer)
 
 
 async def test_can_subscribe_to_kernel():
     context_mock = mock.MagicMock()
-    context_mock.reloadable = rx.subjects.Subject()
+    context_mock.reloadable = ReloadableStub()
     context_mock.reloadable.call = dummy_coro
     observer_mock = mock.MagicMock()
-    obs = schema.execute(
+    subscribe(
             'subscription Sub { kernel { model { label } } }',
-            context=context_mock, allow_subscriptions=True)
-    obs.subscribe(observer_mock)
+            context_mock, observer_mock)
 
     await complete_other_tasks()
     observer_mock.on_next.assert_called_once()
     observer_mock.on_next.reset_mock()
 
-    context_mock.reloadable.on_next(2)
+    context_mock.reloadable.on_next(None)
     await complete_other_tasks()
     observer_mock.on_next.assert_called_once()
     assert_gql_data_equals(observer_mock.on_next.call_args[0][0], {
@@ -46,41 +66,164 @@ async def test_can_subscribe_to_kernel():
     })
 
 
+async def test_skips_requery_if_reload_changed_nothing():
+    context_mock = mock.MagicMock()
+    context_mock.reloadable = ReloadableStub()
+    context_mock.reloadable.call = mock.MagicMock(side_effect=dummy_coro)
+    observer_mock = mock.MagicMock()
+    subscribe(
+            'subscription Sub { kernel { model { label } } }',
+            context_mock, observer_mock)
+    await complete_other_tasks()
+    context_mock.reloadable.call.reset_mock()
+
+    context_mock.reloadable.on_next(ChangeSet())
+    await complete_other_tasks()
+    context_mock.reloadable.call.assert_not_called()
+
+
+async def test_requeries_only_if_changes_touch_result_nodes():
+    async def query(*args, **kwargs):
+        return '{ "model": { "id": "a", "label": "foo" } }'
+
+    context_mock = mock.MagicMock()
+    context_mock.reloadable = ReloadableStub()
+    context_mock.reloadable.call = mock.MagicMock(side_effect=query)
+    observer_mock = mock.MagicMock()
+    subscribe(
+            'subscription Sub { kernel { model { id label } } }',
+            context_mock, observer_mock)
+    await complete_other_tasks()
+    context_mock.reloadable.call.reset_mock()
+
+    context_mock.reloadable.on_next(ChangeSet(changed={'b'}))
+    await complete_other_tasks()
+    context_mock.reloadable.call.assert_not_called()
+
+    context_mock.reloadable.on_next(ChangeSet(changed={'a'}))
+    await complete_other_tasks()
+    context_mock.reloadable.call.assert_called_once()
+
+
+async def test_scopes_to_nodes_without_selected_ids():
+    async def query(*args, **kwargs):
+        return '{ "model": { "id": "a", "label": "foo" } }'
+
+    context_mock = mock.MagicMock()
+    context_mock.reloadable = ReloadableStub()
+    context_mock.reloadable.call = mock.MagicMock(side_effect=query)
+    observer_mock = mock.MagicMock()
+    subscribe(
+            'subscription Sub { kernel { model { label } } }',
+            context_mock, observer_mock)
+    await complete_other_tasks()
+    _, query = context_mock.reloadable.call.call_args[0]
+    assert re.sub(r'\s+', '', query) == 'querySub{model{idlabel}}'
+    assert_gql_data_equals(observer_mock.on_next.call_args[0][0], {
+        'kernel': {'model': {'label': 'foo'}}
+    })
+    context_mock.reloadable.call.reset_mock()
+
+    context_mock.reloadable.on_next(ChangeSet(changed={'b'}))
+    await complete_other_tasks()
+    context_mock.reloadable.call.assert_not_called()
+
+
+async def test_cancels_superseded_refreshes():
+    cont = asyncio.Event()
+    responses = iter(['first', 'superseded', 'latest'])
+
+    async def query(*args, **kwargs):
+        label = next(responses)
+        if label == 'superseded':
+            await cont.wait()
+        return f'{{ "model": {{ "label": "{label}" }} }}'
+
+    context_mock = mock.MagicMock()
+    context_mock.reloadable = ReloadableStub()
+    context_mock.reloadable.call = query
+    observer_mock = mock.MagicMock()
+    subscribe(
+            'subscription Sub { kernel { model { label } } }',
+            context_mock, observer_mock)
+    await complete_other_tasks()
+
+    context_mock.reloadable.on_next(None)
+    await complete_other_tasks()
+    context_mock.reloadable.on_next(None)
+    await complete_other_tasks()
+    cont.set()
+    await complete_other_tasks()
+
+    labels = [
+        c[0][0].data['kernel']['model']['label']
+        for c in observer_mock.on_next.call_args_list]
+    assert labels == ['first', 'latest']
+
+
+async def test_unsubscribing_stops_listening_to_reloads():
+    context_mock = mock.MagicMock()
+    context_mock.reloadable = ReloadableStub()
+    context_mock.reloadable.call = dummy_coro
+    disposable = subscribe(
+            'subscription Sub { kernel { model { label } } }',
+            context_mock, mock.MagicMock())
+    await complete_other_tasks()
+    assert len(context_mock.reloadable.reloads._listeners) == 1
+
+    disposable.dispose()
+    await complete_other_tasks()
+    assert len(context_mock.reloadable.reloads._listeners) == 0
+
+
+async def test_registers_active_kernel_queries():
+    context_mock = mock.MagicMock()
+    context_mock.reloadable = ReloadableStub()
+    context_mock.reloadable.call = mock.MagicMock(side_effect=dummy_coro)
+    context_mock.active_queries = ActiveQueries()
+    disposable = subscribe(
+            'subscription Sub { kernel { model { label } } }',
+            context_mock, mock.MagicMock())
+    await complete_other_tasks()
+    _, query = context_mock.reloadable.call.call_args[0]
+    variables = context_mock.reloadable.call.call_args[1]['variables']
+    assert list(context_mock.active_queries) == [(query, variables)]
+
+    disposable.dispose()
+    await complete_other_tasks()
+    assert len(context_mock.active_queries) == 0
+
+
 async def test_supports_fragments():
     context_mock = mock.MagicMock()
-    context_mock.reloadable = rx.subjects.Subject()
-    context_mock.reloadable.call = mock.MagicMock()
-    context_mock.reloadable.call.return_value = dummy_coro()
+    context_mock.reloadable = ReloadableStub()
+    context_mock.reloadable.call = mock.MagicMock(side_effect=dummy_coro)
     observer_mock = mock.MagicMock()
-    obs = schema.execute(
+    subscribe(
             'subscription Sub { kernel { model { ...fragmentName } } }\n'
             'fragment fragmentName on NengoNetwork { label }',
-            context=context_mock, allow_subscriptions=True)
-    obs.subscribe(observer_mock)
+            context_mock, observer_mock)
     await complete_other_tasks()
 
     context_mock.reloadable.call.assert_called_once()
     method, query = context_mock.reloadable.call.call_args[0]
     assert method is context_mock.kernel.query
     assert re.sub(r'\s+', '', query) == re.sub(r'\s+', '', '''
-        query Sub { model { ...fragmentName } }
-        fragment fragmentName on NengoNetwork { label }
+        query Sub { model { id ...fragmentName } }
+        fragment fragmentName on NengoNetwork { id label }
     ''')
 
 
 async def test_supports_variables():
     context_mock = mock.MagicMock()
-    context_mock.reloadable = rx.subjects.Subject()
-    context_mock.reloadable.call = mock.MagicMock()
-    context_mock.reloadable.call.return_value = dummy_coro()
+    context_mock.reloadable = ReloadableStub()
+    context_mock.reloadable.call = mock.MagicMock(side_effect=dummy_coro)
     observer_mock = mock.MagicMock()
-    obs = schema.execute(
+    subscribe(
             '''subscription Sub($id: ID!) { kernel {
                 node(id: $id) { ... on NengoEnsemble { label } } } }
             ''',
-            context=context_mock, variables={'id': 'ID42'},
-            allow_subscriptions=True)
-    obs.subscribe(observer_mock)
+            context_mock, observer_mock, variables={'id': 'ID42'})
     await complete_other_tasks()
 
     context_mock.reloadable.call.assert_called_once()
@@ -88,6 +231,81 @@ async def test_supports_variables():
     variables = context_mock.reloadable.call.call_args[1]['variables']
     assert method is context_mock.kernel.query
     assert re.sub(r'\s+', '', query) == re.sub(r'\s+', '', '''
-        query Sub($id: ID!) { node(id: $id) { ... on NengoEnsemble { label } } }
+        query Sub($id: ID!) {
+            node(id: $id) { id ... on NengoEnsemble { id label } } }
     ''')
     assert variables == {'id': 'ID42'}
+
+
+async def test_can_subscribe_to_kernel_health():
+    health_updates = Broadcast()
+    context_mock = mock.MagicMock()
+    context_mock.supervisor.listen = lambda: health_updates.listen(
+            initial=Health(Health.RUNNING))
+    observer_mock = mock.MagicMock()
+    subscribe(
+            'subscription Sub { kernelHealth { status restarts } }',
+            context_mock, observer_mock)
+    await complete_other_tasks()
+    assert_gql_data_equals(observer_mock.on_next.call_args[0][0], {
+        'kernelHealth': {'status': 'running', 'restarts': 0}
+    })
+
+    health_updates.publish(Health(Health.RESTARTING, 1, 'crash'))
+    await complete_other_tasks()
+    assert_gql_data_equals(observer_mock.on_next.call_args[0][0], {
+        'kernelHealth': {'status': 'restarting', 'restarts': 1}
+    })
+
+
+async def test_can_query_kernel():
+    context_mock = mock.MagicMock()
+    context_mock.reloadable.call = mock.MagicMock(side_effect=dummy_coro)
+    result = await schema.execute(
+            '{ kernel { model { label } } }', context=context_mock,
+            executor=AsyncioExecutor(asyncio.get_running_loop()),
+            return_promise=True)
+    assert_gql_data_equals(result, {'kernel': {'model': {'label': 'foo'}}})
+    method, query = context_mock.reloadable.call.call_args[0]
+    assert method is context_mock.kernel.query
+    assert re.sub(r'\s+', '', query) == 'query{model{label}}'
+
+
+async def test_can_query_kernel_without_admission_control():
+    reloadable = mock.MagicMock()
+    reloadable.call = mock.MagicMock(side_effect=dummy_coro)
+    context = Context(reloadable, mock.MagicMock())
+    result = await schema.execute(
+            '{ kernel { model { label } } }', context=context,
+            executor=AsyncioExecutor(asyncio.get_running_loop()),
+            return_promise=True)
+    assert not result.errors
+    assert_gql_data_equals(result, {'kernel': {'model': {'label': 'foo'}}})
+
+
+async def test_pages_through_connections():
+    async def kernel_query(*args, **kwargs):
+        return '''{ "model": { "ensemblesConnection": [
+            {"label": "a"}, {"label": "b"}, {"label": "c"}] } }'''
+
+    context_mock = mock.MagicMock()
+    context_mock.reloadable.call = mock.MagicMock(side_effect=kernel_query)
+    result = await schema.execute(
+            '''query Q($first: Int, $after: String) { kernel { model {
+                ensemblesConnection(first: $first, after: $after) {
+                    edges { node { label } }
+                    pageInfo { hasNextPage }
+                } } } }''',
+            variables={'first': 1, 'after': 'YXJyYXljb25uZWN0aW9uOjA='},
+            context=context_mock,
+            executor=AsyncioExecutor(asyncio.get_running_loop()),
+            return_promise=True)
+    assert_gql_data_equals(result, {'kernel': {'model': {
+        'ensemblesConnection': {
+            'edges': [{'node': {'label': 'b'}}],
+            'pageInfo': {'hasNextPage': True},
+        }}}})
+    method, query = context_mock.reloadable.call.call_args[0]
+    assert re.sub(r'\s+', '', query) == re.sub(r'\s+', '', '''
+        query Q { model { ensemblesConnection: ensembles { label } } }
+    ''')
@@ -0,0 +1,62 @@
+from graphene import (
+        Field, ID, List, NonNull, ObjectType, relay, Schema, String)
+
+from nengonized_server.changes import diff_snapshots
+from nengonized_server.gql.snapshot import build_snapshot_query
+
+
+class Leaf(ObjectType, interfaces=[relay.Node]):
+    some_label = String()
+
+
+class Tree(ObjectType, interfaces=[relay.Node]):
+    label = String()
+    leaves = NonNull(List(NonNull(Leaf)))
+    subtrees = List(lambda: Tree)
+
+
+class Root(ObjectType):
+    tree = Field(Tree)
+    node = relay.Node.Field()
+
+
+def test_builds_snapshot_query_with_limited_depth():
+    query = build_snapshot_query(Root, max_depth=2)
+    assert query == (
+        'query Snapshot { tree { id label leaves { id someLabel } '
+        'subtrees { id label leaves { snapshotTruncated: __typename } '
+        'subtrees { snapshotTruncated: __typename } } } }')
+
+
+def test_marks_fields_with_required_arguments_as_truncated():
+    class LookupRoot(ObjectType):
+        leaf = Field(Leaf, id=ID(required=True))
+        label = String(prefix=String())
+
+    assert build_snapshot_query(LookupRoot) == (
+        'query Snapshot { label snapshotTruncated: __typename }')
+
+
+def nested_tree(depth, label):
+    tree = {'id': str(depth), 'label': label, 'leaves': [], 'subtrees': []}
+    for i in reversed(range(depth)):
+        tree = {'id': str(i), 'label': 'tree', 'leaves': [], 'subtrees': [tree]}
+    return tree
+
+
+def take_snapshot(tree, max_depth):
+    schema = Schema(query=Root)
+    result = schema.execute(
+            build_snapshot_query(Root, max_depth), root=Root(tree=tree))
+    assert not result.errors
+    return result.data
+
+
+def test_changes_below_max_depth_are_unknown():
+    old = take_snapshot(nested_tree(3, 'old'), max_depth=5)
+    new = take_snapshot(nested_tree(3, 'new'), max_depth=5)
+    assert diff_snapshots(old, new)
+
+    old = take_snapshot(nested_tree(7, 'old'), max_depth=5)
+    new = take_snapshot(nested_tree(7, 'new'), max_depth=5)
+    assert diff_snapshots(old, new) is None
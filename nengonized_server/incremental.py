@@ -0,0 +1,32 @@
+def split_lists(data, initial_count, path=()):
+    """Truncates all lists in `data` to their first `initial_count` items.
+
+    Returns the truncated data and a list of the cut off items as tuples
+    ``(path, items)`` where `path` is the path of the first item.
+    """
+    deferred = []
+    return _split(data, initial_count, list(path), deferred), deferred
+
+
+def _split(data, initial_count, path, deferred):
+    if isinstance(data, dict):
+        return {
+            k: _split(v, initial_count, path + [k], deferred)
+            for k, v in data.items()}
+    elif isinstance(data, list):
+        head = [
+            _split(x, initial_count, path + [i], deferred)
+            for i, x in enumerate(data[:initial_count])]
+        if len(data) > initial_count:
+            deferred.append((path + [initial_count], data[initial_count:]))
+        return head
+    else:
+        return data
+
+
+def chunk_deferred(deferred, chunk_size):
+    """Splits deferred items from `split_lists` into chunks."""
+    for path, items in deferred:
+        start = path[-1]
+        for i in range(0, len(items), chunk_size):
+            yield path[:-1] + [start + i], items[i:i + chunk_size]
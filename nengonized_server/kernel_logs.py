@@ -0,0 +1,113 @@
+import asyncio
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+from .streams import Broadcast
+
+
+LogEntry = namedtuple('LogEntry', ['time', 'stream', 'level', 'line'])
+
+
+def entry_to_dict(entry):
+    return {
+        'time': entry.time,
+        'stream': entry.stream,
+        'level': logging.getLevelName(entry.level),
+        'line': entry.line.decode(errors='replace'),
+    }
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._tokens = burst
+        self._last = clock()
+
+    def take(self):
+        now = self.clock()
+        self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class KernelLog(object):
+    """Bounded, rate-limited pipeline for the output of a kernel process.
+
+    Lines are retained in a ring buffer of `retain` entries and collected
+    into batches that are flushed every `flush_interval` seconds. Flushed
+    batches are decoded and written to `logger` in a background thread and
+    published to listeners. Lines exceeding `rate` lines per second per
+    stream or `max_pending` unflushed lines are dropped and counted.
+    """
+
+    _executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='kernel-log')
+
+    def __init__(
+            self, logger, retain=1000, flush_interval=0.1, rate=100.,
+            burst=1000, max_pending=1000):
+        self.logger = logger
+        self.recent = deque(maxlen=retain)
+        self.flush_interval = flush_interval
+        self.rate = rate
+        self.burst = burst
+        self.max_pending = max_pending
+        self.dropped = {}
+        self._buckets = {}
+        self._pending = []
+        self._dropped_since_flush = {}
+        self._flush_handle = None
+        self._batches = Broadcast(
+                merge=lambda earlier, later: (earlier + later)[-retain:])
+
+    def listen(self):
+        """Returns a `LatestValue` channel of flushed batches of entries.
+
+        Batches not consumed yet are concatenated with newer ones, keeping
+        the last `retain` entries.
+        """
+        return self._batches.listen()
+
+    def append(self, stream, level, line):
+        bucket = self._buckets.get(stream)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[stream] = bucket
+        if len(self._pending) >= self.max_pending or not bucket.take():
+            self.dropped[stream] = self.dropped.get(stream, 0) + 1
+            self._dropped_since_flush[stream] = (
+                    self._dropped_since_flush.get(stream, 0) + 1)
+        else:
+            entry = LogEntry(time.time(), stream, level, line)
+            self.recent.append(entry)
+            self._pending.append(entry)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                    self.flush_interval, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        dropped, self._dropped_since_flush = self._dropped_since_flush, {}
+        if len(batch) > 0:
+            self._batches.publish(batch)
+        return asyncio.get_running_loop().run_in_executor(
+                self._executor, self._emit, batch, dropped)
+
+    def _emit(self, batch, dropped):
+        for entry in batch:
+            self.logger.getChild(entry.stream).log(
+                    entry.level, '%s', entry.line.decode(errors='replace'))
+        for stream, n in dropped.items():
+            self.logger.getChild(stream).warning(
+                    "Dropped %d lines of kernel output.", n)
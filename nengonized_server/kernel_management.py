@@ -1,80 +1,363 @@
 import asyncio
+from collections import namedtuple
+import itertools
 import logging
 import json
+import os
+import resource
+import shutil
+import socket
 from subprocess import PIPE
 import sys
+import tempfile
 
-import rx
 import websockets
 
+from .changes import diff_snapshots, merge_changes
+from . import framing
+from .gate import RwGate
+from .kernel_logs import KernelLog
+from .scheduling import query_key
+from .shared_buffers import SharedBufferArea
+from .streams import Broadcast, DEFAULT_CHUNK_SIZE, in_chunks
+
 
 logger = logging.getLogger(__name__)
 
 
+class KernelStartupError(Exception):
+    pass
+
+
+class ResourceLimits(object):
+    """Resource limits applied to a kernel process.
+
+    `memory` limits the address space in bytes. `cpu_time` is a budget of
+    CPU seconds for the whole lifetime of the process (``RLIMIT_CPU``), not
+    a share of the CPU: a kernel exhausting it receives ``SIGXCPU`` and is
+    killed. Limits of ``None`` are not applied.
+    """
+
+    def __init__(self, memory=None, cpu_time=None):
+        self.memory = memory
+        self.cpu_time = cpu_time
+
+    def apply(self, pid):
+        """Applies the limits to the running process `pid`."""
+        if self.memory is not None:
+            resource.prlimit(
+                    pid, resource.RLIMIT_AS, (self.memory, self.memory))
+        if self.cpu_time is not None:
+            resource.prlimit(
+                    pid, resource.RLIMIT_CPU, (self.cpu_time, self.cpu_time))
+
+
+# Limits of the kernels started by the server and by worker agents. No
+# CPU time budget is set as kernels run for as long as the server.
+KERNEL_LIMITS = ResourceLimits(memory=4 * 1024**3)
+
+
 class Kernel(object):
-    def __init__(self, *args):
+    """Kernel subprocess.
+
+    With `local_link` set to ``'socketpair'`` or ``'unix'``, the kernel is
+    offered a local link for GraphQL queries instead of a TCP websocket:
+    either an inherited socket given by the file descriptor in
+    ``NENGONIZED_KERNEL_FD`` or a Unix domain socket path to listen on in
+    ``NENGONIZED_KERNEL_SOCKET``. A kernel accepting the link announces it
+    in its configuration with ``"framed": "fd"`` or ``"unix": path``.
+
+    With `shared_buffer_size` set, a `SharedBufferArea` of that size is
+    kept for the lifetime of this object (across restarts) and its path is
+    passed to the kernel in ``NENGONIZED_KERNEL_SHM``.
+
+    With a `model_cache`, the kernel is given the cache entry directory for
+    the model file (the first argument) in ``NENGONIZED_MODEL_CACHE``.
+    ``NENGONIZED_MODEL_CACHE_HIT`` is ``1`` if the entry holds a built model
+    to restore and ``0`` if the kernel should build into it. A kernel that
+    built and saved the model into the entry confirms it with
+    ``"modelCached": true`` in its configuration; only then is the entry
+    committed. The files the model depends on can be listed in
+    ``"dependencies"`` of the kernel configuration to invalidate the entry
+    when they change.
+
+    `tasks` holds the running tasks watching the kernel process and piping
+    its output to the `log`.
+    """
+
+    def __init__(
+            self, *args, terminate_timeout=1., limits=None, local_link=None,
+            shared_buffer_size=None, model_cache=None):
+        assert local_link in (None, 'socketpair', 'unix')
         self.logger = logger.getChild(f'Kernel({id(self)})')
         self.args = args
+        self.terminate_timeout = terminate_timeout
+        self.limits = limits
+        self.local_link = local_link
+        self.model_cache = model_cache
+        self.link_socket = None
+        self._link_dir = None
+        self.shared_buffers = None
+        if shared_buffer_size is not None:
+            self.shared_buffers = SharedBufferArea(shared_buffer_size)
+        self.log = KernelLog(self.logger)
+        self.crash_callback = None
         self.proc = None
         self.conf = None
+        self.tasks = set()
+        self._terminating = False
 
-    async def __aenter__(self):
-        self.proc = await asyncio.create_subprocess_exec(
-                sys.executable, '-m', 'nengonized_kernel', *self.args,
-                stdout=PIPE, stderr=PIPE)
-        self.logger.info("Started kernel with arguments %s.", self.args)
-
-        asyncio.get_running_loop().create_task(
-                self._pipe(self.proc.stderr, 'stderr', logging.ERROR))
+    def _start_task(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
 
-        self.conf = await self._read_json_conf(self.proc.stdout)
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        kwargs = {}
+        env = {}
+        kernel_socket = None
+        if self.local_link == 'socketpair':
+            self.link_socket, kernel_socket = socket.socketpair()
+            kwargs['pass_fds'] = (kernel_socket.fileno(),)
+            env['NENGONIZED_KERNEL_FD'] = str(kernel_socket.fileno())
+        elif self.local_link == 'unix':
+            self._link_dir = tempfile.mkdtemp()
+            env['NENGONIZED_KERNEL_SOCKET'] = os.path.join(
+                    self._link_dir, 'kernel.sock')
+        if self.shared_buffers is not None:
+            env['NENGONIZED_KERNEL_SHM'] = self.shared_buffers.path
+        cache_entry = None
+        if self.model_cache is not None:
+            cache_entry, hit = await loop.run_in_executor(
+                    None, self.model_cache.prepare, self.args[0])
+            env['NENGONIZED_MODEL_CACHE'] = cache_entry
+            env['NENGONIZED_MODEL_CACHE_HIT'] = '1' if hit else '0'
+        if env:
+            kwargs['env'] = dict(os.environ, **env)
+        self._terminating = False
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                    sys.executable, '-m', 'nengonized_kernel', *self.args,
+                    stdout=PIPE, stderr=PIPE, **kwargs)
+            if self.limits is not None:
+                try:
+                    self.limits.apply(self.proc.pid)
+                except BaseException:
+                    self.proc.kill()
+                    raise
+            if kernel_socket is not None:
+                kernel_socket.close()
+            self.logger.info("Started kernel with arguments %s.", self.args)
+            self._start_task(self._watch_exit(self.proc))
+            self._start_task(
+                    self._pipe(self.proc.stderr, 'stderr', logging.ERROR))
+
+            self.conf = await self._read_json_conf(self.proc.stdout)
+        except BaseException:
+            self._remove_link_dir()
+            raise
         self.logger.info("Received kernel configuration %s.", self.conf)
-        asyncio.get_running_loop().create_task(
-                self._pipe(self.proc.stdout, 'stdout', logging.INFO))
+        if cache_entry is not None and not hit and self.conf.get(
+                'modelCached', False):
+            await loop.run_in_executor(
+                    None, self.model_cache.commit, cache_entry,
+                    self.conf.get('dependencies', ()))
+        self._start_task(self._pipe(self.proc.stdout, 'stdout', logging.INFO))
 
         return self
 
+    async def has_cached_model(self):
+        """Returns whether the model cache holds a build of the model file."""
+        if self.model_cache is None:
+            return False
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                    None, self.model_cache.has_entry, self.args[0])
+        except OSError:
+            return False
+
     async def _read_json_conf(self, stream):
         lines = []
         while len(lines) == 0 or lines[-1] != b'\n':
-            lines.append(await stream.readline())
+            line = await stream.readline()
+            if not line:
+                raise KernelStartupError(
+                        "Kernel exited before sending its configuration.")
+            lines.append(line)
         return json.loads(b''.join(lines))
 
+    def _remove_link_dir(self):
+        if self._link_dir is not None:
+            shutil.rmtree(self._link_dir, ignore_errors=True)
+            self._link_dir = None
+
     async def _pipe(self, src, name, lvl):
-        logger = self.logger.getChild(name)
         async for line in src:
-            logger.log(lvl, '%s', line.decode())
+            self.log.append(name, lvl, line)
+
+    async def _watch_exit(self, proc):
+        returncode = await proc.wait()
+        if self._terminating or proc is not self.proc:
+            return
+        self.logger.error("Kernel exited unexpectedly (%s).", returncode)
+        if self.crash_callback is not None:
+            self.crash_callback(returncode)
 
     async def __aexit__(self, exc_type, exc, tb):
         self.logger.info("Terminating kernel.")
+        self._terminating = True
+        if self.link_socket is not None:
+            self.link_socket.close()
+            self.link_socket = None
+        self._remove_link_dir()
+        if self.proc.returncode is not None:
+            return
         self.proc.terminate()
         try:
-            await asyncio.wait_for(self.proc.wait(), timeout=1)
+            await asyncio.wait_for(
+                    self.proc.wait(), timeout=self.terminate_timeout)
         except asyncio.TimeoutError:
             self.logger.warning("Kernel did not terminate in time, killing.")
             self.proc.kill()
+            await self.proc.wait()
+
+
+class InPlaceReloadError(Exception):
+    pass
+
+
+class ActiveQueries(object):
+    """Reference counted set of the kernel queries of active subscriptions."""
+
+    def __init__(self):
+        self._queries = {}
+
+    def __len__(self):
+        return len(self._queries)
+
+    def __iter__(self):
+        """Yields the active queries as ``(query_text, variables)``."""
+        for query_text, variables, _ in list(self._queries.values()):
+            yield query_text, variables
+
+    def add(self, query_text, variables=None):
+        key = query_key(query_text, variables)
+        _, _, count = self._queries.get(key, (None, None, 0))
+        self._queries[key] = (query_text, variables, count + 1)
+
+    def discard(self, query_text, variables=None):
+        key = query_key(query_text, variables)
+        if key not in self._queries:
+            return
+        _, _, count = self._queries[key]
+        if count > 1:
+            self._queries[key] = (query_text, variables, count - 1)
+        else:
+            del self._queries[key]
+
+
+def _retrieve_exception(future):
+    if not future.cancelled():
+        future.exception()
 
 
 class ConnectedKernel(object):
-    def __init__(self, kernel):
+    """Kernel with a GraphQL connection to it.
+
+    With `active_queries`, these are queued to a newly started kernel right
+    after the snapshot query, before any client asks for them. Their
+    responses are kept for `prefetch_ttl` seconds and answer the first
+    identical query instead of a new round trip.
+    """
+
+    reload_mutation = 'mutation Reload { reload }'
+
+    def __init__(
+            self, kernel, snapshot_query=None, active_queries=None,
+            prefetch_ttl=5.):
         self.kernel = kernel
+        self.kernel.crash_callback = self._on_crash
+        self.crash_callback = None
+        self.snapshot_query = snapshot_query
+        self.snapshot = None
+        self.active_queries = active_queries
+        self.prefetch_ttl = prefetch_ttl
         self.gql_connection = None
         self.gql_socket = None
         self.gql_connection_lock = asyncio.Lock()
+        self._pending_queries = {}
+        self._prefetched = {}
+        self._prefetch_tasks = set()
+        self._prefetch_expiry = None
 
     async def __aenter__(self):
         await self.kernel.__aenter__()
-        self.gql_connection = websockets.connect(
-            self._get_connection_string(
-                self.kernel.conf['graphql'][0]))
+        self.gql_connection = self._connect(self.kernel.conf)
         self.gql_socket = await self.gql_connection.__aenter__()
+        snapshot = None
+        if self.snapshot_query is not None:
+            snapshot = self._start_prefetch(self.snapshot_query, None)
+        self._prefetch(list(self.active_queries or ()))
+        if snapshot is not None:
+            self.snapshot = json.loads(await snapshot)
         return self
 
+    def _start_prefetch(self, query_text, variables):
+        task = asyncio.ensure_future(self._send_query(query_text, variables))
+        self._prefetch_tasks.add(task)
+        task.add_done_callback(self._prefetch_tasks.discard)
+        task.add_done_callback(_retrieve_exception)
+        return task
+
+    def _prefetch(self, queries):
+        """Queues `queries` and keeps their responses until they expire.
+
+        Each query takes the connection lock for its own round trip, so
+        that responses never have to be matched to queries by position.
+        """
+        if not queries:
+            return
+        for query_text, variables in queries:
+            self._prefetched[query_key(query_text, variables)] = (
+                    self._start_prefetch(query_text, variables))
+        self._prefetch_expiry = asyncio.get_running_loop().call_later(
+                self.prefetch_ttl, self._clear_prefetched)
+
+    def _clear_prefetched(self):
+        self._prefetched.clear()
+        if self._prefetch_expiry is not None:
+            self._prefetch_expiry.cancel()
+            self._prefetch_expiry = None
+
+    def _take_prefetched(self, key):
+        response = self._prefetched.pop(key, None)
+        if response is None or (response.done() and (
+                response.cancelled() or response.exception())):
+            return None
+        return response
+
     async def __aexit__(self, exc_type, exc, tb):
+        self._clear_prefetched()
+        for task in list(self._prefetch_tasks):
+            task.cancel()
         async with self.gql_connection_lock:
             await self.gql_connection.__aexit__(exc_type, exc, tb)
         await self.kernel.__aexit__(exc_type, exc, tb)
 
+    def _connect(self, conf):
+        if conf.get('framed') == 'fd':
+            sock, self.kernel.link_socket = self.kernel.link_socket, None
+            return framing.FramedConnection(sock=sock)
+        elif 'unix' in conf:
+            return framing.FramedConnection(path=conf['unix'])
+        elif 'proxy' in conf:
+            return websockets.connect(
+                    conf['proxy'], additional_headers=self.kernel.link_headers)
+        else:
+            return websockets.connect(
+                self._get_connection_string(conf['graphql'][0]))
+
     @classmethod
     def _get_connection_string(cls, addr):
         is_ipv6 = len(addr) > 2
@@ -84,81 +367,208 @@ class ConnectedKernel(object):
             return f'ws://{addr[0]}:{addr[1]}'
 
     async def query(self, query_text, variables=None):
+        """Sends a query to the kernel and returns the raw response.
+
+        Identical concurrent queries share a single kernel round trip.
+        """
+        key = query_key(query_text, variables)
+        pending = self._pending_queries.get(key)
+        if pending is None:
+            pending = self._take_prefetched(key)
+            if pending is None:
+                pending = asyncio.ensure_future(
+                        self._send_query(query_text, variables))
+            self._pending_queries[key] = pending
+            pending.add_done_callback(
+                    lambda _, key=key: self._pending_queries.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _send_query(self, query_text, variables):
         async with self.gql_connection_lock:
-            await self.gql_socket.send(json.dumps({
-                'query': query_text, 'variables': variables}))
-            return await self.gql_socket.recv()
+            try:
+                await self.gql_socket.send(json.dumps({
+                    'query': query_text, 'variables': variables}))
+                return await self.gql_socket.recv()
+            except (
+                    websockets.exceptions.ConnectionClosed,
+                    framing.ConnectionClosed) as err:
+                self._on_crash(err)
+                raise
+
+    def _on_crash(self, reason):
+        if self.crash_callback is not None:
+            self.crash_callback(reason)
+
+    async def reload_in_place(self):
+        """Asks the running kernel to re-execute the model file.
+
+        Returns the `ChangeSet` between the model before and after the reload,
+        or ``None`` if a snapshot was truncated and the changes are unknown.
+        Raises `InPlaceReloadError` if the kernel cannot reload in place, and
+        if the model cache holds a build of the model file, which restarting
+        the kernel restores faster than rebuilding it in place.
+        """
+        if self.snapshot_query is None:
+            raise InPlaceReloadError("No snapshot query to diff models with.")
+        if await self.kernel.has_cached_model():
+            raise InPlaceReloadError("Restoring the cached model instead.")
+        self._clear_prefetched()
+        try:
+            result = json.loads(await self.query(self.reload_mutation))
+            if not isinstance(result, dict) or not result.get('reload'):
+                raise InPlaceReloadError(f"Kernel rejected reload: {result}")
+            snapshot = await self._take_snapshot()
+        except (
+                websockets.exceptions.WebSocketException,
+                framing.ConnectionClosed, ValueError) as err:
+            raise InPlaceReloadError(str(err)) from err
+
+        old_snapshot, self.snapshot = self.snapshot, snapshot
+        return diff_snapshots(old_snapshot, self.snapshot)
 
+    async def _take_snapshot(self):
+        return json.loads(await self.query(self.snapshot_query))
 
-class Reloadable(rx.core.ObservableBase):
-    def __init__(self, wrapped):
-        super().__init__()
+
+class Reloadable(object):
+    """Wraps a reloadable object and gates calls to it during reloads.
+
+    `generation` counts the reloads that (possibly) changed the object.
+    """
+
+    def __init__(self, wrapped, in_place=False):
+        self.logger = logger.getChild(self.__class__.__name__)
         self.wrapped = wrapped
-        self._n_calls_ongoing = 0
-        self._cond_lock = asyncio.Condition()
-        self._observers = []
+        self.in_place = in_place
+        self.generation = 0
+        self.gate = RwGate()
+        self._reloads = Broadcast(merge=merge_changes)
 
     async def __aenter__(self):
-        await self.wrapped.__aenter__()
+        await self.gate.acquire_write()
+        try:
+            await self.wrapped.__aenter__()
+        finally:
+            self.gate.release_write()
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
-        for observer in self._observers:
-            if exc:
-                observer.on_error(exc)
-            else:
-                observer.on_completed()
+        self._reloads.close(exc)
         return await self.wrapped.__aexit__(exc_type, exc, tb)
 
-    async def reload(self):
-        async with self._cond_lock:
-            await self._cond_lock.wait_for(lambda: self._n_calls_ongoing == 0)
-            await self.wrapped.__aexit__(None, None, None)
-            await self.wrapped.__aenter__()
-            self._notify_observers()
+    def listen(self, *args, **kwargs):
+        """Returns a `LatestValue` channel of reload change sets.
+
+        Change sets not consumed yet are merged with newer ones. An
+        `initial` value can be given to be received first.
+        """
+        return self._reloads.listen(*args, **kwargs)
+
+    async def reload(self, restart=False, on_reloaded=None):
+        """Reloads the wrapped object and notifies observers.
+
+        Observers receive the `ChangeSet` of the reload, or ``None`` if the
+        wrapped object had to be restarted or could not tell what changed.
+        They are notified in chunks after the gate opened again, so that
+        their calls do not all wake at once when it opens. Set `restart` to
+        skip an in-place reload.
+
+        `on_reloaded` is called with the change set of a successful reload
+        while the gate is still closed, before any call reaches the
+        reloaded object.
+        """
+        await self.gate.acquire_write()
+        try:
+            changes = None
+            restart = restart or not self.in_place
+            if not restart:
+                try:
+                    changes = await self.wrapped.reload_in_place()
+                except InPlaceReloadError as err:
+                    self.logger.warning(
+                        "In-place reload failed, restarting: %s", err)
+                    restart = True
+            if restart:
+                await self.wrapped.__aexit__(None, None, None)
+                await self.wrapped.__aenter__()
+            if changes is None or changes:
+                self.generation += 1
+            if on_reloaded is not None:
+                on_reloaded(changes)
+        finally:
+            self.gate.release_write()
+        await self._notify_observers(changes)
+        return changes
+
+    async def drain(self, timeout=None):
+        """Stops new calls and waits for ongoing calls to finish.
+
+        Meant for shutting down: once drained, the gate stays closed and
+        new calls wait forever. Returns whether all calls finished within
+        `timeout` seconds; otherwise, the gate is opened again.
+        """
+        try:
+            await asyncio.wait_for(self.gate.acquire_write(), timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(
+                    "%d calls still ongoing after %s seconds.",
+                    self.gate.n_readers, timeout)
+            return False
+        return True
 
     async def call(self, method, *args, **kwargs):
-        async with self._cond_lock:
-            self._n_calls_ongoing += 1
+        await self.gate.acquire_read()
         try:
             result = method(*args, **kwargs)
             if asyncio.iscoroutine(result) or asyncio.isfuture(result):
                 result = await result
             return result
         finally:
-            async with self._cond_lock:
-                self._n_calls_ongoing -= 1
+            self.gate.release_read()
+
+    async def _notify_observers(self, changes=None):
+        await self._reloads.publish_in_chunks(changes)
 
-    def _notify_observers(self):
-        for observer in self._observers:
-            observer.on_next(self)
 
-    def _subscribe_core(self, observer, scheduler=None):
-        self._observers.append(observer)
-        def dispose(observer=observer):
-            self._observers.remove(observer)
-        return dispose
+_Subscription = namedtuple(
+        '_Subscription', ['id', 'observer', 'method', 'args', 'kwargs'])
 
 
 class Subscribable(Reloadable):
-    def __init__(self, wrapped):
-        super().__init__(wrapped)
-        self._subscriptions = []
+    """Reloadable passing method results to observers after each reload.
+
+    Subscriptions are indexed by id. After a reload, subscriptions are
+    updated in chunks of `chunk_size`, yielding to the event loop in
+    between.
+    """
+
+    def __init__(self, wrapped, in_place=False, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__(wrapped, in_place=in_place)
+        self.chunk_size = chunk_size
+        self._subscriptions = {}
+        self._subscription_ids = itertools.count()
 
     async def subscribe(self, observer, method, *args, **kwargs):
-        subscription = (observer, method, args, kwargs)
-        self._subscriptions.append(subscription)
+        subscription = _Subscription(
+                next(self._subscription_ids), observer, method, args, kwargs)
+        self._subscriptions[subscription.id] = subscription
         await self._update_subscriber(subscription)
         return subscription
 
     def unsubscribe(self, subscription):
-        self._subscriptions.remove(subscription)
-
-    async def reload(self):
-        await super().reload()
-        await asyncio.gather(
-                *(self._update_subscriber(s) for s in self._subscriptions))
+        del self._subscriptions[subscription.id]
+
+    async def reload(self, restart=False, on_reloaded=None):
+        changes = await super().reload(
+                restart=restart, on_reloaded=on_reloaded)
+        if changes is None or changes:
+            async for chunk in in_chunks(
+                    self._subscriptions.values(), self.chunk_size):
+                await asyncio.gather(*(
+                    self._update_subscriber(s)
+                    for s in chunk if s.id in self._subscriptions))
+        return changes
 
     async def _update_subscriber(self, subscription):
-        observer, method, args, kwargs = subscription
-        observer.on_next(await self.call(method, *args, **kwargs))
+        subscription.observer.on_next(await self.call(
+            subscription.method, *subscription.args, **subscription.kwargs))
@@ -0,0 +1,219 @@
+"""Memory accounting for connections and subscriptions."""
+
+import asyncio
+import collections
+import gc
+import logging
+import os
+import tracemalloc
+
+from tornado.web import HTTPError, RequestHandler
+
+from .gql import stitching
+
+
+logger = logging.getLogger(__name__)
+
+
+def process_memory():
+    """Returns the resident set size of the process in bytes or ``None``."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def object_counts(limit=20):
+    """Returns the `limit` most frequent types of garbage collected objects."""
+    counts = collections.Counter(
+            type(obj).__qualname__ for obj in gc.get_objects())
+    return dict(counts.most_common(limit))
+
+
+def connection_bytes(usage):
+    """Returns the bytes held by a connection for its unsent messages."""
+    return usage['outboundBytes']
+
+
+class AllocationTracer(object):
+    """Reports allocation growth between `tracemalloc` snapshots.
+
+    Tracing starts with the first call to `diff`, which only takes the
+    initial snapshot. Each further call compares a new snapshot to the
+    previous one. Since tracing slows down all allocations, tracing
+    started here is stopped when `diff` was not called for `timeout`
+    seconds.
+    """
+
+    def __init__(self, n_frames=1, timeout=300.):
+        self.n_frames = n_frames
+        self.timeout = timeout
+        self._snapshot = None
+        self._timeout_handle = None
+        self._started = False
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+
+    def diff(self, limit=20):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.n_frames)
+            self._started = True
+            self._snapshot = None
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+        self._timeout_handle = asyncio.get_running_loop().call_later(
+                self.timeout, self.stop)
+        snapshot = self._take_snapshot()
+        previous, self._snapshot = self._snapshot, snapshot
+        if previous is None:
+            return []
+        return [{
+            'location': str(stat.traceback),
+            'size': stat.size,
+            'sizeDiff': stat.size_diff,
+            'count': stat.count,
+            'countDiff': stat.count_diff,
+        } for stat in snapshot.compare_to(previous, 'lineno')[:limit]]
+
+    def stop(self):
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+        self._snapshot = None
+
+
+class MemorySampler(object):
+    """Samples the memory attributed to connections and enforces budgets.
+
+    Every `interval` seconds, the `memory_usage` of each connection in
+    `connections` is sampled. Connections holding more than
+    `connection_budget` bytes in unsent messages are closed. While the
+    process exceeds `process_budget` bytes, the largest connection is
+    closed on each sample if it holds at least `min_overage_share` of the
+    excess bytes; otherwise, closing it would not bring the process back
+    within budget. Budgets of ``None`` are not enforced.
+
+    Allocation tracing and object counts are expensive and only reported
+    with `diagnostics` enabled. The metrics of a `scheduler` and a `gate`
+    are included in each report, if given.
+    """
+
+    def __init__(
+            self, connections=(), interval=10., connection_budget=None,
+            process_budget=None, min_overage_share=0.25, diagnostics=False,
+            scheduler=None, gate=None):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.connections = connections
+        self.interval = interval
+        self.connection_budget = connection_budget
+        self.process_budget = process_budget
+        self.min_overage_share = min_overage_share
+        self.diagnostics = diagnostics
+        self.scheduler = scheduler
+        self.gate = gate
+        self.tracer = AllocationTracer()
+        self.latest = None
+        self.n_closed = 0
+        self._task = None
+
+    def sample(self):
+        usages = [(c, c.memory_usage()) for c in list(self.connections)]
+        report = {
+            'process': {
+                'residentBytes': process_memory(),
+                'tasks': len(asyncio.all_tasks()),
+                'stitchedTypes': len(stitching._stitched),
+                'connections': len(usages),
+                'subscriptions': sum(
+                    len(u.get('subscriptions', ())) for _, u in usages),
+            },
+            'connections': [usage for _, usage in usages],
+        }
+        if self.scheduler is not None:
+            report['scheduler'] = self.scheduler.metrics()
+        if self.gate is not None:
+            report['gate'] = self.gate.metrics()
+        self._enforce_budgets(usages, report['process']['residentBytes'])
+        self.latest = report
+        return report
+
+    def _enforce_budgets(self, usages, resident_bytes):
+        if self.connection_budget is not None:
+            for connection, usage in usages:
+                if connection_bytes(usage) > self.connection_budget:
+                    self._close(connection, usage)
+        if (
+                self.process_budget is not None and
+                resident_bytes is not None and
+                resident_bytes > self.process_budget and usages):
+            overage = resident_bytes - self.process_budget
+            connection, usage = max(
+                    usages, key=lambda x: connection_bytes(x[1]))
+            if connection_bytes(usage) >= self.min_overage_share * overage:
+                self._close(connection, usage)
+
+    def _close(self, connection, usage):
+        self.logger.warning(
+                "Closing %s exceeding the memory budget (%d bytes).",
+                usage['type'], connection_bytes(usage))
+        self.n_closed += 1
+        connection.close(1009, "Memory budget exceeded.")
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self.tracer.stop()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as err:
+                self.logger.error("Sampling memory usage failed: %s", err)
+
+
+class MemoryHandler(RequestHandler):
+    """Reports a fresh memory sample.
+
+    If the sampler has `diagnostics` enabled, the ``allocations`` argument
+    includes the allocation growth since the previous request with this
+    argument, ``allocations=stop`` stops tracing allocations, and the
+    ``objects`` argument includes the most frequent object types. Without
+    `diagnostics`, these arguments are rejected.
+    """
+
+    def initialize(self, sampler):
+        self.sampler = sampler
+
+    def get(self):
+        allocations = self.get_argument('allocations', None)
+        objects = self.get_argument('objects', None)
+        if not self.sampler.diagnostics and (
+                allocations is not None or objects is not None):
+            raise HTTPError(403, "Memory diagnostics are disabled.")
+        report = self.sampler.sample()
+        if allocations == 'stop':
+            self.sampler.tracer.stop()
+        elif allocations is not None:
+            report['allocations'] = self.sampler.tracer.diff()
+        if objects is not None:
+            report['objects'] = object_counts()
+        self.write(report)
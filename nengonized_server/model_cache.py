@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import shutil
+
+from .result_store import file_hash
+
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCache(object):
+    """On-disk cache of built models keyed by the model file's content.
+
+    Each model gets an entry directory in `directory`, named after the hash
+    of the model file, in which the kernel stores the built model. The
+    entry also has a manifest with the hashes of the files the model
+    depended on when it was built. The entry is only used while these are
+    unchanged. Least recently used entries are evicted once all entries
+    together exceed `max_size` bytes.
+
+    The methods do blocking file system operations and are meant to be run
+    in an executor.
+    """
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, directory, max_size):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def prepare(self, filename):
+        """Returns the entry directory for `filename` and whether it is valid.
+
+        An invalid entry is cleared, so that the kernel can build into it.
+        """
+        entry = os.path.join(self.directory, file_hash(filename))
+        if self._is_valid(entry):
+            self._touch(entry)
+            return entry, True
+        shutil.rmtree(entry, ignore_errors=True)
+        os.makedirs(entry)
+        return entry, False
+
+    def has_entry(self, filename):
+        """Returns whether a valid entry for `filename` exists."""
+        return self._is_valid(os.path.join(self.directory, file_hash(filename)))
+
+    def _is_valid(self, entry):
+        try:
+            with open(os.path.join(entry, self.manifest_name)) as f:
+                manifest = json.load(f)
+            return all(
+                file_hash(path) == h
+                for path, h in manifest['dependencies'].items())
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def commit(self, entry, dependencies=()):
+        """Marks `entry` as built from the given dependency files.
+
+        Then evicts least recently used entries other than `entry` while
+        the cache is too large.
+        """
+        manifest = {'dependencies': {}}
+        for path in dependencies:
+            try:
+                manifest['dependencies'][path] = file_hash(path)
+            except OSError as err:
+                self.logger.warning("Not caching model: %s", err)
+                shutil.rmtree(entry, ignore_errors=True)
+                return
+        with open(os.path.join(entry, self.manifest_name), 'w') as f:
+            json.dump(manifest, f)
+        self.evict(keep=entry)
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                entries.append((self._last_use(path), path, _dir_size(path)))
+        total = sum(size for _, _, size in entries)
+        for _, path, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            self.logger.info("Evicting cached model %s.", path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def _touch(self, entry):
+        os.utime(os.path.join(entry, self.manifest_name))
+
+    def _last_use(self, entry):
+        try:
+            return os.stat(os.path.join(entry, self.manifest_name)).st_mtime
+        except OSError:
+            return 0.
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
@@ -0,0 +1,283 @@
+from array import array
+import asyncio
+from collections import namedtuple
+import json
+import logging
+import math
+import struct
+import sys
+
+from .scheduling import Priority
+from .shared_buffers import is_buffer_handle
+from .streams import Broadcast
+
+
+logger = logging.getLogger(__name__)
+
+
+ProbeSamples = namedtuple('ProbeSamples', ['step', 'dimensions', 'samples'])
+ProbeSamples.__doc__ = """Consecutive probe samples starting at `step`.
+
+`samples` is an ``array('d')`` holding the samples row by row with
+`dimensions` values each.
+"""
+
+
+def n_rows(probe_samples):
+    return len(probe_samples.samples) // probe_samples.dimensions
+
+
+def merge_samples(a, b):
+    """Merges two dicts mapping probe ids to `ProbeSamples`.
+
+    Samples of the same probe are concatenated if `b` continues `a`.
+    Otherwise, e.g. after a kernel restart, the samples in `b` replace
+    those in `a`.
+    """
+    merged = dict(a)
+    for probe, samples in b.items():
+        earlier = merged.get(probe)
+        if (
+                earlier is not None and
+                earlier.dimensions == samples.dimensions and
+                earlier.step + n_rows(earlier) == samples.step):
+            samples = ProbeSamples(
+                    earlier.step, earlier.dimensions,
+                    earlier.samples + samples.samples)
+        merged[probe] = samples
+    return merged
+
+
+class ProbeFeed(object):
+    """Polls the kernel for new probe samples and publishes them.
+
+    The kernel is only polled, every `interval` seconds, while there are
+    listeners. It is expected to return all samples after step `since`,
+    which is reset whenever the model is reloaded or the kernel restarted.
+    Samples may be returned as buffer handles into `shared_buffers`
+    instead of JSON lists to avoid encoding them as text; without
+    `shared_buffers`, such samples are logged and skipped. While polling
+    fails, the interval is doubled up to `max_backoff` seconds.
+    """
+
+    query = (
+        'query ProbeData($since: Int!) { '
+        'probeData(since: $since) { probe step dimensions samples } }')
+
+    def __init__(
+            self, reloadable, kernel, shared_buffers=None, interval=0.05,
+            max_backoff=5.):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.reloadable = reloadable
+        self.kernel = kernel
+        self.shared_buffers = shared_buffers
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.since = -1
+        self._n_resets = 0
+        self._samples = Broadcast(merge=merge_samples)
+        self._tasks = []
+
+    def listen(self):
+        """Returns a `LatestValue` channel of dicts of `ProbeSamples`.
+
+        Samples not consumed yet are concatenated with newer ones.
+        """
+        return self._samples.listen()
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [
+            loop.create_task(self._run()),
+            loop.create_task(self._reset_on_reloads(self.reloadable.listen())),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._samples.close()
+
+    async def _run(self):
+        delay = self.interval
+        while True:
+            if self._samples.n_listeners > 0:
+                try:
+                    await self.poll()
+                    delay = self.interval
+                except Exception as err:
+                    self.logger.error(
+                            "Polling probe data failed, retrying in %s "
+                            "seconds: %s", delay, err)
+                    await asyncio.sleep(delay)
+                    delay = min(2 * delay, self.max_backoff)
+                    continue
+            await asyncio.sleep(self.interval)
+
+    async def _reset_on_reloads(self, reloads):
+        try:
+            async for _ in reloads:
+                self.reset()
+        finally:
+            reloads.close()
+
+    def reset(self):
+        """Starts polling from the first step of the simulation again."""
+        self.since = -1
+        self._n_resets += 1
+
+    async def poll(self):
+        n_resets = self._n_resets
+        result = json.loads(await self.reloadable.call(
+            self.kernel.query, self.query, variables={'since': self.since},
+            priority=Priority.SUBSCRIPTION))
+        if n_resets != self._n_resets:
+            return  # polled the previous simulation
+        if not result or not result.get('probeData'):
+            return
+        batch = {}
+        for item in result['probeData']:
+            if (is_buffer_handle(item['samples']) and
+                    self.shared_buffers is None):
+                # Skipped for good, retrying would return the same handles.
+                self.logger.error(
+                        "Samples of probe %s are in a shared buffer, but no "
+                        "shared buffer area is available.", item['probe'])
+                n_values = item['samples']['__buffer__']['length'] // 8
+                self.since = max(
+                        self.since,
+                        item['step'] + n_values // item['dimensions'] - 1)
+                continue
+            values = self._to_array(item['samples'])
+            if values is None:
+                self.logger.warning(
+                        "Samples of probe %s were overwritten before they "
+                        "were read.", item['probe'])
+                continue
+            samples = ProbeSamples(item['step'], item['dimensions'], values)
+            batch = merge_samples(batch, {item['probe']: samples})
+            self.since = max(self.since, samples.step + n_rows(samples) - 1)
+        if batch:
+            self._samples.publish(batch)
+
+    def _to_array(self, samples):
+        """Returns the samples as array or ``None`` if overwritten."""
+        values = array('d')
+        if is_buffer_handle(samples):
+            data = self.shared_buffers.read(samples['__buffer__'])
+            if data is None:
+                return None
+            values.frombytes(data)
+        else:
+            values.extend(samples)
+        return values
+
+
+class Downsampler(object):
+    """Reduces a stream of probe samples to one point per `factor` samples.
+
+    In ``'decimate'`` mode, the first sample of each group of `factor`
+    samples is kept. In ``'minmax'`` mode, the minimum and maximum of each
+    dimension over the group are kept, giving two values per dimension.
+    Incomplete groups are kept back until further samples arrive.
+    """
+
+    DECIMATE = 'decimate'
+    MINMAX = 'minmax'
+
+    def __init__(self, factor, mode=DECIMATE):
+        assert mode in (self.DECIMATE, self.MINMAX)
+        self.factor = factor
+        self.mode = mode
+        self._pending = None
+
+    @classmethod
+    def for_window(cls, window, resolution, mode=DECIMATE):
+        """Downsampler showing `window` steps with `resolution` points."""
+        return cls(max(1, math.ceil(window / resolution)), mode)
+
+    def width(self, dimensions):
+        return 2 * dimensions if self.mode == self.MINMAX else dimensions
+
+    def push(self, probe_samples):
+        """Adds samples and returns the completed points as `ProbeSamples`.
+
+        Returns ``None`` if no point was completed.
+        """
+        if self._pending is not None:
+            probe_samples = merge_samples(
+                    {None: self._pending}, {None: probe_samples})[None]
+        step, d, samples = probe_samples
+        f = self.factor
+        n_points = len(samples) // (d * f)
+        end = n_points * d * f
+        self._pending = ProbeSamples(step + n_points * f, d, samples[end:])
+        if n_points == 0:
+            return None
+
+        if self.mode == self.DECIMATE:
+            points = array('d', bytes(8 * n_points * d))
+            for k in range(d):
+                points[k::d] = samples[k:end:d * f]
+        else:
+            points = array('d')
+            for start in range(0, end, d * f):
+                for k in range(d):
+                    column = samples[start + k:start + d * f:d]
+                    points.append(min(column))
+                    points.append(max(column))
+        return ProbeSamples(step, self.width(d), points)
+
+
+frame_header = struct.Struct('<qII')
+
+
+def encode_frame(subscription_id, step_size, points):
+    """Encodes downsampled points as binary websocket message.
+
+    The message starts with the UTF-8 encoded `subscription_id` prefixed
+    by its length as little-endian 16-bit integer. It follows a header of
+    the step of the first point (int64), the steps between points and the
+    number of values per point (both uint32). The remainder are the values
+    as little-endian float64.
+    """
+    encoded_id = subscription_id.encode()
+    values = points.samples
+    if sys.byteorder != 'little':
+        values = array('d', values)
+        values.byteswap()
+    return b''.join((
+        struct.pack('<H', len(encoded_id)), encoded_id,
+        frame_header.pack(points.step, step_size, points.dimensions),
+        values.tobytes()))
+
+
+class ProbeSubscription(object):
+    """Sends downsampled samples of one probe to a client."""
+
+    def __init__(self, subscription_id, feed, probe, downsampler, send):
+        self.subscription_id = subscription_id
+        self.probe = probe
+        self.downsampler = downsampler
+        self.send = send
+        self._channel = feed.listen()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        async for batch in self._channel:
+            samples = batch.get(self.probe)
+            if samples is None:
+                continue
+            points = self.downsampler.push(samples)
+            if points is not None:
+                self.send(encode_frame(
+                    self.subscription_id, self.downsampler.factor, points),
+                    binary=True)
+
+    def dispose(self):
+        self._channel.close()
+        self._task.cancel()
@@ -0,0 +1,376 @@
+"""Recording and offline replay of server traffic.
+
+A `TraceRecorder` writes websocket connections and messages, file changes
+with the resulting reloads and kernel round trips to a gzip-compressed
+trace with one JSON array ``[time, event, fields]`` per line. `replay`
+feeds a trace through a server backed by a `ReplayKernel` and measures
+latency and throughput::
+
+    python -m nengonized_server.recording TRACE [--speed S] \\
+        [--output REPORT] [--baseline REPORT]
+"""
+
+import argparse
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import itertools
+import json
+import logging
+import math
+import time
+
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.websocket import websocket_connect
+
+from .admission import (
+        AdmissionController, CLIENT_QUERY_BUDGET, QUERY_MAX_COST,
+        QUERY_MAX_DEPTH)
+from .app import make_app
+from .changes import ChangeSet
+from .kernel_management import ActiveQueries, InPlaceReloadError, Reloadable
+from .scheduling import query_key, QueryScheduler, ScheduledKernel
+from .gql.schema import Context
+
+
+logger = logging.getLogger(__name__)
+
+
+class TraceRecorder(object):
+    """Writes a trace of server traffic to `path`.
+
+    Records are encoded when recorded and collected into batches that are
+    compressed and written in a background thread every `flush_interval`
+    seconds. `flush` must be awaited before `close`.
+    """
+
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trace')
+
+    def __init__(self, path, clock=time.monotonic, flush_interval=0.5):
+        self.clock = clock
+        self.start = clock()
+        self.flush_interval = flush_interval
+        self._file = gzip.open(path, 'wt')
+        self._connection_ids = itertools.count()
+        self._pending = []
+        self._flush_handle = None
+
+    def record(self, event, **fields):
+        self._pending.append(json.dumps(
+            [round(self.clock() - self.start, 6), event, fields],
+            separators=(',', ':')))
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                    self.flush_interval, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        return asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write, batch)
+
+    def _write(self, batch):
+        for line in batch:
+            self._file.write(line)
+            self._file.write('\n')
+
+    def record_reload(self, changes):
+        """Records the `ChangeSet` of a reload, ``None`` for a restart."""
+        if changes is None:
+            self.record('reload', changes=None)
+        else:
+            self.record('reload', changes={
+                'added': sorted(changes.added),
+                'removed': sorted(changes.removed),
+                'changed': sorted(changes.changed),
+            })
+
+    def open_connection(self, path):
+        """Records a new websocket connection and returns its trace id."""
+        connection_id = next(self._connection_ids)
+        self.record('open', connection=connection_id, path=path)
+        return connection_id
+
+    def close(self):
+        self._file.close()
+
+
+def read_trace(path):
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+class RecordingKernel(object):
+    """Records the round trips to a `ConnectedKernel`."""
+
+    def __init__(self, kernel, recorder):
+        self.kernel = kernel
+        self.recorder = recorder
+
+    async def query(self, query_text, variables=None):
+        start = time.monotonic()
+        response = await self.kernel.query(query_text, variables)
+        self.recorder.record(
+                'kernel', query=query_text, variables=variables,
+                response=response, duration=time.monotonic() - start)
+        return response
+
+
+class ReplayKernel(object):
+    """Stub kernel answering queries with the responses in a trace.
+
+    The responses to each query are given in the recorded order, repeating
+    the last one once exhausted, and delayed by the recorded duration
+    divided by `speed`. Queries never recorded are answered with an empty
+    result and counted in `n_missing`. In-place reloads return the
+    recorded change sets in order and fail where the server restarted
+    the kernel.
+    """
+
+    snapshot = None
+
+    def __init__(self, events, speed=1.):
+        self.speed = speed
+        self.n_missing = 0
+        self.responses = {}
+        self.reloads = collections.deque()
+        for _, event, fields in events:
+            if event == 'kernel':
+                self.responses.setdefault(
+                    query_key(fields['query'], fields['variables']),
+                    collections.deque()
+                ).append((fields['duration'], fields['response']))
+            elif event == 'reload':
+                self.reloads.append(fields['changes'])
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def reload_in_place(self):
+        changes = self.reloads.popleft() if self.reloads else None
+        if changes is None:
+            raise InPlaceReloadError("Recorded reload restarted the kernel.")
+        return ChangeSet(**changes)
+
+    async def query(self, query_text, variables=None):
+        responses = self.responses.get(query_key(query_text, variables))
+        if not responses:
+            self.n_missing += 1
+            return '{}'
+        duration, response = (
+            responses.popleft() if len(responses) > 1 else responses[0])
+        await asyncio.sleep(duration / self.speed)
+        return response
+
+
+def _expects_response(message):
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return False
+    return not (isinstance(data, dict) and data.get('action') in (
+        'unsubscribe', 'configure'))
+
+
+class _ReplayClient(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.sent = collections.deque()
+        self.latencies = []
+        self.n_received = 0
+        self.answered = asyncio.Event()
+        self.answered.set()
+        self._reader = asyncio.ensure_future(self._read())
+
+    def send(self, message):
+        if _expects_response(message):
+            self.sent.append(time.monotonic())
+            self.answered.clear()
+        self.connection.write_message(message)
+
+    async def _read(self):
+        while True:
+            message = await self.connection.read_message()
+            if message is None:
+                break
+            self.n_received += 1
+            if self.sent:
+                self.latencies.append(time.monotonic() - self.sent.popleft())
+                if not self.sent:
+                    self.answered.set()
+        self.answered.set()
+
+    async def close(self, timeout=None):
+        """Closes the connection once all responses arrived or timed out."""
+        try:
+            await asyncio.wait_for(self.answered.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.connection.close()
+        await self._reader
+
+
+class ReplayReport(object):
+    """Latency and throughput measured by a replay.
+
+    Latency is the time from sending a message that expects a response to
+    the next message received on the same connection.
+    """
+
+    def __init__(self, latencies, n_received, duration, n_missing=0):
+        self.latencies = sorted(latencies)
+        self.n_received = n_received
+        self.duration = duration
+        self.n_missing = n_missing
+
+    @property
+    def throughput(self):
+        return self.n_received / self.duration if self.duration > 0 else 0.
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        index = math.ceil(q / 100. * len(self.latencies)) - 1
+        return self.latencies[max(0, index)]
+
+    def to_dict(self):
+        return {
+            'received': self.n_received,
+            'duration': self.duration,
+            'throughput': self.throughput,
+            'missingResponses': self.n_missing,
+            'latency': {
+                'mean': (
+                    sum(self.latencies) / len(self.latencies)
+                    if self.latencies else None),
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'max': self.percentile(100),
+            },
+        }
+
+
+def _relative_change(baseline, current):
+    if not baseline or current is None:
+        return None
+    return (current - baseline) / baseline
+
+
+def compare_reports(baseline, current):
+    """Returns the relative changes from `baseline` to `current`.
+
+    Both are reports as returned by `ReplayReport.to_dict`.
+    """
+    deltas = {'throughput': _relative_change(
+        baseline['throughput'], current['throughput'])}
+    for name, value in baseline['latency'].items():
+        deltas['latency.' + name] = _relative_change(
+                value, current['latency'][name])
+    return deltas
+
+
+async def replay(events, speed=1., app_factory=make_app, settle_timeout=5.):
+    """Replays the trace `events` and returns a `ReplayReport`.
+
+    Events are replayed at their recorded times divided by `speed`, which
+    may be ``math.inf`` to replay as fast as possible. `app_factory` is
+    called with the `Context` to create the server application. The
+    context is wired like the server's, with in-place reloads, admission
+    control and active query tracking. After the last event, responses
+    are awaited for up to `settle_timeout` seconds.
+    """
+    events = list(events)
+    kernel = ReplayKernel(events, speed)
+    reloadable = Reloadable(kernel, in_place=True)
+    admission = AdmissionController(
+            max_depth=QUERY_MAX_DEPTH, max_cost=QUERY_MAX_COST,
+            client_budget=CLIENT_QUERY_BUDGET, kernel=kernel)
+    app = app_factory(Context(
+            reloadable, ScheduledKernel(kernel, QueryScheduler()),
+            admission=admission, active_queries=ActiveQueries()))
+    sockets = bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+
+    clients = {}
+    all_clients = []
+    reloads = []
+    closing = []
+    try:
+        async with reloadable:
+            start = time.monotonic()
+            for t, event, fields in events:
+                delay = start + t / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if event == 'open':
+                    client = _ReplayClient(await websocket_connect(
+                        f'ws://127.0.0.1:{port}{fields["path"]}'))
+                    clients[fields['connection']] = client
+                    all_clients.append(client)
+                elif event == 'message' and fields['connection'] in clients:
+                    clients[fields['connection']].send(fields['message'])
+                elif event == 'close' and fields['connection'] in clients:
+                    closing.append(asyncio.ensure_future(
+                        clients.pop(fields['connection']).close(
+                            settle_timeout)))
+                elif event == 'file_change':
+                    reloads.append(asyncio.ensure_future(reloadable.reload()))
+
+            try:
+                await asyncio.wait_for(asyncio.gather(
+                    *reloads, *closing,
+                    *(c.answered.wait() for c in all_clients)),
+                    settle_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                        "Responses still pending after %s seconds.",
+                        settle_timeout)
+            duration = time.monotonic() - start
+            for client in all_clients:
+                await client.close(0)
+    finally:
+        server.stop()
+
+    latencies = [
+        latency for client in all_clients for latency in client.latencies]
+    return ReplayReport(
+            latencies, sum(c.n_received for c in all_clients), duration,
+            kernel.n_missing)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Replay a recorded trace and report performance.")
+    parser.add_argument('trace')
+    parser.add_argument(
+            '--speed', type=float, default=1.,
+            help="replay speed factor, inf for as fast as possible")
+    parser.add_argument('--output', help="file to write the report to")
+    parser.add_argument('--baseline', help="report to compare with")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(
+            replay(read_trace(args.trace), speed=args.speed)).to_dict()
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            deltas = compare_reports(json.load(f), report)
+        print(json.dumps({'deltas': deltas}, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
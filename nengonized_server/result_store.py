@@ -0,0 +1,274 @@
+import asyncio
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+
+from graphql.language.parser import parse
+from graphql.language.printer import print_ast
+from graphql.error import GraphQLSyntaxError
+
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def normalize_query(query, variables=None):
+    """Returns a key identifying a query independent of its formatting.
+
+    Returns ``None`` if the query cannot be parsed.
+    """
+    try:
+        query = print_ast(parse(query))
+    except GraphQLSyntaxError:
+        return None
+    return hashlib.sha256(
+            (query + json.dumps(variables, sort_keys=True)).encode()
+    ).hexdigest()
+
+
+class _Entry(object):
+    def __init__(self, tag, offset, length, digest):
+        self.tag = tag
+        self.offset = offset
+        self.length = length
+        self.digest = digest
+
+
+_Pending = namedtuple('_Pending', ['tag', 'value', 'digest'])
+
+
+class ResultStore(object):
+    """Persists the latest result for each key, tagged with a model hash.
+
+    Results are appended as JSON to a single file at `path` and read back
+    through a memory map. Only results stored with the current `tag` are
+    returned. The file is compacted once it is larger than `min_compact_size`
+    bytes and `compact_ratio` times larger than the results it still holds.
+
+    Results put while an event loop runs are collected and written in
+    batches by a task that does the file writes and compactions in the
+    default executor. Without a running event loop, they are written
+    immediately. Pending results are returned by `get` already and written
+    by `flush` and `close`.
+    """
+
+    record_header = struct.Struct('>III')
+
+    def __init__(
+            self, path, tag=None, compact_ratio=2.,
+            min_compact_size=1024 * 1024):
+        self.path = path
+        self.tag = tag
+        self.compact_ratio = compact_ratio
+        self.min_compact_size = min_compact_size
+        self._index = {}
+        self._pending = {}
+        self._flushing = None
+        self._live_size = 0
+        self._mmap = None
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'a+b')
+        self._size = 0
+        self._index.clear()
+        self._live_size = 0
+        self._remap()
+        mapped_size = len(self._mmap) if self._mmap is not None else 0
+        while self._size + self.record_header.size <= mapped_size:
+            key_len, tag_len, value_len = self.record_header.unpack_from(
+                    self._mmap, self._size)
+            start = self._size + self.record_header.size
+            end = start + key_len + tag_len + value_len
+            if end > mapped_size:
+                break
+            key = self._mmap[start:start + key_len].decode()
+            tag = self._mmap[start + key_len:start + key_len + tag_len].decode()
+            value_offset = start + key_len + tag_len
+            self._set_entry(key, _Entry(
+                tag, value_offset, value_len, hashlib.sha1(
+                    self._mmap[value_offset:end]).digest()),
+                end - self._size)
+            self._size = end
+        if self._size < mapped_size:  # drop partially written record
+            self._file.truncate(self._size)
+            self._remap()
+
+    def _remap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        size = os.fstat(self._file.fileno()).st_size
+        if size > 0:
+            self._mmap = mmap.mmap(
+                    self._file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _set_entry(self, key, entry, record_size):
+        previous = self._index.get(key)
+        if previous is not None:
+            self._live_size -= self._record_size(key, previous)
+        self._index[key] = entry
+        self._live_size += record_size
+
+    def _record_size(self, key, entry):
+        return (
+            self.record_header.size + len(key.encode()) +
+            len(entry.tag.encode()) + entry.length)
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key):
+        """Returns the data stored for `key` or ``None``."""
+        pending = self._pending.get(key)
+        if pending is not None and pending.tag == self.tag:
+            return json.loads(pending.value)
+        entry = self._index.get(key)
+        if entry is None or entry.tag != self.tag:
+            return None
+        if self._mmap is None or len(self._mmap) < entry.offset + entry.length:
+            self._remap()
+        return json.loads(
+                self._mmap[entry.offset:entry.offset + entry.length])
+
+    def put(self, key, data):
+        if self.tag is None:
+            return
+        value = json.dumps(data).encode()
+        digest = hashlib.sha1(value).digest()
+        entry = self._pending.get(key, self._index.get(key))
+        if entry is not None and entry.tag == self.tag and (
+                entry.digest == digest):
+            return
+        self._pending[key] = _Pending(self.tag, value, digest)
+
+        if self._flushing is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._write_pending()
+                return
+            self._flushing = loop.create_task(self._flush_batches())
+
+    async def flush(self):
+        """Waits until all pending results are written."""
+        if self._flushing is not None:
+            await self._flushing
+
+    async def _flush_batches(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                batch = dict(self._pending)
+                records, entries = self._encode(batch)
+                await loop.run_in_executor(None, self._append, records)
+                self._commit(batch, entries)
+                if self._needs_compaction():
+                    self._replace(*await loop.run_in_executor(
+                        None, self._write_compacted, dict(self._index)))
+        except Exception as err:
+            logger.error("Writing results failed: %s", err)
+        finally:
+            self._flushing = None
+
+    def _write_pending(self):
+        batch = dict(self._pending)
+        records, entries = self._encode(batch)
+        self._append(records)
+        self._commit(batch, entries)
+        if self._needs_compaction():
+            self.compact()
+
+    def _encode(self, batch):
+        records = []
+        entries = {}
+        offset = self._size
+        for key, pending in batch.items():
+            encoded_key = key.encode()
+            encoded_tag = pending.tag.encode()
+            header = self.record_header.pack(
+                    len(encoded_key), len(encoded_tag), len(pending.value))
+            records.extend((header, encoded_key, encoded_tag, pending.value))
+            value_offset = (
+                offset + len(header) + len(encoded_key) + len(encoded_tag))
+            record_size = value_offset + len(pending.value) - offset
+            entries[key] = (_Entry(
+                pending.tag, value_offset, len(pending.value),
+                pending.digest), record_size)
+            offset += record_size
+        return b''.join(records), entries
+
+    def _append(self, records):
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(records)
+        self._file.flush()
+
+    def _commit(self, batch, entries):
+        for key, (entry, record_size) in entries.items():
+            self._set_entry(key, entry, record_size)
+            self._size += record_size
+            if self._pending.get(key) is batch[key]:
+                del self._pending[key]
+
+    def _needs_compaction(self):
+        return self._size > max(
+                self.min_compact_size, self.compact_ratio * self._live_size)
+
+    def compact(self):
+        """Rewrites the store file with only the latest results."""
+        self._replace(*self._write_compacted(dict(self._index)))
+
+    def _write_compacted(self, index):
+        compacted = {}
+        offset = 0
+        with open(self.path, 'rb') as src, open(self.tmp_path, 'wb') as f:
+            for key, entry in index.items():
+                encoded_key = key.encode()
+                encoded_tag = entry.tag.encode()
+                header = self.record_header.pack(
+                        len(encoded_key), len(encoded_tag), entry.length)
+                src.seek(entry.offset)
+                f.write(b''.join((
+                    header, encoded_key, encoded_tag, src.read(entry.length))))
+                value_offset = (
+                    offset + len(header) + len(encoded_key) +
+                    len(encoded_tag))
+                compacted[key] = _Entry(
+                        entry.tag, value_offset, entry.length, entry.digest)
+                offset = value_offset + entry.length
+        return compacted, offset
+
+    def _replace(self, index, size):
+        self._close_file()
+        os.replace(self.tmp_path, self.path)
+        self._file = open(self.path, 'a+b')
+        self._remap()
+        self._index = index
+        self._size = self._live_size = size
+
+    @property
+    def tmp_path(self):
+        return self.path + '.tmp'
+
+    def _close_file(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def close(self):
+        """Writes pending results and closes the store.
+
+        Await `flush` first if results were put with a running event loop.
+        """
+        if self._pending:
+            self._write_pending()
+        self._close_file()
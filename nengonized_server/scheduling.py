@@ -0,0 +1,203 @@
+import asyncio
+import heapq
+import itertools
+import json
+import time
+
+
+class Priority(object):
+    INTERACTIVE = 0
+    SUBSCRIPTION = 1
+    BACKGROUND = 2
+
+    names = {INTERACTIVE: 'interactive', SUBSCRIPTION: 'subscription',
+             BACKGROUND: 'background'}
+
+
+def query_key(query_text, variables):
+    """Returns a hashable key identifying a query with its variables."""
+    return query_text, json.dumps(variables, sort_keys=True)
+
+
+class QueueTimeStats(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, queue_time):
+        self.count += 1
+        self.total += queue_time
+        self.max = max(self.max, queue_time)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'max': self.max}
+
+
+class _Job(object):
+    def __init__(self, client, priority, tag, enqueued, ready):
+        self.client = client
+        self.priority = priority
+        self.tag = tag
+        self.enqueued = enqueued
+        self.ready = ready
+
+
+class QueryScheduler(object):
+    """Schedules calls by priority with fair queuing across clients.
+
+    Calls of a higher priority always run first. Within a priority, calls
+    are ordered by weighted fair queuing: each client gets a share of the
+    dispatched calls proportional to its weight in `weights` (default 1).
+    At most `max_concurrency` calls run at the same time and at most
+    `client_quota` of these may belong to the same client.
+    """
+
+    def __init__(
+            self, max_concurrency=1, client_quota=None, weights=None,
+            clock=time.monotonic):
+        self.max_concurrency = max_concurrency
+        self.client_quota = client_quota
+        self.weights = weights if weights is not None else {}
+        self.clock = clock
+        self.queue_times = {p: QueueTimeStats() for p in Priority.names}
+        self._queues = {p: [] for p in Priority.names}
+        self._seq = itertools.count()
+        self._virtual_time = 0.
+        self._last_tags = {}
+        self._n_running = 0
+        self._n_running_per_client = {}
+
+    @property
+    def n_queued(self):
+        return sum(len(q) for q in self._queues.values())
+
+    async def run(
+            self, method, *args, priority=Priority.BACKGROUND, client=None,
+            **kwargs):
+        job = self._enqueue(client, priority)
+        self._dispatch()
+        try:
+            await job.ready
+        except asyncio.CancelledError:
+            if job.ready.done() and not job.ready.cancelled():
+                self._release(job)
+            raise
+        self.queue_times[priority].add(self.clock() - job.enqueued)
+        try:
+            result = method(*args, **kwargs)
+            if asyncio.iscoroutine(result) or asyncio.isfuture(result):
+                result = await result
+            return result
+        finally:
+            self._release(job)
+
+    def _enqueue(self, client, priority):
+        start = max(self._virtual_time, self._last_tags.get(client, 0.))
+        tag = start + 1. / self.weights.get(client, 1.)
+        self._last_tags[client] = tag
+        job = _Job(
+                client, priority, tag, self.clock(),
+                asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queues[priority], (tag, next(self._seq), job))
+        return job
+
+    def _dispatch(self):
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            deferred = []
+            while queue and self._n_running < self.max_concurrency:
+                entry = heapq.heappop(queue)
+                job = entry[2]
+                if job.ready.done():
+                    continue  # cancelled while queued
+                if self._is_at_quota(job.client):
+                    deferred.append(entry)
+                    continue
+                self._start(job)
+            for entry in deferred:
+                heapq.heappush(queue, entry)
+            if self._n_running >= self.max_concurrency:
+                break
+
+    def _is_at_quota(self, client):
+        return (
+            self.client_quota is not None and
+            self._n_running_per_client.get(client, 0) >= self.client_quota)
+
+    def _start(self, job):
+        self._n_running += 1
+        self._n_running_per_client[job.client] = (
+                self._n_running_per_client.get(job.client, 0) + 1)
+        self._virtual_time = max(self._virtual_time, job.tag)
+        job.ready.set_result(None)
+
+    def _release(self, job):
+        self._n_running -= 1
+        self._n_running_per_client[job.client] -= 1
+        if self._n_running_per_client[job.client] == 0:
+            del self._n_running_per_client[job.client]
+            if self._last_tags.get(job.client, 0.) <= self._virtual_time:
+                self._last_tags.pop(job.client, None)
+        self._dispatch()
+
+    def metrics(self):
+        return {
+            'running': self._n_running,
+            'queued': {
+                Priority.names[p]: len(q) for p, q in self._queues.items()},
+            'queue_time': {
+                Priority.names[p]: s.to_dict()
+                for p, s in self.queue_times.items()},
+        }
+
+
+class _SharedQuery(object):
+    def __init__(self, task):
+        self.task = task
+        self.n_waiting = 0
+
+
+class ScheduledKernel(object):
+    """Routes queries to a kernel through a `QueryScheduler`.
+
+    Identical queries share a single scheduled call while it is queued or
+    running, so that they take neither several scheduler slots nor several
+    kernel round trips. The shared call keeps the priority and client of
+    the first query and is cancelled once all its callers are.
+    """
+
+    def __init__(self, kernel, scheduler):
+        self.kernel = kernel
+        self.scheduler = scheduler
+        self._pending = {}
+
+    async def query(
+            self, query_text, variables=None, priority=Priority.BACKGROUND,
+            client=None):
+        key = query_key(query_text, variables)
+        shared = self._pending.get(key)
+        if shared is None:
+            shared = _SharedQuery(asyncio.ensure_future(self.scheduler.run(
+                self.kernel.query, query_text, variables=variables,
+                priority=priority, client=client)))
+            self._pending[key] = shared
+            shared.task.add_done_callback(
+                    lambda _, key=key, shared=shared: self._discard(
+                        key, shared))
+        shared.n_waiting += 1
+        try:
+            return await asyncio.shield(shared.task)
+        finally:
+            shared.n_waiting -= 1
+            if shared.n_waiting == 0 and not shared.task.done():
+                shared.task.cancel()
+                self._discard(key, shared)
+
+    def _discard(self, key, shared):
+        if self._pending.get(key) is shared:
+            del self._pending[key]
@@ -0,0 +1,112 @@
+import mmap
+import os
+import struct
+import tempfile
+
+
+class SharedBufferArea(object):
+    """Memory-mapped file shared with a kernel for bulk numeric data.
+
+    Instead of encoding arrays as JSON, the kernel writes their raw bytes
+    into the area and puts a handle into the query result::
+
+        {"__buffer__": {"offset": 8, "length": 800, "generation": 3,
+                        "dtype": "float64", "shape": [10, 10]}}
+
+    The kernel reuses the area for later results, so a buffer may be
+    overwritten before the server read it. To detect this, the kernel
+    stamps each buffer with the `generation` of the write, stored as
+    little-endian uint64 in the 8 bytes before `offset`, and puts the same
+    generation into the handle. `read` only returns buffers whose stamp
+    still matches their handle.
+
+    The area is backed by a file in ``/dev/shm`` if available.
+    """
+
+    generation_stamp = struct.Struct('<Q')
+
+    def __init__(self, size):
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, self.path = tempfile.mkstemp(
+                prefix='nengonized-', suffix='.buf', dir=directory)
+        try:
+            os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+
+    def view(self, offset, length):
+        if offset < 0 or length < 0 or offset + length > self.size:
+            raise ValueError(
+                    f"Buffer handle ({offset}, {length}) outside of shared "
+                    f"area of size {self.size}.")
+        return memoryview(self.mmap)[offset:offset + length]
+
+    def read(self, handle):
+        """Returns a copy of the buffer of `handle`.
+
+        Returns ``None`` if the buffer was overwritten since the handle
+        was issued. Handles without generation are read unchecked.
+        """
+        offset, length = handle['offset'], handle['length']
+        generation = handle.get('generation')
+        if generation is None:
+            return bytes(self.view(offset, length))
+        stamp_offset = offset - self.generation_stamp.size
+        if stamp_offset < 0:
+            raise ValueError(
+                    f"Buffer handle at {offset} leaves no room for its "
+                    f"generation stamp.")
+        if self._stamp(stamp_offset) != generation:
+            return None
+        data = bytes(self.view(offset, length))
+        if self._stamp(stamp_offset) != generation:
+            return None  # overwritten while copying
+        return data
+
+    def _stamp(self, offset):
+        return self.generation_stamp.unpack_from(self.mmap, offset)[0]
+
+    def close(self):
+        self.mmap.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def is_buffer_handle(obj):
+    return isinstance(obj, dict) and len(obj) == 1 and '__buffer__' in obj
+
+
+def extract_buffers(data, area):
+    """Replaces buffer handles in `data` with references to binary frames.
+
+    Returns the new data and the list of buffers copied from `area`. Each
+    handle is replaced by ``{"__buffer__": i, "dtype": ..., "shape": ...}``
+    where ``i`` is the index of the buffer in the list. Handles of buffers
+    that were overwritten in the meantime are replaced by ``None``.
+    """
+    buffers = []
+    return _extract(data, area, buffers), buffers
+
+
+def _extract(data, area, buffers):
+    if is_buffer_handle(data):
+        handle = data['__buffer__']
+        buffer = area.read(handle)
+        if buffer is None:
+            return None
+        buffers.append(buffer)
+        return {
+            '__buffer__': len(buffers) - 1,
+            'dtype': handle.get('dtype'),
+            'shape': handle.get('shape'),
+        }
+    elif isinstance(data, dict):
+        return {k: _extract(v, area, buffers) for k, v in data.items()}
+    elif isinstance(data, list):
+        return [_extract(x, area, buffers) for x in data]
+    else:
+        return data
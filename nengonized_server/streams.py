@@ -0,0 +1,140 @@
+import asyncio
+
+
+_EMPTY = object()
+DEFAULT_CHUNK_SIZE = 1000
+
+
+async def in_chunks(items, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields `items` in chunks, yielding to the event loop in between."""
+    items = list(items)
+    for start in range(0, len(items), chunk_size):
+        if start > 0:
+            await asyncio.sleep(0)
+        yield items[start:start + chunk_size]
+
+
+class LatestValue(object):
+    """Async iterable channel that only keeps the latest value put into it.
+
+    If a value is put while an earlier one has not been consumed yet, the
+    earlier one is replaced. With a `merge` function both are combined
+    instead.
+    """
+
+    def __init__(self, merge=None, on_close=None):
+        self.merge = merge
+        self.on_close = on_close
+        self._value = _EMPTY
+        self._error = None
+        self._closed = False
+        self._available = asyncio.Event()
+
+    def put(self, value):
+        if self._value is not _EMPTY and self.merge is not None:
+            value = self.merge(self._value, value)
+        self._value = value
+        self._available.set()
+
+    def close(self, error=None):
+        if self._closed:
+            return
+        self._closed = True
+        self._error = error
+        self._available.set()
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await self._available.wait()
+        if self._value is _EMPTY:
+            if self._error is not None:
+                raise self._error
+            raise StopAsyncIteration
+        value, self._value = self._value, _EMPTY
+        if not self._closed:
+            self._available.clear()
+        return value
+
+
+class Broadcast(object):
+    """Publishes values to any number of `LatestValue` listeners.
+
+    `publish_in_chunks` yields to the event loop after every `chunk_size`
+    listeners, so that publishing to many listeners does not stall it.
+    """
+
+    def __init__(self, merge=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.merge = merge
+        self.chunk_size = chunk_size
+        self._listeners = set()
+
+    @property
+    def n_listeners(self):
+        return len(self._listeners)
+
+    def listen(self, initial=_EMPTY):
+        """Returns a new `LatestValue` channel receiving published values.
+
+        The channel stops receiving values once it is closed.
+        """
+        channel = LatestValue(self.merge, on_close=self._listeners.discard)
+        if initial is not _EMPTY:
+            channel.put(initial)
+        self._listeners.add(channel)
+        return channel
+
+    def publish(self, value):
+        for listener in self._listeners:
+            listener.put(value)
+
+    async def publish_in_chunks(self, value):
+        """Publishes `value` to the current listeners still listening."""
+        async for chunk in in_chunks(self._listeners, self.chunk_size):
+            for listener in chunk:
+                if listener in self._listeners:
+                    listener.put(value)
+
+    def close(self, error=None):
+        for listener in list(self._listeners):
+            listener.close(error)
+
+
+async def switch_map(source, fn):
+    """Yields the results of `fn` applied to each value of `source`.
+
+    A pending call to `fn` is cancelled as soon as `source` produces a new
+    value, so that results are never yielded out of order and superseded
+    results are not computed to completion.
+    """
+    source = source.__aiter__()
+    next_value = asyncio.ensure_future(source.__anext__())
+    pending = None
+    try:
+        while True:
+            waiting = {next_value} if pending is None else {next_value, pending}
+            done, _ = await asyncio.wait(
+                    waiting, return_when=asyncio.FIRST_COMPLETED)
+            if pending in done:
+                result = pending.result()
+                pending = None
+                yield result
+            if next_value in done:
+                try:
+                    value = next_value.result()
+                except StopAsyncIteration:
+                    break
+                if pending is not None:
+                    pending.cancel()
+                pending = asyncio.ensure_future(fn(value))
+                next_value = asyncio.ensure_future(source.__anext__())
+        if pending is not None:
+            yield await pending
+            pending = None
+    finally:
+        next_value.cancel()
+        if pending is not None:
+            pending.cancel()
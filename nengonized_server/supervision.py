@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+
+from .streams import Broadcast
+
+
+logger = logging.getLogger(__name__)
+
+
+class Health(object):
+    STARTING = 'starting'
+    RUNNING = 'running'
+    RESTARTING = 'restarting'
+    STOPPED = 'stopped'
+
+    def __init__(self, status, restarts=0, last_crash_reason=None):
+        self.status = status
+        self.restarts = restarts
+        self.last_crash_reason = last_crash_reason
+
+
+class Supervisor(object):
+    """Restarts a crashed kernel with exponential backoff.
+
+    Crashes are reported by the `crash_callback` of the supervised
+    `ConnectedKernel`. The kernel is restarted through `reloadable`, so that
+    ongoing calls are finished first and observers get notified. The
+    backoff starts at `initial_backoff` seconds, doubles with each crash up
+    to `max_backoff`, and is reset once the kernel has been running for
+    `stable_after` seconds. Listeners receive the `Health` of the kernel,
+    which is starting until `notify_started` is called.
+    """
+
+    def __init__(
+            self, reloadable, kernel, initial_backoff=0.5, max_backoff=30.,
+            stable_after=60., clock=time.monotonic):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.reloadable = reloadable
+        self.kernel = kernel
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.clock = clock
+        self.health = Health(Health.STARTING)
+        self.backoff = initial_backoff
+        self._last_start = clock()
+        self._restart_task = None
+        self._health_updates = Broadcast()
+        kernel.crash_callback = self.notify_crash
+
+    def notify_started(self):
+        self._last_start = self.clock()
+        self._set_health(Health(Health.RUNNING))
+
+    def notify_crash(self, reason):
+        if self.health.status != Health.RUNNING:
+            return
+        if self.clock() - self._last_start >= self.stable_after:
+            self.backoff = self.initial_backoff
+        self._set_health(Health(
+            Health.RESTARTING, self.health.restarts, str(reason)))
+        self._restart_task = asyncio.get_running_loop().create_task(
+                self._restart())
+
+    async def _restart(self):
+        while True:
+            self.logger.warning(
+                    "Kernel crashed, restarting in %s seconds.", self.backoff)
+            await asyncio.sleep(self.backoff)
+            self.backoff = min(2 * self.backoff, self.max_backoff)
+            try:
+                await self.reloadable.reload(restart=True)
+            except Exception as err:
+                self.logger.error("Restarting kernel failed: %s", err)
+                self._set_health(Health(
+                    Health.RESTARTING, self.health.restarts, str(err)))
+            else:
+                break
+        self._last_start = self.clock()
+        self._set_health(Health(
+            Health.RUNNING, self.health.restarts + 1,
+            self.health.last_crash_reason))
+        self._restart_task = None
+
+    async def stop(self):
+        self.kernel.crash_callback = None
+        if self._restart_task is not None:
+            self._restart_task.cancel()
+            try:
+                await self._restart_task
+            except asyncio.CancelledError:
+                pass
+            self._restart_task = None
+        self._set_health(Health(
+            Health.STOPPED, self.health.restarts,
+            self.health.last_crash_reason))
+
+    def listen(self):
+        """Returns a `LatestValue` channel starting with the current health."""
+        return self._health_updates.listen(initial=self.health)
+
+    def _set_health(self, health):
+        self.health = health
+        self._health_updates.publish(health)
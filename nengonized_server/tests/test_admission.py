@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from nengonized_server.admission import AdmissionController, QueryRejected
+from nengonized_server.gql.cost import CostEstimate
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_rejects_queries_above_limits():
+    controller = AdmissionController(max_depth=3, max_cost=100)
+    with pytest.raises(QueryRejected):
+        async with controller.admit('a', CostEstimate(10, 4)):
+            pass
+    with pytest.raises(QueryRejected):
+        async with controller.admit('a', CostEstimate(101, 1)):
+            pass
+    async with controller.admit('a', CostEstimate(100, 3)):
+        pass
+    assert controller.n_rejected == 2
+
+
+async def test_queues_queries_above_client_budget():
+    controller = AdmissionController(client_budget=10)
+    release = asyncio.Event()
+    admitted = []
+
+    async def run(client, cost):
+        async with controller.admit(client, CostEstimate(cost, 1)):
+            admitted.append((client, cost))
+            await release.wait()
+
+    tasks = [
+        asyncio.ensure_future(run('a', 8)),
+        asyncio.ensure_future(run('a', 5)),
+        asyncio.ensure_future(run('b', 5)),
+    ]
+    await asyncio.sleep(0.01)
+    assert admitted == [('a', 8), ('b', 5)]
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert admitted == [('a', 8), ('b', 5), ('a', 5)]
+
+
+async def test_admits_oversized_query_when_client_is_idle():
+    controller = AdmissionController(client_budget=10)
+    async with controller.admit('a', CostEstimate(20, 1)):
+        pass
+
+
+async def test_takes_list_sizes_from_kernel_snapshot():
+    class KernelStub(object):
+        snapshot = {'model': {'ensembles': [{}, {}, {}]}}
+
+    controller = AdmissionController(kernel=KernelStub())
+    assert controller.list_sizes() == {'ensembles': 3}
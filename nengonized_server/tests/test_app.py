@@ -1,9 +1,22 @@
+import asyncio
 import json
 from unittest import mock
+from urllib.parse import quote
 
 import graphene
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application
 
-from nengonized_server.app import QueryHandler, SubscriptionHandler
+from nengonized_server.app import (
+        close_connections, HttpQueryHandler, LogHandler, QueryHandler,
+        SubscriptionHandler, UpdateBatcher)
+from nengonized_server.kernel_logs import LogEntry
+from nengonized_server.result_store import ResultStore
+from nengonized_server.shared_buffers import SharedBufferArea
+from nengonized_server.streams import Broadcast
 
 
 def create_handler(type_, **kwargs):
@@ -24,36 +37,135 @@ class GqlDummyRoot(graphene.ObjectType):
 dummySchema = graphene.Schema(query=GqlDummyRoot)
 
 
+class GqlListRoot(graphene.ObjectType):
+    values = graphene.List(graphene.Int)
+
+    def resolve_values(self, info):
+        return list(range(4))
+
+
 class TestQueryHandler(object):
-    def test_query(self):
+    @pytest.mark.asyncio
+    async def test_query(self):
         context = object()
         schema = mock.MagicMock()
         schema.execute.return_value = dummySchema.execute('{ value }')
         handler = create_handler(QueryHandler, context=context, schema=schema)
         handler.write_message = mock.MagicMock()
 
-        handler.on_message(json.dumps(
+        await handler.on_message(json.dumps(
             {'query': 'input-msg', 'variables': {'var': 'value'}}))
         schema.execute.assert_called_once_with(
-                'input-msg', variables={'var': 'value'}, context=context)
+                'input-msg', variables={'var': 'value'}, context=context,
+                executor=mock.ANY, return_promise=True)
         handler.write_message.assert_called_once_with('{"value": "foo"}')
 
-    def test_error_handling(self):
+    @pytest.mark.asyncio
+    async def test_error_handling(self):
         context = object()
         schema = mock.MagicMock()
         schema.execute.return_value = dummySchema.execute('{ error }')
         handler = create_handler(QueryHandler, context=context, schema=schema)
         handler.write_message = mock.MagicMock()
 
-        handler.on_message(json.dumps(
+        await handler.on_message(json.dumps(
             {'query': 'input-msg', 'variables': None}))
         schema.execute.assert_called_once_with(
-                'input-msg', variables=None, context=context)
+                'input-msg', variables=None, context=context,
+                executor=mock.ANY, return_promise=True)
         handler.write_message.assert_called_once_with('{"error": null}')
 
+    @pytest.mark.asyncio
+    async def test_batch_query(self):
+        handler = create_handler(
+                QueryHandler, context=object(), schema=dummySchema)
+        handler.write_message = mock.MagicMock()
+
+        await handler.on_message(json.dumps([
+            {'query': '{ value }'}, {'query': '{ error }'}]))
+        handler.write_message.assert_called_once_with(
+                '[{"value": "foo"}, {"error": null}]')
+
+    @pytest.mark.asyncio
+    async def test_streamed_batch_query(self):
+        handler = create_handler(
+                QueryHandler, context=object(), schema=dummySchema)
+        handler.write_message = mock.MagicMock()
+
+        await handler.on_message(json.dumps({'stream': True, 'batch': [
+            {'id': 'a', 'query': '{ value }'}, {'query': '{ error }'}]}))
+        handler.write_message.assert_has_calls([
+            mock.call('{"id": "a", "data": {"value": "foo"}}'),
+            mock.call('{"id": 1, "data": {"error": null}}'),
+        ], any_order=True)
+
+    @pytest.mark.asyncio
+    async def test_sends_shared_buffers_as_binary_messages(self):
+        area = SharedBufferArea(16)
+        area.mmap[4:8] = b'data'
+        handle = {'__buffer__': {
+            'offset': 4, 'length': 4, 'dtype': 'uint8', 'shape': [4]}}
+        handler = create_handler(
+                QueryHandler, context=object(), schema=dummySchema,
+                shared_buffers=area)
+        handler.write_message = mock.MagicMock()
+
+        handler.send_data({'value': handle})
+        handler.write_message.assert_has_calls([
+            mock.call(json.dumps({'value': {
+                '__buffer__': 0, 'dtype': 'uint8', 'shape': [4]}})),
+            mock.call(b'data', binary=True),
+        ])
+        area.close()
+
+    @pytest.mark.asyncio
+    async def test_incremental_query(self):
+        schema = mock.MagicMock()
+        schema.execute.return_value = graphene.Schema(
+                query=GqlListRoot).execute('{ values }')
+        handler = create_handler(
+                QueryHandler, context=object(), schema=schema)
+        handler.write_message = mock.MagicMock()
+
+        await handler.on_message(json.dumps({
+            'query': 'input-msg', 'variables': None,
+            'incremental': {'initialCount': 1, 'chunkSize': 2}}))
+        handler.write_message.assert_has_calls([
+            mock.call(json.dumps({'data': {'values': [0]}, 'hasNext': True})),
+            mock.call(json.dumps(
+                {'path': ['values', 1], 'items': [1, 2], 'hasNext': True})),
+            mock.call(json.dumps(
+                {'path': ['values', 3], 'items': [3], 'hasNext': False})),
+        ])
+
+    @pytest.mark.asyncio
+    async def test_incremental_query_waits_for_writes_between_chunks(self):
+        schema = mock.MagicMock()
+        schema.execute.return_value = graphene.Schema(
+                query=GqlListRoot).execute('{ values }')
+        handler = create_handler(
+                QueryHandler, context=object(), schema=schema)
+        written = asyncio.get_running_loop().create_future()
+        handler.write_message = mock.MagicMock(return_value=written)
+
+        task = asyncio.get_running_loop().create_task(handler.on_message(
+            json.dumps({
+                'query': 'input-msg', 'variables': None,
+                'incremental': {'initialCount': 1, 'chunkSize': 2}})))
+        await asyncio.sleep(0.01)
+        schema.execute.assert_called_once()
+        handler.write_message.assert_called_once_with(
+                json.dumps({'data': {'values': [0]}, 'hasNext': True}))
+
+        handler.write_message.return_value = None
+        written.set_result(None)
+        await task
+        assert handler.write_message.call_count == 3
+
 
 class TestSubsriptionHandler(object):
-    def test_query(self):
+    @pytest.mark.asyncio
+    async def test_query(self):
         context = object()
         schema = mock.MagicMock()
         observable_mock = mock.MagicMock()
@@ -70,14 +182,15 @@ class TestSubsriptionHandler(object):
         }))
         schema.execute.assert_called_once_with(
                 'input-msg', context=context, variables={'var': 'value'},
-                allow_subscriptions=True)
+                allow_subscriptions=True, executor=mock.ANY)
         observable_mock.subscribe.assert_called_once()
 
         subscriber = observable_mock.subscribe.call_args[0][0]
         subscriber(dummySchema.execute('{ value }'))
         handler.write_message.assert_called_once_with('{"value": "foo"}')
 
-    def test_subscription_error_handling(self):
+    @pytest.mark.asyncio
+    async def test_subscription_error_handling(self):
         context = object()
         schema = mock.MagicMock()
         schema.execute.return_value = dummySchema.execute('{ error }')
@@ -93,9 +206,10 @@ class TestSubsriptionHandler(object):
         }))
         schema.execute.assert_called_once_with(
                 'input-msg', context=context, variables=None,
-                allow_subscriptions=True)
+                allow_subscriptions=True, executor=mock.ANY)
 
-    def test_update_error_handling(self):
+    @pytest.mark.asyncio
+    async def test_update_error_handling(self):
         context = object()
         schema = mock.MagicMock()
         observable_mock = mock.MagicMock()
@@ -112,14 +226,15 @@ class TestSubsriptionHandler(object):
         }))
         schema.execute.assert_called_once_with(
                 'input-msg', context=context, variables=None,
-                allow_subscriptions=True)
+                allow_subscriptions=True, executor=mock.ANY)
         observable_mock.subscribe.assert_called_once()
 
         subscriber = observable_mock.subscribe.call_args[0][0]
         subscriber(dummySchema.execute('{ error }'))
         handler.write_message.assert_called_once_with('{"error": null}')
 
-    def test_unsubscribe(self):
+    @pytest.mark.asyncio
+    async def test_unsubscribe(self):
         context = mock.MagicMock()
         schema = mock.MagicMock()
         disposable_mock = mock.MagicMock()
@@ -143,7 +258,8 @@ class TestSubsriptionHandler(object):
         }))
         disposable_mock.dispose.assert_called_once()
 
-    def test_disposes_subscriptions_on_connection_close(self):
+    @pytest.mark.asyncio
+    async def test_disposes_subscriptions_on_connection_close(self):
         context = mock.MagicMock()
         schema = mock.MagicMock()
         disposable_mock = mock.MagicMock()
@@ -163,3 +279,286 @@ class TestSubsriptionHandler(object):
 
         handler.close()
         disposable_mock.dispose.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_disposes_subscriptions_when_client_disconnects(self):
+        context = mock.MagicMock()
+        schema = mock.MagicMock()
+        disposable_mock = mock.MagicMock()
+        observable_mock = mock.MagicMock()
+        observable_mock.subscribe.return_value = disposable_mock
+        schema.execute.return_value = observable_mock
+        connections = set()
+        handler = create_handler(
+                SubscriptionHandler, context=context, schema=schema,
+                connections=connections)
+        handler.write_message = mock.MagicMock()
+
+        handler.open()
+        handler.on_message(json.dumps({
+            'action': 'subscribe',
+            'subscriptionId': '1',
+            'query': 'input-msg',
+            'variables': {},
+        }))
+        assert handler in connections
+
+        handler.on_close()
+        disposable_mock.dispose.assert_called_once()
+        assert handler not in connections
+
+    @pytest.mark.asyncio
+    async def test_subscribes_to_probe(self):
+        context = mock.MagicMock()
+        handler = create_handler(
+                SubscriptionHandler, context=context, schema=dummySchema)
+        handler.context = context
+
+        handler.on_message(json.dumps({
+            'action': 'subscribeProbe',
+            'subscriptionId': '1',
+            'probe': 'probe-id',
+            'window': 100,
+            'resolution': 10,
+            'mode': 'minmax',
+        }))
+        subscription = handler.subscriptions['1']
+        assert subscription.probe == 'probe-id'
+        assert subscription.downsampler.factor == 10
+        assert subscription.downsampler.mode == 'minmax'
+        context.probes.listen.assert_called_once()
+
+        handler.on_message(json.dumps(
+            {'action': 'unsubscribe', 'subscriptionId': '1'}))
+        assert handler.subscriptions == {}
+        context.probes.listen.return_value.close.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_frames_probe_with_numeric_subscription_id(self):
+        context = mock.MagicMock()
+        handler = create_handler(
+                SubscriptionHandler, context=context, schema=dummySchema)
+        handler.context = context
+
+        handler.subscribe_probe(7, 'probe-id', 100, 10)
+        assert handler.subscriptions[7].subscription_id == '7'
+        handler.unsubscribe(7)
+        assert handler.subscriptions == {}
+
+    @pytest.mark.asyncio
+    async def test_sends_and_stores_results(self, tmpdir):
+        store = ResultStore(str(tmpdir.join('results.bin')), tag='v1')
+        schema = mock.MagicMock()
+        observable_mock = mock.MagicMock()
+        schema.execute.return_value = observable_mock
+        message = json.dumps({
+            'action': 'subscribe', 'subscriptionId': '1',
+            'query': '{ value }', 'variables': None})
+
+        handler = create_handler(
+                SubscriptionHandler, context=object(), schema=schema,
+                result_store=store)
+        handler.write_message = mock.MagicMock()
+        handler.on_message(message)
+        handler.write_message.assert_not_called()
+        subscriber = observable_mock.subscribe.call_args[0][0]
+        subscriber(dummySchema.execute('{ value }'))
+
+        handler = create_handler(
+                SubscriptionHandler, context=object(), schema=schema,
+                result_store=store)
+        handler.write_message = mock.MagicMock()
+        handler.on_message(message)
+        handler.write_message.assert_called_once_with(
+                '{"stale": {"value": "foo"}}')
+        store.close()
+
+
+class TestLogHandler(object):
+    @pytest.mark.asyncio
+    async def test_sends_recent_and_new_entries(self):
+        context = mock.MagicMock()
+        context.log.recent = [LogEntry(1., 'stdout', 20, b'recent\n')]
+        batches = Broadcast()
+        context.log.listen = batches.listen
+        handler = create_handler(LogHandler, context=context)
+        handler.write_message = mock.MagicMock()
+
+        handler.open()
+        handler.write_message.assert_called_once_with(json.dumps({'entries': [
+            {'time': 1., 'stream': 'stdout', 'level': 'INFO',
+             'line': 'recent\n'}]}))
+
+        handler.write_message.reset_mock()
+        batches.publish([LogEntry(2., 'stderr', 40, b'new\n')])
+        await asyncio.sleep(0)
+        handler.write_message.assert_called_once_with(json.dumps({'entries': [
+            {'time': 2., 'stream': 'stderr', 'level': 'ERROR',
+             'line': 'new\n'}]}))
+
+        handler.on_close()
+        assert batches.n_listeners == 0
+
+
+@pytest.mark.asyncio
+async def test_close_connections_flushes_pending_writes():
+    write_done = asyncio.get_running_loop().create_future()
+    handler = create_handler(
+            QueryHandler, context=object(), schema=mock.MagicMock())
+    handler.write_message = mock.MagicMock(return_value=write_done)
+    handler.close = mock.MagicMock()
+
+    handler.send('message')
+    close_task = asyncio.get_running_loop().create_task(
+            close_connections([handler]))
+    await asyncio.sleep(0)
+    handler.close.assert_not_called()
+
+    write_done.set_result(None)
+    await close_task
+    handler.close.assert_called_once()
+    assert len(handler.pending_writes) == 0
+
+
+class TestUpdateBatcher(object):
+    @pytest.mark.asyncio
+    async def test_coalesces_updates_within_one_tick(self):
+        send = mock.MagicMock()
+        batcher = UpdateBatcher(send)
+        batcher.add('1', {'value': 'old'})
+        batcher.add('2', {'value': 'foo'})
+        batcher.add('1', {'value': 'new'})
+        send.assert_not_called()
+
+        await asyncio.sleep(0)
+        send.assert_called_once_with(
+                {'1': {'value': 'new'}, '2': {'value': 'foo'}})
+
+    @pytest.mark.asyncio
+    async def test_flushes_after_interval(self):
+        send = mock.MagicMock()
+        batcher = UpdateBatcher(send, flush_interval=0.01)
+        batcher.add('1', {'value': 'foo'})
+        await asyncio.sleep(0)
+        send.assert_not_called()
+        await asyncio.sleep(0.02)
+        send.assert_called_once_with({'1': {'value': 'foo'}})
+
+    @pytest.mark.asyncio
+    async def test_discards_updates(self):
+        send = mock.MagicMock()
+        batcher = UpdateBatcher(send)
+        batcher.add('1', {'value': 'foo'})
+        batcher.discard('1')
+        await asyncio.sleep(0)
+        send.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_multiplexes_subscription_updates():
+    schema = mock.MagicMock()
+    handler = create_handler(
+            SubscriptionHandler, context=object(), schema=schema)
+    handler.write_message = mock.MagicMock()
+    handler.on_message(json.dumps({'action': 'configure', 'multiplex': True}))
+
+    subscribers = []
+    for subscription_id in ('1', '2'):
+        observable_mock = mock.MagicMock()
+        schema.execute.return_value = observable_mock
+        handler.on_message(json.dumps({
+            'action': 'subscribe',
+            'subscriptionId': subscription_id,
+            'query': 'input-msg',
+            'variables': None,
+        }))
+        subscribers.append(observable_mock.subscribe.call_args[0][0])
+
+    for subscriber in subscribers:
+        subscriber(dummySchema.execute('{ value }'))
+    await asyncio.sleep(0)
+    handler.write_message.assert_called_once_with(
+            '{"1": {"value": "foo"}, "2": {"value": "foo"}}')
+
+
+class TestHttpQueryHandler(object):
+    @pytest.fixture
+    async def server(self):
+        context = mock.MagicMock()
+        context.reloadable.generation = 0
+        app = Application([(r"/graphql", HttpQueryHandler, {
+            'context': context, 'schema': dummySchema})],
+            compress_response=True)
+        sock, port = bind_unused_port()
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        yield context, f'http://127.0.0.1:{port}/graphql'
+        server.stop()
+
+    async def fetch(self, url, **kwargs):
+        return await AsyncHTTPClient().fetch(url, raise_error=False, **kwargs)
+
+    @pytest.mark.asyncio
+    async def test_get(self, server):
+        _, url = server
+        response = await self.fetch(url + '?query={value}')
+        assert response.code == 200
+        assert json.loads(response.body) == {'data': {'value': 'foo'}}
+
+    @pytest.mark.asyncio
+    async def test_post(self, server):
+        _, url = server
+        response = await self.fetch(url, method='POST', body=json.dumps(
+            {'query': '{ error }', 'variables': None}))
+        assert response.code == 200
+        body = json.loads(response.body)
+        assert body['data'] == {'error': None}
+        assert body['errors'][0]['message'] == "An error."
+
+    @pytest.mark.asyncio
+    async def test_rejects_invalid_body(self, server):
+        _, url = server
+        response = await self.fetch(url, method='POST', body='{')
+        assert response.code == 400
+
+    @pytest.mark.asyncio
+    async def test_answers_unchanged_results_with_not_modified(self, server):
+        context, url = server
+        response = await self.fetch(url + '?query={value}')
+        etag = response.headers['Etag']
+        response = await self.fetch(
+                url + '?query=' + quote('{ value }'),
+                headers={'If-None-Match': etag})
+        assert response.code == 304
+
+        context.reloadable.generation = 1
+        response = await self.fetch(
+                url + '?query={value}', headers={'If-None-Match': etag})
+        assert response.code == 200
+        assert response.headers['Etag'] != etag
+
+    @pytest.mark.asyncio
+    async def test_etag_changes_with_process(self, server):
+        _, url = server
+        response = await self.fetch(url + '?query={value}')
+        etag = response.headers['Etag']
+        with mock.patch('nengonized_server.app.ETAG_EPOCH', 'other'):
+            response = await self.fetch(
+                    url + '?query={value}', headers={'If-None-Match': etag})
+        assert response.code == 200
+        assert response.headers['Etag'] != etag
+
+    @pytest.mark.asyncio
+    async def test_sends_no_etag_with_errors(self, server):
+        _, url = server
+        response = await self.fetch(url + '?query={error}')
+        assert response.code == 200
+        assert 'Etag' not in response.headers
+
+    @pytest.mark.asyncio
+    async def test_identifies_clients_by_remote_address(self, server):
+        context, url = server
+        await self.fetch(url + '?query={value}')
+        await self.fetch(url + '?query={value}')
+        clients = {c[0][0] for c in context.for_client.call_args_list}
+        assert clients == {('http', '127.0.0.1')}
@@ -0,0 +1,70 @@
+from nengonized_server.changes import (
+        ChangeSet, collect_nodes, diff_snapshots, NodeScope, ROOT_ID)
+
+
+def test_collect_nodes_replaces_nested_nodes_with_ids():
+    data = {'model': {'id': 'a', 'label': 'net', 'ensembles': [
+        {'id': 'b', 'label': 'ens'}]}}
+    assert collect_nodes(data) == {
+        'a': {'id': 'a', 'label': 'net', 'ensembles': [{'id': 'b'}]},
+        'b': {'id': 'b', 'label': 'ens'},
+    }
+
+
+def test_diff_snapshots():
+    old = {'model': {'id': 'a', 'label': 'net', 'ensembles': [
+        {'id': 'b', 'label': 'ens'}, {'id': 'c', 'label': 'removed'}]}}
+    new = {'model': {'id': 'a', 'label': 'net', 'ensembles': [
+        {'id': 'b', 'label': 'renamed'}, {'id': 'd', 'label': 'added'}]}}
+    assert diff_snapshots(old, new) == ChangeSet(
+        added={'d'}, removed={'c'}, changed={'a', 'b'})
+
+
+def test_child_change_does_not_change_parent():
+    old = {'model': {'id': 'a', 'ensembles': [{'id': 'b', 'n': 1}]}}
+    new = {'model': {'id': 'a', 'ensembles': [{'id': 'b', 'n': 2}]}}
+    assert diff_snapshots(old, new) == ChangeSet(changed={'b'})
+
+
+def test_diffs_data_outside_nodes_as_root():
+    old = {'model': {'label': 'net', 'ensembles': [{'id': 'b', 'n': 1}]}}
+    new = {'model': {'label': 'renamed', 'ensembles': [{'id': 'b', 'n': 1}]}}
+    assert diff_snapshots(old, new) == ChangeSet(changed={ROOT_ID})
+
+
+def test_truncated_snapshots_have_unknown_changes():
+    old = {'model': {'id': 'a', 'networks': [{'snapshotTruncated': 'Net'}]}}
+    assert diff_snapshots(old, old) is None
+    assert diff_snapshots({'model': {'id': 'a', 'networks': []}}, old) is None
+
+
+def test_empty_change_set_is_falsy():
+    assert not diff_snapshots({'id': 'a'}, {'id': 'a'})
+    assert ChangeSet(added={'a'}).ids == {'a'}
+
+
+class TestNodeScope(object):
+    def test_is_touched_by_intersecting_changes_only(self):
+        scope = NodeScope()
+        scope.update({'model': {'id': 'a', 'ensembles': [{'id': 'b'}]}})
+        assert scope.is_touched_by(ChangeSet(changed={'b'}))
+        assert scope.is_touched_by(ChangeSet(removed={'a'}))
+        assert not scope.is_touched_by(ChangeSet(changed={'c'}))
+        assert not scope.is_touched_by(ChangeSet())
+
+    def test_is_touched_by_changes_outside_nodes(self):
+        scope = NodeScope()
+        scope.update({'model': {'id': 'a'}})
+        assert scope.is_touched_by(ChangeSet(changed={ROOT_ID}))
+
+    def test_is_touched_by_restarts(self):
+        scope = NodeScope()
+        scope.update({'model': {'id': 'a'}})
+        assert scope.is_touched_by(None)
+
+    def test_is_touched_by_any_change_without_known_ids(self):
+        scope = NodeScope()
+        assert scope.is_touched_by(ChangeSet(changed={'c'}))
+        scope.update({'model': {'label': 'foo'}})
+        assert scope.is_touched_by(ChangeSet(changed={'c'}))
+        assert not scope.is_touched_by(ChangeSet())
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import socket
+import tempfile
+
+import pytest
+
+from nengonized_server.framing import ConnectionClosed, FramedConnection
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def echo_frames(reader, writer):
+    header = await reader.readexactly(FramedConnection.header.size)
+    (length,) = FramedConnection.header.unpack(header)
+    writer.write(header + await reader.readexactly(length))
+    await writer.drain()
+    writer.close()
+
+
+async def test_exchanges_messages_over_socketpair():
+    a, b = socket.socketpair()
+    async with FramedConnection(sock=a) as conn_a:
+        async with FramedConnection(sock=b) as conn_b:
+            await conn_a.send('{"query": "{ model { label } }"}')
+            await conn_a.send('äöü')
+            assert await conn_b.recv() == '{"query": "{ model { label } }"}'
+            assert await conn_b.recv() == 'äöü'
+
+
+async def test_exchanges_messages_over_unix_socket():
+    path = os.path.join(tempfile.mkdtemp(), 'test.sock')
+    server = await asyncio.start_unix_server(echo_frames, path)
+    try:
+        async with FramedConnection(path=path) as conn:
+            await conn.send('message')
+            assert await conn.recv() == 'message'
+    finally:
+        server.close()
+        await server.wait_closed()
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+
+async def test_raises_connection_closed_on_eof():
+    a, b = socket.socketpair()
+    async with FramedConnection(sock=a) as conn:
+        b.close()
+        with pytest.raises(ConnectionClosed):
+            await conn.recv()
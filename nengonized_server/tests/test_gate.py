@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from nengonized_server.gate import RwGate
+
+
+pytestmark = pytest.mark.asyncio
+
+
+def create_task(coro):
+    return asyncio.get_running_loop().create_task(coro)
+
+
+async def test_readers_pass_concurrently():
+    gate = RwGate()
+    await gate.acquire_read()
+    await gate.acquire_read()
+    assert gate.n_readers == 2
+    gate.release_read()
+    gate.release_read()
+    assert gate.read_wait.count == 0
+
+
+async def test_writer_waits_for_readers():
+    gate = RwGate()
+    await gate.acquire_read()
+    writer = create_task(gate.acquire_write())
+    await asyncio.sleep(0)
+    assert not writer.done()
+    gate.release_read()
+    await writer
+    gate.release_write()
+
+
+async def test_new_readers_queue_behind_pending_writer():
+    gate = RwGate()
+    order = []
+
+    async def read(name):
+        await gate.acquire_read()
+        order.append(name)
+        gate.release_read()
+
+    async def write():
+        await gate.acquire_write()
+        order.append('writer')
+        gate.release_write()
+
+    await gate.acquire_read()
+    writer = create_task(write())
+    await asyncio.sleep(0)
+    reader = create_task(read('reader'))
+    await asyncio.sleep(0)
+    assert order == []
+
+    gate.release_read()
+    await asyncio.gather(writer, reader)
+    assert order == ['writer', 'reader']
+    assert gate.read_wait.count == 1
+    assert gate.write_wait.count == 1
+
+
+async def test_writers_are_exclusive():
+    gate = RwGate()
+    await gate.acquire_write()
+    second = create_task(gate.acquire_write())
+    await asyncio.sleep(0)
+    assert not second.done()
+    gate.release_write()
+    await second
+    gate.release_write()
+    assert gate.n_writers == 0
+
+
+async def test_cancelled_writer_lets_readers_pass():
+    gate = RwGate()
+    await gate.acquire_read()
+    writer = create_task(gate.acquire_write())
+    await asyncio.sleep(0)
+    writer.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await writer
+    await asyncio.wait_for(gate.acquire_read(), timeout=1)
+    assert gate.n_writers == 0
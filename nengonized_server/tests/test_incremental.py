@@ -0,0 +1,16 @@
+from nengonized_server.incremental import chunk_deferred, split_lists
+
+
+def test_splits_lists():
+    data = {'a': [{'b': [1, 2, 3]}, {'b': []}, {'b': [4]}], 'c': 'd'}
+    head, deferred = split_lists(data, 1)
+    assert head == {'a': [{'b': [1]}], 'c': 'd'}
+    assert deferred == [
+        (['a', 0, 'b', 1], [2, 3]),
+        (['a', 1], [{'b': []}, {'b': [4]}]),
+    ]
+
+
+def test_chunks_deferred_items():
+    chunks = list(chunk_deferred([(['a', 2], [3, 4, 5])], 2))
+    assert chunks == [(['a', 2], [3, 4]), (['a', 4], [5])]
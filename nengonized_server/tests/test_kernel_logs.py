@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from unittest import mock
+
+import pytest
+
+from nengonized_server.kernel_logs import KernelLog, TokenBucket
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class ClockStub(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+async def test_token_bucket_limits_rate():
+    clock = ClockStub()
+    bucket = TokenBucket(rate=2., burst=2, clock=clock)
+    assert bucket.take()
+    assert bucket.take()
+    assert not bucket.take()
+    clock.now = 0.5
+    assert bucket.take()
+    assert not bucket.take()
+
+
+async def test_batches_lines_and_logs_them_on_flush():
+    logger = mock.MagicMock()
+    child_logger = mock.MagicMock()
+    logger.getChild.return_value = child_logger
+    log = KernelLog(logger, flush_interval=10.)
+    channel = log.listen()
+
+    log.append('stdout', logging.INFO, b'a\n')
+    log.append('stdout', logging.INFO, b'b\n')
+    child_logger.log.assert_not_called()
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(channel.__anext__(), 0.01)
+
+    await log.flush()
+    child_logger.log.assert_has_calls([
+        mock.call(logging.INFO, '%s', 'a\n'),
+        mock.call(logging.INFO, '%s', 'b\n'),
+    ])
+    assert [e.line for e in await channel.__anext__()] == [b'a\n', b'b\n']
+    channel.close()
+
+
+async def test_flushes_after_interval():
+    log = KernelLog(mock.MagicMock(), flush_interval=0.01)
+    channel = log.listen()
+    log.append('stdout', logging.INFO, b'a\n')
+    batch = await asyncio.wait_for(channel.__anext__(), 1.)
+    assert [e.line for e in batch] == [b'a\n']
+    channel.close()
+
+
+async def test_concatenates_unconsumed_batches_up_to_retain():
+    log = KernelLog(mock.MagicMock(), retain=2, flush_interval=10.)
+    channel = log.listen()
+    for line in (b'a\n', b'b\n', b'c\n'):
+        log.append('stdout', logging.INFO, line)
+        await log.flush()
+    assert [e.line for e in await channel.__anext__()] == [b'b\n', b'c\n']
+    channel.close()
+
+
+async def test_retains_recent_lines_in_ring_buffer():
+    log = KernelLog(mock.MagicMock(), retain=2, flush_interval=10.)
+    for line in (b'a\n', b'b\n', b'c\n'):
+        log.append('stdout', logging.INFO, line)
+    assert [e.line for e in log.recent] == [b'b\n', b'c\n']
+    await log.flush()
+
+
+async def test_drops_and_counts_lines_above_limits():
+    logger = mock.MagicMock()
+    child_logger = mock.MagicMock()
+    logger.getChild.return_value = child_logger
+    log = KernelLog(
+            logger, flush_interval=10., rate=0., burst=2, max_pending=10)
+    for _ in range(5):
+        log.append('stdout', logging.INFO, b'line\n')
+    assert log.dropped == {'stdout': 3}
+    assert len(log.recent) == 2
+
+    await log.flush()
+    child_logger.warning.assert_called_once_with(
+            "Dropped %d lines of kernel output.", 3)
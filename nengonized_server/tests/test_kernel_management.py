@@ -2,14 +2,22 @@ import asyncio
 import json
 import logging
 from unittest import mock
+import os
+import resource
+import socket
 from subprocess import PIPE
 import sys
 
 import pytest
+import websockets
 
 from nengonized_server.async_testing import create_stub_future, mock_coroutine
+from nengonized_server.changes import ChangeSet
+from nengonized_server.framing import FramedConnection
 from nengonized_server.kernel_management import (
-        ConnectedKernel, Kernel, Reloadable, Subscribable)
+        ActiveQueries, ConnectedKernel, InPlaceReloadError, Kernel,
+        KernelStartupError, Reloadable, ResourceLimits, Subscribable)
+from nengonized_server.model_cache import ModelCache
 
 
 pytestmark = pytest.mark.asyncio
@@ -25,6 +33,7 @@ class CreateProcessStub(mock.MagicMock):
 class ProcessStub(mock.NonCallableMagicMock):
     def __init__(self):
         super().__init__()
+        self.returncode = None
         self.stdout = StreamStub([b'{"field": 42}\n', b'\n', b'stdout\n'])
         self.stderr = StreamStub([b'stderr\n'])
 
@@ -32,9 +41,8 @@ class ProcessStub(mock.NonCallableMagicMock):
         pass
 
 
-class StreamStub(mock.MagicMock):
+class StreamStub(object):
     def __init__(self, lines):
-        super().__init__()
         self.line_iter = iter(lines)
 
     async def readline(self):
@@ -64,22 +72,144 @@ class TestKernel(object):
                 sys.executable, '-m', 'nengonized_kernel', 'foo', 'bar',
                 stdout=PIPE, stderr=PIPE)
 
+    async def test_applies_resource_limits(self, cse_mock):
+        limits = ResourceLimits(memory=1024**3, cpu_time=60)
+        with mock.patch('resource.prlimit') as prlimit:
+            async with Kernel('foo', limits=limits) as kernel:
+                cse_mock.assert_called_once_with(
+                    sys.executable, '-m', 'nengonized_kernel', 'foo',
+                    stdout=PIPE, stderr=PIPE)
+        pid = cse_mock.proc.pid
+        assert prlimit.call_args_list == [
+            mock.call(pid, resource.RLIMIT_AS, (1024**3, 1024**3)),
+            mock.call(pid, resource.RLIMIT_CPU, (60, 60)),
+        ]
+
+    async def test_kills_kernel_if_limits_fail(self, cse_mock):
+        limits = ResourceLimits(memory=1024**3)
+        with mock.patch('resource.prlimit', side_effect=PermissionError):
+            with pytest.raises(PermissionError):
+                async with Kernel('foo', limits=limits):
+                    pass
+        cse_mock.proc.kill.assert_called_once_with()
+
+    async def test_offers_socketpair_link(self, cse_mock):
+        async with Kernel('foo', local_link='socketpair') as kernel:
+            kwargs = cse_mock.call_args[1]
+            fd = kwargs['pass_fds'][0]
+            assert kwargs['env']['NENGONIZED_KERNEL_FD'] == str(fd)
+            assert kernel.link_socket is not None
+        assert kernel.link_socket is None
+
+    async def test_passes_shared_buffer_area(self, cse_mock):
+        kernel = Kernel('foo', shared_buffer_size=1024)
+        try:
+            async with kernel:
+                env = cse_mock.call_args[1]['env']
+                assert env['NENGONIZED_KERNEL_SHM'] == (
+                        kernel.shared_buffers.path)
+        finally:
+            kernel.shared_buffers.close()
+
+    async def test_passes_model_cache_entry(self, cse_mock, tmpdir):
+        model = tmpdir.join('model.py')
+        model.write('model = None')
+        cache = ModelCache(str(tmpdir.join('cache')), 1024**2)
+        async with Kernel(str(model), model_cache=cache):
+            env = cse_mock.call_args[1]['env']
+            assert env['NENGONIZED_MODEL_CACHE_HIT'] == '0'
+
+        cse_mock.return_value = create_stub_future(ProcessStub())
+        async with Kernel(str(model), model_cache=cache):
+            env = cse_mock.call_args[1]['env']
+            assert env['NENGONIZED_MODEL_CACHE_HIT'] == '0'
+
+        proc = ProcessStub()
+        proc.stdout = StreamStub([b'{"modelCached": true}\n', b'\n'])
+        cse_mock.return_value = create_stub_future(proc)
+        async with Kernel(str(model), model_cache=cache):
+            pass
+        cse_mock.return_value = create_stub_future(ProcessStub())
+        async with Kernel(str(model), model_cache=cache):
+            env = cse_mock.call_args[1]['env']
+            assert env['NENGONIZED_MODEL_CACHE_HIT'] == '1'
+            assert env['NENGONIZED_MODEL_CACHE'].startswith(cache.directory)
+
+    async def test_reports_cached_model(self, cse_mock, tmpdir):
+        model = tmpdir.join('model.py')
+        model.write('model = None')
+        cache = ModelCache(str(tmpdir.join('cache')), 1024**2)
+        assert not await Kernel(str(model)).has_cached_model()
+        kernel = Kernel(str(model), model_cache=cache)
+        assert not await kernel.has_cached_model()
+        cache.commit(cache.prepare(str(model))[0])
+        assert await kernel.has_cached_model()
+
+    async def test_reports_unexpected_exit(self, cse_mock):
+        exited = asyncio.Event()
+        cse_mock.proc.wait = exited.wait
+        kernel = Kernel()
+        kernel.crash_callback = mock.MagicMock()
+        async with kernel:
+            exited.set()
+            await asyncio.sleep(0)
+            kernel.crash_callback.assert_called_once()
+
+    async def test_does_not_report_exit_on_termination(self, cse_mock):
+        exited = asyncio.Event()
+        cse_mock.proc.wait = exited.wait
+        cse_mock.proc.terminate.side_effect = exited.set
+        kernel = Kernel()
+        kernel.crash_callback = mock.MagicMock()
+        async with kernel:
+            pass
+        await asyncio.sleep(0)
+        kernel.crash_callback.assert_not_called()
+
     async def test_on_exit_terminates_kernel(self, cse_mock):
         async with Kernel() as kernel:
             pass
         cse_mock.proc.terminate.assert_called_once()
 
+    async def test_kills_kernel_not_terminating_in_time(self, cse_mock):
+        killed = asyncio.Event()
+        cse_mock.proc.kill.side_effect = killed.set
+        cse_mock.proc.wait = killed.wait
+        async with Kernel(terminate_timeout=0.01) as kernel:
+            pass
+        cse_mock.proc.kill.assert_called_once()
+
     async def test_reads_kernel_conf(self, cse_mock):
         async with Kernel() as kernel:
             assert kernel.conf == {'field': 42}
 
+    async def test_raises_if_kernel_exits_before_sending_conf(self, cse_mock):
+        cse_mock.proc.stdout = StreamStub([b'{"field":', b''])
+        with pytest.raises(KernelStartupError):
+            await asyncio.wait_for(Kernel().__aenter__(), 1.)
+
+    async def test_removes_unix_link_dir(self, cse_mock):
+        async with Kernel(local_link='unix') as kernel:
+            env = cse_mock.call_args[1]['env']
+            link_dir = os.path.dirname(env['NENGONIZED_KERNEL_SOCKET'])
+            assert os.path.isdir(link_dir)
+        assert not os.path.exists(link_dir)
+
+        cse_mock.proc.stdout = StreamStub([b''])
+        with pytest.raises(KernelStartupError):
+            await Kernel(local_link='unix').__aenter__()
+        env = cse_mock.call_args[1]['env']
+        assert not os.path.exists(
+                os.path.dirname(env['NENGONIZED_KERNEL_SOCKET']))
+
     async def test_logs_kernel_stdout_and_stderr(self, cse_mock):
         kernel = Kernel()
-        kernel.logger = mock.MagicMock()
+        kernel.log.logger = mock.MagicMock()
         child_logger = mock.MagicMock()
-        kernel.logger.getChild.return_value = child_logger
+        kernel.log.logger.getChild.return_value = child_logger
         async with kernel:
             pass
+        await kernel.log.flush()
         child_logger.log.assert_has_calls([
                 mock.call(logging.INFO, '%s', 'stdout\n'),
                 mock.call(logging.ERROR, '%s', 'stderr\n'),
@@ -97,6 +227,7 @@ class KernelMock(mock.NonCallableMagicMock):
         self.pass_enter.set()
         self.__aenter__ = mock_coroutine(self)
         self.__aexit__ = mock_coroutine(None)
+        self.has_cached_model = mock_coroutine(False)
 
     async def __aenter__(self):
         await self.pass_enter.wait()
@@ -135,6 +266,18 @@ class TestConnectedKernel(object):
             kernel_mock.__aenter__.assert_called_once()
             ws_connect_mock.assert_called_once_with(url)
 
+    async def test_uses_framed_socketpair_link_if_offered(self):
+        kernel_mock = KernelMock({'framed': 'fd'})
+        kernel_mock.link_socket, kernel_end = socket.socketpair()
+        async with ConnectedKernel(kernel_mock) as connected_kernel:
+            async with FramedConnection(sock=kernel_end) as kernel_conn:
+                query = asyncio.get_running_loop().create_task(
+                        connected_kernel.query('{ model { id } }'))
+                assert json.loads(await kernel_conn.recv()) == {
+                        'query': '{ model { id } }', 'variables': None}
+                await kernel_conn.send('data')
+                assert await query == 'data'
+
     async def test_disconnects_stops_kernel(
             self, ws_connect_mock, connection_mock):
         kernel_mock = KernelMock()
@@ -153,6 +296,175 @@ class TestConnectedKernel(object):
                 {'query': '{ model { id } }', 'variables': {'var': 'value'}}))
         assert result == 'data'
 
+    async def test_shares_round_trip_of_identical_concurrent_queries(
+            self, ws_connect_mock, connection_mock):
+        connection_mock.recv = mock_coroutine('data')
+        async with ConnectedKernel(KernelMock()) as connected_kernel:
+            results = await asyncio.gather(
+                    connected_kernel.query('{ model { id } }'),
+                    connected_kernel.query('{ model { id } }'),
+                    connected_kernel.query('{ model { label } }'))
+        assert results == ['data', 'data', 'data']
+        assert connection_mock.send.call_count == 2
+
+    async def test_reports_closed_connection_as_crash(
+            self, ws_connect_mock, connection_mock):
+        async def recv():
+            raise websockets.exceptions.ConnectionClosed(None, None)
+        connection_mock.recv = recv
+        async with ConnectedKernel(KernelMock()) as connected_kernel:
+            connected_kernel.crash_callback = mock.MagicMock()
+            with pytest.raises(websockets.exceptions.ConnectionClosed):
+                await connected_kernel.query('{ model { id } }')
+            connected_kernel.crash_callback.assert_called_once()
+
+    async def test_reloads_in_place_and_diffs_snapshots(
+            self, ws_connect_mock, connection_mock):
+        responses = iter([
+            '{"model": {"id": "a", "label": "old"}}',
+            '{"reload": true}',
+            '{"model": {"id": "a", "label": "new"}}',
+        ])
+        async def recv():
+            return next(responses)
+        connection_mock.recv = recv
+        async with ConnectedKernel(
+                KernelMock(), snapshot_query='snapshot') as connected_kernel:
+            changes = await connected_kernel.reload_in_place()
+            connection_mock.send.assert_called_with(
+                    json.dumps({'query': 'snapshot', 'variables': None}))
+        assert changes == ChangeSet(changed={'a'})
+
+    async def test_reports_unknown_changes_for_truncated_snapshots(
+            self, ws_connect_mock, connection_mock):
+        deep = {'id': 'c', 'networks': {'snapshotTruncated': 'Net'}}
+        responses = iter([
+            '{"model": {"id": "a", "networks": null}}',
+            '{"reload": true}',
+            json.dumps({'model': {'id': 'a', 'networks': {
+                'id': 'b', 'networks': deep}}}),
+        ])
+
+        async def recv():
+            return next(responses)
+        connection_mock.recv = recv
+        async with ConnectedKernel(
+                KernelMock(), snapshot_query='snapshot') as connected_kernel:
+            assert await connected_kernel.reload_in_place() is None
+
+    async def test_raises_to_restore_cached_model(
+            self, ws_connect_mock, connection_mock):
+        kernel_mock = KernelMock()
+        kernel_mock.has_cached_model = mock_coroutine(True)
+        connection_mock.recv = mock_coroutine('{"model": null}')
+        async with ConnectedKernel(
+                kernel_mock, snapshot_query='snapshot') as connected_kernel:
+            connection_mock.send.reset_mock()
+            with pytest.raises(InPlaceReloadError):
+                await connected_kernel.reload_in_place()
+            connection_mock.send.assert_not_called()
+
+    async def test_raises_if_kernel_rejects_reload(
+            self, ws_connect_mock, connection_mock):
+        connection_mock.recv = mock_coroutine('null')
+        async with ConnectedKernel(
+                KernelMock(), snapshot_query='snapshot') as connected_kernel:
+            with pytest.raises(InPlaceReloadError):
+                await connected_kernel.reload_in_place()
+
+    async def test_raises_if_snapshot_after_reload_fails(
+            self, ws_connect_mock, connection_mock):
+        responses = iter(['{"model": null}', '{"reload": true}', 'invalid'])
+
+        async def recv():
+            return next(responses)
+        connection_mock.recv = recv
+        async with ConnectedKernel(
+                KernelMock(), snapshot_query='snapshot') as connected_kernel:
+            with pytest.raises(InPlaceReloadError):
+                await connected_kernel.reload_in_place()
+            assert connected_kernel.snapshot == {'model': None}
+
+    async def test_prefetches_active_queries_after_snapshot(
+            self, ws_connect_mock, connection_mock):
+        events = []
+        responses = iter(['{"model": null}', 'a', 'b'])
+
+        async def send(message):
+            events.append(('send', json.loads(message)['query']))
+
+        async def recv():
+            events.append(('recv',))
+            return next(responses)
+        connection_mock.send = send
+        connection_mock.recv = recv
+        active_queries = ActiveQueries()
+        active_queries.add('query A', {'x': 1})
+        active_queries.add('query B')
+
+        async with ConnectedKernel(
+                KernelMock(), snapshot_query='snapshot',
+                active_queries=active_queries) as connected_kernel:
+            assert connected_kernel.snapshot == {'model': None}
+            assert await connected_kernel.query('query B') == 'b'
+            assert await connected_kernel.query('query A', {'x': 1}) == 'a'
+            assert events == [
+                ('send', 'snapshot'), ('recv',), ('send', 'query A'),
+                ('recv',), ('send', 'query B'), ('recv',)]
+
+    async def test_prefetched_responses_are_used_once(
+            self, ws_connect_mock, connection_mock):
+        connection_mock.recv = mock_coroutine('data')
+        active_queries = ActiveQueries()
+        active_queries.add('query A')
+        async with ConnectedKernel(
+                KernelMock(),
+                active_queries=active_queries) as connected_kernel:
+            await connected_kernel.query('query A')
+            assert connection_mock.send.call_count == 1
+            await connected_kernel.query('query A')
+            assert connection_mock.send.call_count == 2
+
+    async def test_ignores_expired_prefetched_responses(
+            self, ws_connect_mock, connection_mock):
+        connection_mock.recv = mock_coroutine('data')
+        active_queries = ActiveQueries()
+        active_queries.add('query A')
+        async with ConnectedKernel(
+                KernelMock(), active_queries=active_queries,
+                prefetch_ttl=0.) as connected_kernel:
+            await asyncio.sleep(0.01)
+            await connected_kernel.query('query A')
+            assert connection_mock.send.call_count == 2
+            assert connected_kernel._prefetched == {}
+
+    async def test_cancels_prefetching_on_exit(
+            self, ws_connect_mock, connection_mock):
+        never = asyncio.get_running_loop().create_future()
+        connection_mock.recv = lambda: never
+        active_queries = ActiveQueries()
+        active_queries.add('query A')
+        async with ConnectedKernel(
+                KernelMock(), active_queries=active_queries):
+            await asyncio.sleep(0)
+        connection_mock.__aexit__.assert_called_once()
+
+
+class TestActiveQueries(object):
+    async def test_counts_references(self):
+        active_queries = ActiveQueries()
+        active_queries.add('query', {'b': 2, 'a': 1})
+        active_queries.add('query', {'a': 1, 'b': 2})
+        active_queries.add('other')
+        assert len(active_queries) == 2
+
+        active_queries.discard('query', {'a': 1, 'b': 2})
+        active_queries.discard('other')
+        active_queries.discard('other')
+        assert list(active_queries) == [('query', {'b': 2, 'a': 1})]
+        active_queries.discard('query', {'a': 1, 'b': 2})
+        assert len(active_queries) == 0
+
 
 class TestReloadable(object):
     async def test_enters_and_exits_wrapped_object(self):
@@ -169,6 +481,66 @@ class TestReloadable(object):
             kernel_mock.__aexit__.assert_called_once()
             kernel_mock.__aenter__.assert_called_once()
 
+    async def test_reloads_in_place(self):
+        changes = ChangeSet(changed={'a'})
+        kernel_mock = KernelMock()
+        kernel_mock.reload_in_place = mock_coroutine(changes)
+        async with Reloadable(kernel_mock, in_place=True) as reloadable:
+            kernel_mock.__aenter__.reset_mock()
+            assert await reloadable.reload() is changes
+            kernel_mock.__aexit__.assert_not_called()
+            kernel_mock.__aenter__.assert_not_called()
+
+    async def test_calls_on_reloaded_before_opening_gate(self):
+        changes = ChangeSet(changed={'a'})
+        kernel_mock = KernelMock()
+        kernel_mock.reload_in_place = mock_coroutine(changes)
+        async with Reloadable(kernel_mock, in_place=True) as reloadable:
+            calls = []
+
+            def on_reloaded(changes):
+                calls.append((changes, reloadable.gate.n_writers))
+            await reloadable.reload(on_reloaded=on_reloaded)
+            assert calls == [(changes, 1)]
+
+    async def test_skips_on_reloaded_if_reload_fails(self):
+        kernel_mock = KernelMock()
+        async with Reloadable(kernel_mock) as reloadable:
+            kernel_mock.__aenter__ = mock.MagicMock(side_effect=RuntimeError)
+            on_reloaded = mock.MagicMock()
+            with pytest.raises(RuntimeError):
+                await reloadable.reload(on_reloaded=on_reloaded)
+            on_reloaded.assert_not_called()
+
+    async def test_counts_generations_of_changed_objects(self):
+        kernel_mock = KernelMock()
+        kernel_mock.reload_in_place = mock_coroutine(ChangeSet())
+        async with Reloadable(kernel_mock, in_place=True) as reloadable:
+            await reloadable.reload()
+            assert reloadable.generation == 0
+            await reloadable.reload(restart=True)
+            assert reloadable.generation == 1
+
+    async def test_reloads_in_place_with_unknown_changes(self):
+        kernel_mock = KernelMock()
+        kernel_mock.reload_in_place = mock_coroutine(None)
+        async with Reloadable(kernel_mock, in_place=True) as reloadable:
+            kernel_mock.__aenter__.reset_mock()
+            assert await reloadable.reload() is None
+            assert reloadable.generation == 1
+            kernel_mock.__aexit__.assert_not_called()
+            kernel_mock.__aenter__.assert_not_called()
+
+    async def test_restarts_if_in_place_reload_fails(self):
+        kernel_mock = KernelMock()
+        kernel_mock.reload_in_place = mock.MagicMock(
+                side_effect=InPlaceReloadError())
+        async with Reloadable(kernel_mock, in_place=True) as reloadable:
+            kernel_mock.__aenter__.reset_mock()
+            assert await reloadable.reload() is None
+            kernel_mock.__aexit__.assert_called_once()
+            kernel_mock.__aenter__.assert_called_once()
+
     async def test_forwards_calls(self):
         kernel_mock = KernelMock()
         async with Reloadable(kernel_mock) as reloadable:
@@ -190,6 +562,29 @@ class TestReloadable(object):
             await call_task
             kernel_mock.fn.assert_called_once()
 
+    async def test_queues_call_until_entered(self):
+        pass_enter = asyncio.Event()
+        fn = mock.MagicMock()
+
+        class SlowToEnter(object):
+            async def __aenter__(self):
+                await pass_enter.wait()
+
+            async def __aexit__(self, exc_type, exc, tb):
+                pass
+
+        reloadable = Reloadable(SlowToEnter())
+        enter_task = asyncio.get_event_loop().create_task(
+                reloadable.__aenter__())
+        await asyncio.sleep(0)
+        call_task = asyncio.get_event_loop().create_task(reloadable.call(fn))
+        await asyncio.sleep(0)
+        fn.assert_not_called()
+        pass_enter.set()
+        await enter_task
+        await call_task
+        fn.assert_called_once()
+
     async def test_queues_reload_until_calls_finished(self):
         cont = asyncio.Event()
         async def fn():
@@ -208,13 +603,86 @@ class TestReloadable(object):
             await reload_task
             kernel_mock.__aexit__.assert_called_once()
 
-    async def test_is_observable(self):
-        observable_mock = mock.MagicMock()
+    async def test_queues_new_calls_behind_pending_reload(self):
+        cont = asyncio.Event()
+        async def fn():
+            await cont.wait()
+
         kernel_mock = KernelMock()
         async with Reloadable(kernel_mock) as reloadable:
-            reloadable.subscribe(observable_mock)
+            kernel_mock.__aexit__.reset_mock()
+            first_call = asyncio.get_event_loop().create_task(
+                    reloadable.call(fn))
+            await asyncio.sleep(0)
+            reload_task = asyncio.get_event_loop().create_task(
+                    reloadable.reload())
+            await asyncio.sleep(0)
+            second_call = asyncio.get_event_loop().create_task(
+                    reloadable.call(kernel_mock.fn))
+            await asyncio.sleep(0)
+            kernel_mock.fn.assert_not_called()
+
+            cont.set()
+            await asyncio.gather(first_call, reload_task, second_call)
+            kernel_mock.__aexit__.assert_called_once()
+            kernel_mock.fn.assert_called_once()
+            assert reloadable.gate.read_wait.count == 1
+
+    async def test_drains_ongoing_calls(self):
+        cont = asyncio.Event()
+        async def fn():
+            await cont.wait()
+
+        async with Reloadable(KernelMock()) as reloadable:
+            call_task = asyncio.get_event_loop().create_task(
+                    reloadable.call(fn))
+            await asyncio.sleep(0)
+            assert not await reloadable.drain(timeout=0.01)
+            cont.set()
+            assert await reloadable.drain(timeout=1)
+            await call_task
+
+    async def test_stops_new_calls_when_drained(self):
+        fn = mock.MagicMock()
+        async with Reloadable(KernelMock()) as reloadable:
+            assert await reloadable.drain(timeout=1)
+            call_task = asyncio.get_event_loop().create_task(
+                    reloadable.call(fn))
+            await asyncio.sleep(0.01)
+            fn.assert_not_called()
+            call_task.cancel()
+
+    async def test_publishes_reloads(self):
+        kernel_mock = KernelMock()
+        async with Reloadable(kernel_mock) as reloadable:
+            reloads = reloadable.listen()
+            await reloadable.reload()
+            assert await reloads.__anext__() is None
+        with pytest.raises(StopAsyncIteration):
+            await reloads.__anext__()
+
+    async def test_merges_unconsumed_change_sets(self):
+        kernel_mock = KernelMock()
+        kernel_mock.reload_in_place = mock.MagicMock(side_effect=[
+            create_stub_future(ChangeSet(changed={'a'})),
+            create_stub_future(ChangeSet(added={'b'}))])
+        async with Reloadable(kernel_mock, in_place=True) as reloadable:
+            reloads = reloadable.listen()
             await reloadable.reload()
-            observable_mock.on_next.assert_called_once()
+            await reloadable.reload()
+            assert await reloads.__anext__() == ChangeSet(
+                    added={'b'}, changed={'a'})
+
+    async def test_publishes_reloads_after_opening_gate(self):
+        kernel_mock = KernelMock()
+        async with Reloadable(kernel_mock) as reloadable:
+            n_writers = []
+
+            async def notify(changes):
+                n_writers.append(reloadable.gate.n_writers)
+            reloadable._notify_observers = notify
+            await reloadable.reload()
+            assert n_writers == [0]
 
 
 class TestSubscribableKernel(object):
@@ -247,3 +715,35 @@ class TestSubscribableKernel(object):
 
         dummy.fn.assert_called_once_with(1, 2, three=3)
         observer.on_next.assert_called_once_with(42)
+
+    async def test_skips_subscribers_on_empty_change_set(self):
+        dummy = mock.MagicMock()
+        dummy.__aenter__ = mock_coroutine(self)
+        dummy.__aexit__ = mock_coroutine(None)
+        dummy.reload_in_place = mock_coroutine(ChangeSet())
+        observer = mock.MagicMock()
+
+        async with Subscribable(dummy, in_place=True) as subscribable:
+            await subscribable.subscribe(observer, dummy.fn)
+            dummy.fn.reset_mock()
+            await subscribable.reload()
+
+        dummy.fn.assert_not_called()
+
+    async def test_unsubscribed_observers_are_not_notified(self):
+        dummy = mock.MagicMock()
+        dummy.__aenter__ = mock_coroutine(self)
+        dummy.__aexit__ = mock_coroutine(None)
+        observers = [mock.MagicMock() for _ in range(5)]
+
+        async with Subscribable(dummy, chunk_size=2) as subscribable:
+            subscriptions = [
+                await subscribable.subscribe(o, dummy.fn) for o in observers]
+            for subscription in subscriptions[1::2]:
+                subscribable.unsubscribe(subscription)
+            for observer in observers:
+                observer.on_next.reset_mock()
+            await subscribable.reload()
+
+        for i, observer in enumerate(observers):
+            assert observer.on_next.called == (i % 2 == 0)
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import tracemalloc
+from unittest import mock
+
+import graphene
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application
+
+from nengonized_server.app import QueryHandler, SubscriptionHandler
+from nengonized_server.gate import RwGate
+from nengonized_server.memory import (
+        AllocationTracer, MemoryHandler, MemorySampler)
+from nengonized_server.scheduling import QueryScheduler
+
+
+class GqlDummyRoot(graphene.ObjectType):
+    value = graphene.String()
+
+    def resolve_value(self, info):
+        return 'foo'
+
+
+dummySchema = graphene.Schema(query=GqlDummyRoot)
+
+
+def create_handler(type_, **kwargs):
+    return type_(mock.MagicMock(), mock.MagicMock(), **kwargs)
+
+
+def usage(outbound=0, last_result=0):
+    return {
+        'type': 'Handler', 'outboundBytes': outbound,
+        'lastResultBytes': last_result, 'pendingWrites': 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_handler_accounts_pending_bytes():
+    handler = create_handler(
+            QueryHandler, context=mock.MagicMock(), schema=dummySchema)
+    future = asyncio.get_running_loop().create_future()
+    handler.write_message = mock.MagicMock(return_value=future)
+
+    handler.send('12345')
+    assert handler.memory_usage()['outboundBytes'] == 5
+    assert handler.memory_usage()['pendingWrites'] == 1
+
+    future.set_result(None)
+    await asyncio.sleep(0)
+    assert handler.memory_usage()['outboundBytes'] == 0
+    assert handler.memory_usage()['pendingWrites'] == 0
+
+
+@pytest.mark.asyncio
+async def test_subscription_handler_accounts_result_sizes():
+    handler = create_handler(
+            SubscriptionHandler, context=mock.MagicMock(), schema=dummySchema)
+    handler.write_message = mock.MagicMock()
+    handler.subscriptions = {'a': mock.MagicMock(), 'b': mock.MagicMock()}
+    result = dummySchema.execute('{ value }')
+
+    handler.update(result, 'a')
+    assert handler.result_sizes == {'a': len('{"value": "foo"}')}
+
+    handler.configure(multiplex=True)
+    handler.update(result, 'a')
+    handler.update(result, 'b')
+    await handler.flush_writes()
+    message = json.dumps({'a': result.data, 'b': result.data})
+    assert handler.result_sizes == {
+        'a': len(message) // 2, 'b': len(message) // 2}
+    assert handler.memory_usage()['lastResultBytes'] == (
+            2 * (len(message) // 2))
+
+    handler.unsubscribe('a')
+    assert set(handler.memory_usage()['subscriptions']) == {'b'}
+
+
+@pytest.mark.asyncio
+async def test_sampler_closes_connections_over_budget():
+    small = mock.MagicMock()
+    small.memory_usage.return_value = usage(outbound=10, last_result=100)
+    large = mock.MagicMock()
+    large.memory_usage.return_value = usage(outbound=100, last_result=10)
+    sampler = MemorySampler([small, large], connection_budget=50)
+
+    report = sampler.sample()
+    assert report['process']['connections'] == 2
+    small.close.assert_not_called()
+    large.close.assert_called_once_with(1009, mock.ANY)
+    assert sampler.n_closed == 1
+
+
+@pytest.mark.asyncio
+async def test_sampler_closes_largest_connection_over_process_budget():
+    connections = [mock.MagicMock() for _ in range(3)]
+    for i, connection in enumerate(connections):
+        connection.memory_usage.return_value = usage(
+                outbound=[50, 400, 100][i])
+    sampler = MemorySampler(connections, process_budget=1000)
+
+    with mock.patch(
+            'nengonized_server.memory.process_memory', return_value=2000):
+        sampler.sample()
+    connections[0].close.assert_not_called()
+    connections[1].close.assert_called_once()
+    connections[2].close.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_sampler_keeps_connections_small_relative_to_overage():
+    connection = mock.MagicMock()
+    connection.memory_usage.return_value = usage(outbound=10)
+    sampler = MemorySampler([connection], process_budget=1000)
+
+    with mock.patch(
+            'nengonized_server.memory.process_memory', return_value=2000):
+        sampler.sample()
+    connection.close.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_sampler_reports_scheduler_and_gate_metrics():
+    scheduler = QueryScheduler()
+    gate = RwGate()
+    await gate.acquire_read()
+    gate.release_read()
+    report = MemorySampler(scheduler=scheduler, gate=gate).sample()
+    assert report['scheduler'] == scheduler.metrics()
+    assert report['gate']['read_wait']['count'] == 0
+    assert report['gate']['readers'] == 0
+
+
+@pytest.mark.asyncio
+async def test_allocation_tracer_reports_growth():
+    tracer = AllocationTracer()
+    try:
+        assert tracer.diff() == []
+        retained = [bytearray(1024) for _ in range(100)]
+        stats = tracer.diff()
+        assert sum(s['sizeDiff'] for s in stats) >= 100 * 1024
+        assert all('location' in s for s in stats)
+    finally:
+        tracer.stop()
+    del retained
+
+
+@pytest.mark.asyncio
+async def test_allocation_tracer_stops_after_timeout():
+    tracer = AllocationTracer(timeout=0.01)
+    tracer.diff()
+    assert tracemalloc.is_tracing()
+    await asyncio.sleep(0.02)
+    assert not tracemalloc.is_tracing()
+
+
+@pytest.fixture
+async def memory_endpoint():
+    servers = []
+
+    def start(sampler):
+        app = Application([(r"/memory", MemoryHandler, {'sampler': sampler})])
+        sock, port = bind_unused_port()
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        servers.append(server)
+        return f'http://127.0.0.1:{port}/memory'
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.mark.asyncio
+async def test_memory_endpoint(memory_endpoint):
+    sampler = MemorySampler(diagnostics=True)
+    url = memory_endpoint(sampler)
+    response = await AsyncHTTPClient().fetch(url + '?objects')
+    report = json.loads(response.body)
+    assert report['connections'] == []
+    assert report['process']['subscriptions'] == 0
+    assert 'objects' in report
+    assert sampler.latest is not None
+
+    await AsyncHTTPClient().fetch(url + '?allocations')
+    assert tracemalloc.is_tracing()
+    await AsyncHTTPClient().fetch(url + '?allocations=stop')
+    assert not tracemalloc.is_tracing()
+
+
+@pytest.mark.asyncio
+async def test_memory_endpoint_rejects_diagnostics_by_default(
+        memory_endpoint):
+    url = memory_endpoint(MemorySampler())
+    for query in ('?objects', '?allocations'):
+        response = await AsyncHTTPClient().fetch(
+                url + query, raise_error=False)
+        assert response.code == 403
+    assert not tracemalloc.is_tracing()
+    response = await AsyncHTTPClient().fetch(url)
+    assert response.code == 200
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from nengonized_server.model_cache import ModelCache
+
+
+@pytest.fixture
+def model(tmpdir):
+    model = tmpdir.join('model.py')
+    model.write('model = 1')
+    return model
+
+
+def build(entry, size=100):
+    with open(os.path.join(entry, 'model.pkl'), 'wb') as f:
+        f.write(b'x' * size)
+
+
+def test_hits_after_commit(tmpdir, model):
+    cache = ModelCache(str(tmpdir.join('cache')), 1024)
+    entry, hit = cache.prepare(str(model))
+    assert not hit
+    build(entry)
+    cache.commit(entry)
+
+    assert cache.prepare(str(model)) == (entry, True)
+
+
+def test_has_entry_only_after_commit(tmpdir, model):
+    cache = ModelCache(str(tmpdir.join('cache')), 1024)
+    entry, _ = cache.prepare(str(model))
+    assert not cache.has_entry(str(model))
+    cache.commit(entry)
+    assert cache.has_entry(str(model))
+
+
+def test_misses_uncommitted_entry(tmpdir, model):
+    cache = ModelCache(str(tmpdir.join('cache')), 1024)
+    entry, _ = cache.prepare(str(model))
+    build(entry)
+    assert cache.prepare(str(model)) == (entry, False)
+    assert os.listdir(entry) == []
+
+
+def test_invalidates_entry_on_changed_dependency(tmpdir, model):
+    dependency = tmpdir.join('dep.py')
+    dependency.write('a')
+    cache = ModelCache(str(tmpdir.join('cache')), 1024)
+    entry, _ = cache.prepare(str(model))
+    cache.commit(entry, [str(dependency)])
+    assert cache.prepare(str(model))[1]
+
+    dependency.write('b')
+    assert not cache.prepare(str(model))[1]
+
+
+def test_keys_by_content(tmpdir, model):
+    cache = ModelCache(str(tmpdir.join('cache')), 1024)
+    entry, _ = cache.prepare(str(model))
+    cache.commit(entry)
+
+    model.write('model = 2')
+    assert not cache.prepare(str(model))[1]
+    model.write('model = 1')
+    assert cache.prepare(str(model)) == (entry, True)
+
+
+def test_evicts_least_recently_used(tmpdir):
+    cache = ModelCache(str(tmpdir.join('cache')), 1024)
+    entries = []
+    for i in range(3):
+        model = tmpdir.join(f'model{i}.py')
+        model.write(str(i))
+        entry, _ = cache.prepare(str(model))
+        build(entry)
+        cache.commit(entry)
+        os.utime(os.path.join(entry, 'manifest.json'), (i, i))
+        entries.append(entry)
+
+    cache.prepare(str(tmpdir.join('model0.py')))  # marks model0 as used
+    cache.max_size = 250
+    cache.evict()
+    assert os.path.exists(entries[0])
+    assert not os.path.exists(entries[1])
+    assert os.path.exists(entries[2])
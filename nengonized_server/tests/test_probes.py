@@ -0,0 +1,210 @@
+from array import array
+import asyncio
+import json
+import struct
+from unittest import mock
+
+import pytest
+
+from nengonized_server.probes import (
+        Downsampler, encode_frame, merge_samples, ProbeFeed, ProbeSamples,
+        ProbeSubscription)
+from nengonized_server.shared_buffers import SharedBufferArea
+from nengonized_server.streams import Broadcast
+
+
+def samples(step, dimensions, values):
+    return ProbeSamples(step, dimensions, array('d', values))
+
+
+class ReloadableStub(object):
+    def __init__(self):
+        self.reloads = Broadcast()
+
+    def listen(self):
+        return self.reloads.listen()
+
+    async def call(self, method, *args, **kwargs):
+        return await method(*args, **kwargs)
+
+
+class KernelStub(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.queries = []
+
+    async def query(self, query_text, variables=None, **kwargs):
+        self.queries.append(variables)
+        return json.dumps(self.responses.pop(0))
+
+
+def test_merges_continuing_samples():
+    merged = merge_samples(
+            {'a': samples(0, 1, [1, 2]), 'b': samples(0, 1, [1])},
+            {'a': samples(2, 1, [3]), 'c': samples(0, 1, [4])})
+    assert merged == {
+        'a': samples(0, 1, [1, 2, 3]),
+        'b': samples(0, 1, [1]),
+        'c': samples(0, 1, [4]),
+    }
+
+
+def test_replaces_discontinuous_samples():
+    merged = merge_samples(
+            {'a': samples(5, 1, [1, 2])}, {'a': samples(0, 1, [3])})
+    assert merged == {'a': samples(0, 1, [3])}
+
+
+class TestDownsampler(object):
+    def test_decimates(self):
+        downsampler = Downsampler(2)
+        assert downsampler.push(samples(0, 2, [0, 10, 1, 11, 2, 12])) == (
+                samples(0, 2, [0, 10]))
+        assert downsampler.push(samples(3, 2, [3, 13, 4, 14, 5, 15])) == (
+                samples(2, 2, [2, 12, 4, 14]))
+
+    def test_min_max_downsamples(self):
+        downsampler = Downsampler(3, mode=Downsampler.MINMAX)
+        assert downsampler.push(samples(0, 2, [1, 5, 3, 4])) is None
+        assert downsampler.push(samples(2, 2, [2, 6])) == (
+                samples(0, 4, [1, 3, 4, 6]))
+
+    def test_derives_factor_from_window(self):
+        assert Downsampler.for_window(1000, 300).factor == 4
+        assert Downsampler.for_window(10, 300).factor == 1
+
+    def test_drops_pending_samples_on_discontinuity(self):
+        downsampler = Downsampler(2)
+        assert downsampler.push(samples(10, 1, [1])) is None
+        assert downsampler.push(samples(0, 1, [2, 3])) == samples(0, 1, [2])
+
+
+def test_encodes_frame():
+    frame = encode_frame('sub', 4, samples(8, 2, [1., 2.]))
+    assert frame[:5] == b'\x03\x00sub'
+    assert struct.unpack('<qII', frame[5:21]) == (8, 4, 2)
+    assert struct.unpack('<2d', frame[21:]) == (1., 2.)
+
+
+@pytest.mark.asyncio
+async def test_feed_polls_kernel_and_publishes_samples():
+    area = SharedBufferArea(16)
+    area.mmap[0:16] = array('d', [3., 4.]).tobytes()
+    kernel = KernelStub([
+        {'probeData': [
+            {'probe': 'a', 'step': 0, 'dimensions': 1, 'samples': [1., 2.]}]},
+        {'probeData': [{
+            'probe': 'a', 'step': 2, 'dimensions': 1,
+            'samples': {'__buffer__': {'offset': 0, 'length': 16}}}]},
+    ])
+    feed = ProbeFeed(ReloadableStub(), kernel, shared_buffers=area)
+    channel = feed.listen()
+
+    await feed.poll()
+    await feed.poll()
+    assert kernel.queries == [{'since': -1}, {'since': 1}]
+    assert await channel.__anext__() == {'a': samples(0, 1, [1, 2, 3, 4])}
+    area.close()
+
+
+@pytest.mark.asyncio
+async def test_subscription_sends_downsampled_frames():
+    kernel = KernelStub([{'probeData': [
+        {'probe': 'a', 'step': 0, 'dimensions': 1, 'samples': [1., 2., 3.]},
+        {'probe': 'b', 'step': 0, 'dimensions': 1, 'samples': [4.]},
+    ]}])
+    feed = ProbeFeed(ReloadableStub(), kernel)
+    send = mock.MagicMock()
+    subscription = ProbeSubscription('1', feed, 'a', Downsampler(2), send)
+
+    await feed.poll()
+    await asyncio.sleep(0)
+    send.assert_called_once_with(
+            encode_frame('1', 2, samples(0, 1, [1.])), binary=True)
+    subscription.dispose()
+
+
+@pytest.mark.asyncio
+async def test_feed_resets_since_on_reload():
+    kernel = KernelStub([
+        {'probeData': [
+            {'probe': 'a', 'step': 0, 'dimensions': 1, 'samples': [1., 2.]}]},
+        {'probeData': []},
+    ])
+    reloadable = ReloadableStub()
+    feed = ProbeFeed(reloadable, kernel, interval=10.)
+    feed.start()
+    await feed.poll()
+    assert feed.since == 1
+
+    reloadable.reloads.publish(None)
+    await asyncio.sleep(0)
+    assert feed.since == -1
+    await feed.poll()
+    assert kernel.queries == [{'since': -1}, {'since': -1}]
+    await feed.stop()
+    assert reloadable.reloads.n_listeners == 0
+
+
+@pytest.mark.asyncio
+async def test_feed_ignores_polls_started_before_reset():
+    kernel = KernelStub([{'probeData': [
+        {'probe': 'a', 'step': 5, 'dimensions': 1, 'samples': [1.]}]}])
+    feed = ProbeFeed(ReloadableStub(), kernel)
+    query = kernel.query
+
+    async def reset_during_query(*args, **kwargs):
+        feed.reset()
+        return await query(*args, **kwargs)
+    kernel.query = reset_during_query
+
+    await feed.poll()
+    assert feed.since == -1
+
+
+@pytest.mark.asyncio
+async def test_feed_backs_off_while_polling_fails():
+    kernel = mock.MagicMock()
+    kernel.query = mock.AsyncMock(side_effect=ConnectionError("down"))
+    feed = ProbeFeed(
+            ReloadableStub(), kernel, interval=0.01, max_backoff=0.04)
+    channel = feed.listen()
+    feed.start()
+    await asyncio.sleep(0.2)
+    await feed.stop()
+    channel.close()
+    assert 3 <= kernel.query.call_count <= 8
+
+
+@pytest.mark.asyncio
+async def test_feed_skips_overwritten_samples():
+    area = SharedBufferArea(24)
+    area.mmap[0:8] = struct.pack('<Q', 2)
+    kernel = KernelStub([{'probeData': [{
+        'probe': 'a', 'step': 0, 'dimensions': 1,
+        'samples': {'__buffer__': {
+            'offset': 8, 'length': 16, 'generation': 1}}}]}])
+    feed = ProbeFeed(ReloadableStub(), kernel, shared_buffers=area)
+    channel = feed.listen()
+
+    await feed.poll()
+    assert feed.since == -1
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(channel.__anext__(), 0.01)
+    channel.close()
+    area.close()
+
+
+@pytest.mark.asyncio
+async def test_feed_skips_buffer_handles_without_area():
+    kernel = KernelStub([{'probeData': [{
+        'probe': 'a', 'step': 0, 'dimensions': 2,
+        'samples': {'__buffer__': {'offset': 0, 'length': 32}}}]}])
+    feed = ProbeFeed(ReloadableStub(), kernel)
+    channel = feed.listen()
+
+    await feed.poll()
+    assert feed.since == 1
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(channel.__anext__(), 0.01)
+    channel.close()
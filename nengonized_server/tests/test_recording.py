@@ -0,0 +1,177 @@
+import json
+import math
+from unittest import mock
+
+import graphene
+import pytest
+from tornado.web import Application
+
+from nengonized_server.app import QueryHandler
+from nengonized_server.changes import ChangeSet
+from nengonized_server.kernel_management import InPlaceReloadError
+from nengonized_server.recording import (
+        compare_reports, read_trace, RecordingKernel, replay, ReplayKernel,
+        ReplayReport, TraceRecorder)
+
+
+class KernelRoot(graphene.ObjectType):
+    value = graphene.String()
+
+    async def resolve_value(self, info):
+        return await info.context.kernel.query('{ value }')
+
+
+kernelSchema = graphene.Schema(query=KernelRoot)
+
+
+def make_test_app(context):
+    return Application([(r"/graphql", QueryHandler, {
+        'context': context, 'schema': kernelSchema})])
+
+
+@pytest.mark.asyncio
+async def test_trace_round_trip(tmpdir):
+    path = str(tmpdir.join('trace.gz'))
+    clock = mock.MagicMock(side_effect=[10., 10.5, 11.])
+    recorder = TraceRecorder(path, clock=clock)
+    assert recorder.open_connection('/graphql') == 0
+    recorder.record('message', connection=0, message='{}')
+    await recorder.flush()
+    recorder.close()
+
+    assert list(read_trace(path)) == [
+        (0.5, 'open', {'connection': 0, 'path': '/graphql'}),
+        (1., 'message', {'connection': 0, 'message': '{}'}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_recording_kernel_records_round_trips():
+    kernel = mock.MagicMock()
+
+    async def query(query_text, variables=None):
+        return '{"value": 1}'
+    kernel.query = query
+    recorder = mock.MagicMock()
+
+    response = await RecordingKernel(kernel, recorder).query(
+            '{ value }', {'a': 1})
+    assert response == '{"value": 1}'
+    recorder.record.assert_called_once_with(
+            'kernel', query='{ value }', variables={'a': 1},
+            response='{"value": 1}', duration=mock.ANY)
+
+
+@pytest.mark.asyncio
+async def test_handler_records_connection_and_messages():
+    recorder = mock.MagicMock()
+    recorder.open_connection.return_value = 3
+    handler = QueryHandler(
+            mock.MagicMock(), mock.MagicMock(), context=mock.MagicMock(),
+            schema=mock.MagicMock(), recorder=recorder)
+    handler.execute = mock.AsyncMock(return_value=mock.MagicMock(data=None))
+    handler.write_message = mock.MagicMock()
+
+    handler.open()
+    message = json.dumps({'query': '{ value }', 'variables': None})
+    await handler.on_message(message)
+    handler.on_close()
+
+    recorder.open_connection.assert_called_once_with(handler.request.path)
+    assert recorder.record.call_args_list == [
+        mock.call('message', connection=3, message=message),
+        mock.call('close', connection=3),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_replay_kernel_answers_in_recorded_order():
+    kernel = ReplayKernel([
+        (0., 'kernel', {
+            'query': 'q', 'variables': None, 'response': '1',
+            'duration': 0.}),
+        (1., 'kernel', {
+            'query': 'q', 'variables': None, 'response': '2',
+            'duration': 0.}),
+    ])
+    assert await kernel.query('q') == '1'
+    assert await kernel.query('q') == '2'
+    assert await kernel.query('q') == '2'
+    assert await kernel.query('other') == '{}'
+    assert kernel.n_missing == 1
+
+
+@pytest.mark.asyncio
+async def test_replay_kernel_reloads_as_recorded(tmpdir):
+    path = str(tmpdir.join('trace.gz'))
+    recorder = TraceRecorder(path)
+    recorder.record_reload(ChangeSet(changed={'b', 'a'}))
+    recorder.record_reload(None)
+    await recorder.flush()
+    recorder.close()
+
+    kernel = ReplayKernel(read_trace(path))
+    assert await kernel.reload_in_place() == ChangeSet(changed={'a', 'b'})
+    with pytest.raises(InPlaceReloadError):
+        await kernel.reload_in_place()
+    with pytest.raises(InPlaceReloadError):
+        await kernel.reload_in_place()
+
+
+def test_report_statistics():
+    report = ReplayReport([0.3, 0.1, 0.2, 0.4], n_received=8, duration=2.)
+    data = report.to_dict()
+    assert data['throughput'] == 4.
+    assert data['latency']['p50'] == 0.2
+    assert data['latency']['max'] == 0.4
+    assert data['latency']['mean'] == pytest.approx(0.25)
+
+
+def test_compare_reports():
+    baseline = ReplayReport([0.1, 0.2], 4, 2.).to_dict()
+    current = ReplayReport([0.2, 0.4], 4, 1.).to_dict()
+    deltas = compare_reports(baseline, current)
+    assert deltas['throughput'] == pytest.approx(1.)
+    assert deltas['latency.max'] == pytest.approx(1.)
+    assert compare_reports(
+        ReplayReport([], 0, 1.).to_dict(), current)['latency.p50'] is None
+
+
+@pytest.mark.asyncio
+async def test_replay_measures_latency():
+    events = [
+        (0., 'open', {'connection': 0, 'path': '/graphql'}),
+        (0.1, 'message', {
+            'connection': 0,
+            'message': json.dumps({'query': '{ value }', 'variables': None}),
+        }),
+        (0.2, 'kernel', {
+            'query': '{ value }', 'variables': None, 'response': 'foo',
+            'duration': 10.}),
+        (0.3, 'close', {'connection': 0}),
+    ]
+    report = await replay(events, speed=math.inf, app_factory=make_test_app)
+    assert report.n_received == 1
+    assert len(report.latencies) == 1
+    assert report.n_missing == 0
+
+
+@pytest.mark.asyncio
+async def test_replay_wires_context_like_server():
+    contexts = []
+
+    def app_factory(context):
+        contexts.append(context)
+        return make_test_app(context)
+
+    events = [
+        (0., 'file_change', {'filename': 'model.py'}),
+        (0., 'reload', {
+            'changes': {'added': [], 'removed': [], 'changed': ['a']}}),
+    ]
+    await replay(events, speed=math.inf, app_factory=app_factory)
+    context, = contexts
+    assert context.reloadable.in_place
+    assert context.reloadable.generation == 1
+    assert context.admission is not None
+    assert context.active_queries is not None
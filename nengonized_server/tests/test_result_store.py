@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+from nengonized_server.result_store import (
+        file_hash, normalize_query, ResultStore)
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('results.bin'))
+
+
+def test_normalizes_query_formatting():
+    assert normalize_query('{ a { b } }') == normalize_query('{a{b}}')
+    assert normalize_query('{ a }', {'x': 1}) != normalize_query('{ a }')
+    assert normalize_query('{ a') is None
+
+
+def test_hashes_file_content(tmpdir):
+    filename = tmpdir.join('model.py')
+    filename.write('a')
+    a = file_hash(str(filename))
+    filename.write('b')
+    assert file_hash(str(filename)) != a
+
+
+def test_returns_latest_result_for_current_tag(path):
+    store = ResultStore(path, tag='v1')
+    assert store.get('q') is None
+    store.put('q', {'value': 1})
+    store.put('q', {'value': 2})
+    assert store.get('q') == {'value': 2}
+
+    store.tag = 'v2'
+    assert store.get('q') is None
+    store.close()
+
+
+def test_persists_results(path):
+    store = ResultStore(path, tag='v1')
+    store.put('q', {'value': 1})
+    store.put('r', {'value': 2})
+    store.close()
+
+    store = ResultStore(path, tag='v1')
+    assert store.get('q') == {'value': 1}
+    assert store.get('r') == {'value': 2}
+    store.close()
+
+
+def test_ignores_partially_written_record(path):
+    store = ResultStore(path, tag='v1')
+    store.put('q', {'value': 1})
+    store.close()
+    with open(path, 'ab') as f:
+        f.write(b'\x00\x00\x00\x01')
+
+    store = ResultStore(path, tag='v1')
+    assert store.get('q') == {'value': 1}
+    store.put('r', {'value': 2})
+    store.close()
+    store = ResultStore(path, tag='v1')
+    assert store.get('r') == {'value': 2}
+    store.close()
+
+
+def test_compacts_superseded_results(path):
+    store = ResultStore(path, tag='v1', min_compact_size=0)
+    store.put('q', {'value': 0})
+    record_size = os.path.getsize(path)
+    for i in range(1, 10):
+        store.put('q', {'value': i})
+    assert os.path.getsize(path) <= 2 * record_size
+    assert store.get('q') == {'value': 9}
+    store.close()
+
+
+@pytest.mark.asyncio
+async def test_writes_batches_in_executor(path):
+    store = ResultStore(path, tag='v1')
+    store.put('q', {'value': 1})
+    store.put('q', {'value': 2})
+    store.put('r', {'value': 3})
+    assert os.path.getsize(path) == 0
+    assert store.get('q') == {'value': 2}
+
+    await store.flush()
+    assert store.get('q') == {'value': 2}
+    store.close()
+    store = ResultStore(path, tag='v1')
+    assert store.get('q') == {'value': 2}
+    assert store.get('r') == {'value': 3}
+    store.close()
+
+
+@pytest.mark.asyncio
+async def test_compacts_in_executor(path):
+    store = ResultStore(path, tag='v1', min_compact_size=0)
+    store.put('q', {'value': 0})
+    await store.flush()
+    record_size = os.path.getsize(path)
+    for i in range(1, 10):
+        store.put('q', {'value': i})
+        await store.flush()
+    assert os.path.getsize(path) <= 2 * record_size
+    assert store.get('q') == {'value': 9}
+    store.close()
@@ -0,0 +1,181 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from nengonized_server.async_testing import mock_coroutine
+from nengonized_server.scheduling import (
+        Priority, QueryScheduler, ScheduledKernel)
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class Recorder(object):
+    def __init__(self):
+        self.order = []
+        self.block = asyncio.Event()
+
+    async def blocking(self):
+        await self.block.wait()
+
+    async def record(self, name):
+        self.order.append(name)
+
+
+async def run_all(scheduler, recorder, jobs):
+    blocker = asyncio.get_running_loop().create_task(
+            scheduler.run(recorder.blocking))
+    await asyncio.sleep(0)
+    tasks = [
+        asyncio.get_running_loop().create_task(scheduler.run(
+            recorder.record, name, priority=priority, client=client))
+        for name, priority, client in jobs]
+    await asyncio.sleep(0)
+    recorder.block.set()
+    await asyncio.gather(blocker, *tasks)
+
+
+async def test_forwards_calls():
+    fn = mock.MagicMock(return_value=42)
+    assert await QueryScheduler().run(fn, 1, kwarg=2) == 42
+    fn.assert_called_once_with(1, kwarg=2)
+
+
+async def test_runs_higher_priorities_first():
+    recorder = Recorder()
+    await run_all(QueryScheduler(), recorder, [
+        ('background', Priority.BACKGROUND, None),
+        ('subscription', Priority.SUBSCRIPTION, None),
+        ('interactive', Priority.INTERACTIVE, None),
+    ])
+    assert recorder.order == ['interactive', 'subscription', 'background']
+
+
+async def test_queues_fairly_across_clients():
+    recorder = Recorder()
+    await run_all(QueryScheduler(), recorder, [
+        ('a1', Priority.SUBSCRIPTION, 'a'),
+        ('a2', Priority.SUBSCRIPTION, 'a'),
+        ('a3', Priority.SUBSCRIPTION, 'a'),
+        ('b1', Priority.SUBSCRIPTION, 'b'),
+        ('b2', Priority.SUBSCRIPTION, 'b'),
+    ])
+    assert recorder.order == ['a1', 'b1', 'a2', 'b2', 'a3']
+
+
+async def test_weights_clients():
+    recorder = Recorder()
+    await run_all(QueryScheduler(weights={'a': 2.}), recorder, [
+        ('a1', Priority.SUBSCRIPTION, 'a'),
+        ('a2', Priority.SUBSCRIPTION, 'a'),
+        ('a3', Priority.SUBSCRIPTION, 'a'),
+        ('a4', Priority.SUBSCRIPTION, 'a'),
+        ('b1', Priority.SUBSCRIPTION, 'b'),
+        ('b2', Priority.SUBSCRIPTION, 'b'),
+    ])
+    assert recorder.order == ['a1', 'a2', 'b1', 'a3', 'a4', 'b2']
+
+
+async def test_limits_concurrency_per_client():
+    scheduler = QueryScheduler(max_concurrency=2, client_quota=1)
+    block = asyncio.Event()
+    fn_a = mock.MagicMock(side_effect=lambda: block.wait())
+    fn_b = mock.MagicMock(side_effect=lambda: block.wait())
+    tasks = [
+        asyncio.get_running_loop().create_task(scheduler.run(fn_a, client='a')),
+        asyncio.get_running_loop().create_task(scheduler.run(fn_a, client='a')),
+        asyncio.get_running_loop().create_task(scheduler.run(fn_b, client='b')),
+    ]
+    await asyncio.sleep(0)
+    assert fn_a.call_count == 1
+    assert fn_b.call_count == 1
+    block.set()
+    await asyncio.gather(*tasks)
+    assert fn_a.call_count == 2
+
+
+async def test_skips_cancelled_calls():
+    recorder = Recorder()
+    scheduler = QueryScheduler()
+    blocker = asyncio.get_running_loop().create_task(
+            scheduler.run(recorder.blocking))
+    await asyncio.sleep(0)
+    cancelled = asyncio.get_running_loop().create_task(
+            scheduler.run(recorder.record, 'cancelled'))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    recorder.block.set()
+    await blocker
+    assert await scheduler.run(recorder.record, 'next') is None
+    assert recorder.order == ['next']
+
+
+async def test_records_queue_times():
+    now = [0.]
+    scheduler = QueryScheduler(clock=lambda: now[0])
+    block = asyncio.Event()
+    blocker = asyncio.get_running_loop().create_task(
+            scheduler.run(block.wait))
+    await asyncio.sleep(0)
+    task = asyncio.get_running_loop().create_task(
+            scheduler.run(mock.MagicMock(), priority=Priority.INTERACTIVE))
+    await asyncio.sleep(0)
+    now[0] = 2.
+    block.set()
+    await asyncio.gather(blocker, task)
+
+    metrics = scheduler.metrics()
+    assert metrics['queue_time']['interactive'] == {
+            'count': 1, 'mean': 2., 'max': 2.}
+    assert metrics['running'] == 0
+
+
+async def test_scheduled_kernel_forwards_queries():
+    kernel = mock.MagicMock()
+    kernel.query = mock_coroutine('data')
+    scheduled = ScheduledKernel(kernel, QueryScheduler())
+    result = await scheduled.query(
+            '{ model { id } }', variables={'var': 'value'},
+            priority=Priority.INTERACTIVE, client='a')
+    assert result == 'data'
+    kernel.query.assert_called_once_with(
+            '{ model { id } }', variables={'var': 'value'})
+
+
+async def test_scheduled_kernel_shares_identical_queries():
+    recorder = Recorder()
+    kernel = mock.MagicMock()
+    kernel.query = mock.MagicMock(side_effect=lambda *args, **kwargs: (
+        recorder.blocking()))
+    scheduler = QueryScheduler()
+    scheduled = ScheduledKernel(kernel, scheduler)
+    tasks = [
+        asyncio.get_running_loop().create_task(scheduled.query(query))
+        for query in ('{ a }', '{ a }', '{ b }')]
+    await asyncio.sleep(0.01)
+    assert scheduler.metrics()['running'] == 1
+    assert scheduler.n_queued == 1
+    recorder.block.set()
+    await asyncio.gather(*tasks)
+    assert kernel.query.call_count == 2
+
+
+async def test_scheduled_kernel_cancels_shared_query_without_callers():
+    recorder = Recorder()
+    kernel = mock.MagicMock()
+    kernel.query = mock.MagicMock(side_effect=lambda *args, **kwargs: (
+        recorder.blocking()))
+    scheduler = QueryScheduler()
+    scheduled = ScheduledKernel(kernel, scheduler)
+    tasks = [
+        asyncio.get_running_loop().create_task(scheduled.query('{ a }'))
+        for _ in range(2)]
+    await asyncio.sleep(0.01)
+    tasks[0].cancel()
+    await asyncio.sleep(0.01)
+    assert scheduler.metrics()['running'] == 1
+    tasks[1].cancel()
+    await asyncio.sleep(0.01)
+    assert scheduler.metrics()['running'] == 0
+    assert not scheduled._pending
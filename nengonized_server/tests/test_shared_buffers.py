@@ -0,0 +1,85 @@
+import os
+import struct
+
+import pytest
+
+from nengonized_server.shared_buffers import (
+        extract_buffers, is_buffer_handle, SharedBufferArea)
+
+
+@pytest.fixture
+def area():
+    area = SharedBufferArea(64)
+    yield area
+    area.close()
+
+
+def handle(offset, length, **kwargs):
+    return {'__buffer__': dict(offset=offset, length=length, **kwargs)}
+
+
+def test_creates_and_removes_backing_file():
+    area = SharedBufferArea(64)
+    assert os.path.getsize(area.path) == 64
+    area.close()
+    assert not os.path.exists(area.path)
+
+
+def test_views_do_not_copy(area):
+    view = area.view(8, 4)
+    area.mmap[8:12] = b'abcd'
+    assert bytes(view) == b'abcd'
+
+
+def test_rejects_views_outside_of_area(area):
+    with pytest.raises(ValueError):
+        area.view(60, 8)
+
+
+def test_recognizes_buffer_handles():
+    assert is_buffer_handle(handle(0, 8))
+    assert not is_buffer_handle({'__buffer__': 0, 'dtype': 'float64'})
+    assert not is_buffer_handle([handle(0, 8)])
+
+
+def test_extracts_buffers(area):
+    area.mmap[0:8] = b'01234567'
+    data = {
+        'a': handle(0, 4, dtype='uint8', shape=[4]),
+        'b': [{'c': handle(4, 4, dtype='int32', shape=[1])}, 1],
+        'd': 'foo',
+    }
+    data, buffers = extract_buffers(data, area)
+    assert data == {
+        'a': {'__buffer__': 0, 'dtype': 'uint8', 'shape': [4]},
+        'b': [{'c': {'__buffer__': 1, 'dtype': 'int32', 'shape': [1]}}, 1],
+        'd': 'foo',
+    }
+    assert [bytes(b) for b in buffers] == [b'0123', b'4567']
+
+
+def stamp(area, offset, generation):
+    area.mmap[offset - 8:offset] = struct.pack('<Q', generation)
+
+
+def test_reads_buffers_with_current_generation(area):
+    area.mmap[8:12] = b'abcd'
+    stamp(area, 8, 3)
+    assert area.read({'offset': 8, 'length': 4, 'generation': 3}) == b'abcd'
+    assert area.read({'offset': 8, 'length': 4}) == b'abcd'
+
+    stamp(area, 8, 4)
+    assert area.read({'offset': 8, 'length': 4, 'generation': 3}) is None
+    with pytest.raises(ValueError):
+        area.read({'offset': 4, 'length': 4, 'generation': 3})
+
+
+def test_drops_overwritten_buffers(area):
+    area.mmap[8:12] = b'abcd'
+    stamp(area, 8, 2)
+    data, buffers = extract_buffers({
+        'a': handle(8, 4, generation=1), 'b': handle(8, 4, generation=2),
+    }, area)
+    assert data == {
+        'a': None, 'b': {'__buffer__': 0, 'dtype': None, 'shape': None}}
+    assert buffers == [b'abcd']
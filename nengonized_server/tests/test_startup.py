@@ -0,0 +1,21 @@
+import json
+import subprocess
+import sys
+
+
+IMPORT_TIME_BUDGET = 1.
+
+
+def test_app_imports_quickly_without_kernel():
+    output = subprocess.check_output([sys.executable, '-c', '''
+import json, sys, time
+start = time.perf_counter()
+import nengonized_server.app
+print(json.dumps({
+    "time": time.perf_counter() - start,
+    "kernelImported": "nengonized_kernel" in sys.modules,
+}))
+'''])
+    measurement = json.loads(output)
+    assert not measurement['kernelImported']
+    assert measurement['time'] < IMPORT_TIME_BUDGET
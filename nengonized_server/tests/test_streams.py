@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from nengonized_server.streams import (
+        Broadcast, in_chunks, LatestValue, switch_map)
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def collect(aiterable):
+    return [x async for x in aiterable]
+
+
+async def test_latest_value_keeps_only_latest_value():
+    channel = LatestValue()
+    channel.put(1)
+    channel.put(2)
+    channel.close()
+    assert await collect(channel) == [2]
+
+
+async def test_latest_value_merges_unconsumed_values():
+    channel = LatestValue(merge=lambda a, b: a + b)
+    channel.put(1)
+    channel.put(2)
+    assert await channel.__anext__() == 3
+    channel.put(4)
+    assert await channel.__anext__() == 4
+
+
+async def test_latest_value_raises_error_on_close():
+    channel = LatestValue()
+    channel.close(ValueError())
+    with pytest.raises(ValueError):
+        await channel.__anext__()
+
+
+async def test_broadcast_publishes_to_all_listeners():
+    broadcast = Broadcast()
+    a = broadcast.listen()
+    b = broadcast.listen(initial=0)
+    broadcast.publish(1)
+    broadcast.close()
+    assert await collect(a) == [1]
+    assert await collect(b) == [1]
+
+
+async def test_broadcast_forgets_closed_listeners():
+    broadcast = Broadcast()
+    broadcast.listen().close()
+    assert len(broadcast._listeners) == 0
+
+
+async def test_in_chunks_yields_to_event_loop_between_chunks():
+    ran = []
+    asyncio.get_running_loop().call_soon(ran.append, True)
+    chunks = in_chunks(range(5), chunk_size=2)
+    assert await chunks.__anext__() == [0, 1]
+    assert not ran
+    assert await chunks.__anext__() == [2, 3]
+    assert ran
+    assert await collect(chunks) == [[4]]
+
+
+async def test_broadcast_publishes_in_chunks_to_remaining_listeners():
+    broadcast = Broadcast(chunk_size=1)
+    a = broadcast.listen()
+    b = broadcast.listen()
+    publishing = asyncio.ensure_future(broadcast.publish_in_chunks(1))
+    await asyncio.sleep(0)
+    a.close()
+    b.close()
+    await publishing
+    assert len(await collect(a)) + len(await collect(b)) == 1
+
+
+async def test_switch_map_applies_function():
+    async def double(x):
+        return 2 * x
+
+    channel = LatestValue()
+    channel.put(1)
+    channel.close()
+    assert await collect(switch_map(channel, double)) == [2]
+
+
+async def test_switch_map_cancels_superseded_calls():
+    cont = asyncio.Event()
+    cancelled = []
+
+    async def fn(x):
+        if x == 'slow':
+            try:
+                await cont.wait()
+            except asyncio.CancelledError:
+                cancelled.append(x)
+                raise
+        return x
+
+    channel = LatestValue()
+    results = asyncio.get_running_loop().create_task(
+            collect(switch_map(channel, fn)))
+    channel.put('slow')
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    channel.put('fast')
+    channel.close()
+    assert await results == ['fast']
+    assert cancelled == ['slow']
@@ -0,0 +1,107 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from nengonized_server.supervision import Health, Supervisor
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class ReloadableStub(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.reloads = []
+
+    async def reload(self, restart=False):
+        self.reloads.append(restart)
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError("Kernel failed to start.")
+
+
+async def test_restarts_crashed_kernel():
+    reloadable = ReloadableStub()
+    kernel = mock.MagicMock()
+    supervisor = Supervisor(reloadable, kernel, initial_backoff=0.)
+    health_updates = supervisor.listen()
+    assert (await health_updates.__anext__()).status == Health.STARTING
+    supervisor.notify_started()
+    assert (await health_updates.__anext__()).status == Health.RUNNING
+
+    kernel.crash_callback(1)
+    assert supervisor.health.status == Health.RESTARTING
+    assert (await health_updates.__anext__()).status == Health.RESTARTING
+    await asyncio.sleep(0.01)
+
+    assert reloadable.reloads == [True]
+    assert supervisor.health.status == Health.RUNNING
+    assert supervisor.health.restarts == 1
+    assert (await health_updates.__anext__()).status == Health.RUNNING
+
+
+async def test_backs_off_exponentially():
+    reloadable = ReloadableStub(failures=2)
+    kernel = mock.MagicMock()
+    supervisor = Supervisor(
+            reloadable, kernel, initial_backoff=0.001, max_backoff=0.003)
+    supervisor.notify_started()
+
+    kernel.crash_callback(1)
+    await asyncio.sleep(0.05)
+    assert reloadable.reloads == [True, True, True]
+    assert supervisor.backoff == 0.003
+    assert supervisor.health.status == Health.RUNNING
+
+
+async def test_resets_backoff_when_stable():
+    now = [0.]
+    reloadable = ReloadableStub()
+    kernel = mock.MagicMock()
+    supervisor = Supervisor(
+            reloadable, kernel, initial_backoff=0.001, stable_after=10.,
+            clock=lambda: now[0])
+    supervisor.notify_started()
+    supervisor.backoff = 1.
+
+    now[0] = 10.
+    kernel.crash_callback(1)
+    await asyncio.sleep(0.01)
+    assert supervisor.health.status == Health.RUNNING
+
+
+async def test_ignores_crashes_while_restarting():
+    reloadable = ReloadableStub()
+    kernel = mock.MagicMock()
+    supervisor = Supervisor(reloadable, kernel, initial_backoff=0.)
+    supervisor.notify_started()
+
+    kernel.crash_callback(1)
+    kernel.crash_callback('connection closed')
+    await asyncio.sleep(0.01)
+    assert reloadable.reloads == [True]
+
+
+async def test_stop_cancels_pending_restart():
+    reloadable = ReloadableStub()
+    kernel = mock.MagicMock()
+    supervisor = Supervisor(reloadable, kernel, initial_backoff=10.)
+    supervisor.notify_started()
+
+    kernel.crash_callback(1)
+    await supervisor.stop()
+    assert reloadable.reloads == []
+    assert kernel.crash_callback is None
+    assert supervisor.health.status == Health.STOPPED
+
+
+async def test_ignores_crashes_while_starting():
+    reloadable = ReloadableStub()
+    kernel = mock.MagicMock()
+    supervisor = Supervisor(reloadable, kernel, initial_backoff=0.)
+
+    kernel.crash_callback(1)
+    await asyncio.sleep(0.01)
+    assert reloadable.reloads == []
+    assert supervisor.health.status == Health.STARTING
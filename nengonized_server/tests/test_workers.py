@@ -0,0 +1,224 @@
+import asyncio
+import json
+import os
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.websocket import websocket_connect
+import websockets
+
+from nengonized_server.kernel_management import ConnectedKernel
+from nengonized_server.workers import (
+        make_worker_app, PlacementError, PlacementScheduler, RemoteKernel,
+        TOKEN_HEADER, WorkerAgent)
+
+
+pytestmark = pytest.mark.asyncio
+
+TOKEN = 'secret'
+
+
+class KernelStub(object):
+    port = 1234
+
+    def __init__(self, filename, *args):
+        self.filename = filename
+        self.args = args
+        self.conf = {'graphql': [['127.0.0.1', self.port]], 'framed': None}
+        self.running = False
+
+    async def __aenter__(self):
+        with open(self.filename) as f:
+            self.source = f.read()
+        self.running = True
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.running = False
+
+
+@pytest.fixture
+async def start_agents():
+    servers = []
+
+    def start(*resources, lease_ttl=30.):
+        urls = []
+        agents = []
+        for r in resources:
+            agent = WorkerAgent(
+                    TOKEN, kernel_factory=KernelStub,
+                    resources=lambda r=r: dict(r), lease_ttl=lease_ttl)
+            sock, port = bind_unused_port()
+            server = HTTPServer(make_worker_app(agent))
+            server.add_sockets([sock])
+            servers.append(server)
+            agents.append(agent)
+            urls.append(f'http://127.0.0.1:{port}')
+        return agents, urls
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def model_file(tmpdir):
+    path = tmpdir.join('model.py')
+    path.write('model = 42\n')
+    return str(path)
+
+
+async def test_agent_reports_status(start_agents):
+    _, (url,) = start_agents({'freeMemory': 1024, 'freeCpus': 2.})
+    response = await AsyncHTTPClient().fetch(
+            url + '/status', headers={TOKEN_HEADER: TOKEN})
+    assert json.loads(response.body) == {
+        'freeMemory': 1024, 'freeCpus': 2., 'kernels': 0}
+
+
+async def test_placement_prefers_free_cpus_then_memory(start_agents):
+    _, urls = start_agents(
+        {'freeMemory': 4096, 'freeCpus': 1.},
+        {'freeMemory': 1024, 'freeCpus': 3.},
+        {'freeMemory': 2048, 'freeCpus': 3.})
+    assert await PlacementScheduler(urls, TOKEN).place() == urls[2]
+
+
+async def test_placement_requires_free_memory(start_agents):
+    _, urls = start_agents(
+        {'freeMemory': 4096, 'freeCpus': 1.},
+        {'freeMemory': 1024, 'freeCpus': 3.})
+    assert await PlacementScheduler(urls, TOKEN).place(memory=2048) == urls[0]
+    with pytest.raises(PlacementError):
+        await PlacementScheduler(urls, TOKEN).place(memory=8192)
+
+
+async def test_placement_skips_unreachable_agents(start_agents):
+    _, urls = start_agents({'freeMemory': 1024, 'freeCpus': 1.})
+    sock, port = bind_unused_port()
+    sock.close()
+    scheduler = PlacementScheduler(
+            [f'http://127.0.0.1:{port}'] + urls, TOKEN)
+    assert await scheduler.place() == urls[0]
+
+
+async def test_remote_kernel_lifecycle(start_agents, model_file):
+    agents, urls = start_agents(
+        {'freeMemory': 1024, 'freeCpus': 1.},
+        {'freeMemory': 1024, 'freeCpus': 2.})
+    kernel = RemoteKernel(model_file, PlacementScheduler(urls, TOKEN))
+
+    async with kernel:
+        assert kernel.agent == urls[1]
+        assert kernel.conf == {'proxy': (
+            'ws' + urls[1][len('http'):] +
+            f'/kernels/{kernel.kernel_id}/graphql')}
+        assert not agents[0].kernels
+        (stub, workdir), = agents[1].kernels.values()
+        assert stub.running
+        assert stub.source == 'model = 42\n'
+        assert os.path.basename(stub.filename) == 'model.py'
+
+    assert not stub.running
+    assert not agents[1].kernels
+    assert not os.path.exists(workdir)
+
+
+async def test_agent_rejects_invalid_requests(start_agents):
+    _, (url,) = start_agents({'freeMemory': 1024, 'freeCpus': 1.})
+    client = AsyncHTTPClient()
+    headers = {TOKEN_HEADER: TOKEN}
+    response = await client.fetch(
+            url + '/kernels', method='POST', body='{}', headers=headers,
+            raise_error=False)
+    assert response.code == 400
+    response = await client.fetch(
+            url + '/kernels/0', method='DELETE', headers=headers,
+            raise_error=False)
+    assert response.code == 404
+
+
+async def test_agent_requires_token(start_agents, model_file):
+    agents, (url,) = start_agents({'freeMemory': 1024, 'freeCpus': 1.})
+    client = AsyncHTTPClient()
+    body = json.dumps({'filename': model_file, 'source': 'model = 42\n'})
+    for headers in ({}, {TOKEN_HEADER: 'wrong'}):
+        response = await client.fetch(
+                url + '/kernels', method='POST', body=body, headers=headers,
+                raise_error=False)
+        assert response.code == 403
+        response = await client.fetch(
+                url + '/status', headers=headers, raise_error=False)
+        assert response.code == 403
+    assert not agents[0].kernels
+    with pytest.raises(ValueError):
+        WorkerAgent('')
+
+
+async def test_agent_stops_kernels_with_expired_lease(
+        start_agents, model_file):
+    agents, urls = start_agents(
+            {'freeMemory': 1024, 'freeCpus': 1.}, lease_ttl=0.05)
+    kernel = RemoteKernel(model_file, PlacementScheduler(urls, TOKEN))
+    await kernel.__aenter__()
+    (stub, _), = agents[0].kernels.values()
+
+    await asyncio.sleep(0.1)
+    await agents[0].reap_expired()
+    assert stub.running
+
+    kernel._heartbeat.cancel()
+    await asyncio.sleep(0.1)
+    await agents[0].reap_expired()
+    assert not stub.running
+    assert not agents[0].kernels
+    assert not agents[0].leases
+
+
+async def test_remote_kernel_reports_lost_lease(start_agents, model_file):
+    agents, urls = start_agents(
+            {'freeMemory': 1024, 'freeCpus': 1.}, lease_ttl=0.03)
+    kernel = RemoteKernel(model_file, PlacementScheduler(urls, TOKEN))
+    crashed = asyncio.Event()
+    kernel.crash_callback = lambda reason: crashed.set()
+    async with kernel:
+        await agents[0].stop_all()
+        await asyncio.wait_for(crashed.wait(), 1.)
+        assert kernel.kernel_id is None
+
+
+@pytest.fixture
+async def kernel_socket():
+    async def respond(connection):
+        async for message in connection:
+            await connection.send('response to ' + message)
+
+    async with websockets.serve(respond, '127.0.0.1', 0) as server:
+        KernelStub.port = server.sockets[0].getsockname()[1]
+        yield
+    KernelStub.port = 1234
+
+
+async def test_queries_remote_kernel_through_agent(
+        start_agents, model_file, kernel_socket):
+    _, urls = start_agents({'freeMemory': 1024, 'freeCpus': 1.})
+    kernel = ConnectedKernel(
+            RemoteKernel(model_file, PlacementScheduler(urls, TOKEN)))
+    async with kernel:
+        response = await kernel.query('{ model { label } }')
+        assert response == 'response to ' + json.dumps({
+            'query': '{ model { label } }', 'variables': None})
+
+
+async def test_agent_link_requires_token(
+        start_agents, model_file, kernel_socket):
+    agents, (url,) = start_agents({'freeMemory': 1024, 'freeCpus': 1.})
+    kernel_id, _ = await agents[0].start_kernel(model_file, 'model = 42\n')
+    link_url = 'ws' + url[len('http'):] + f'/kernels/{kernel_id}/graphql'
+    for headers in ({}, {TOKEN_HEADER: 'wrong'}):
+        with pytest.raises(HTTPClientError) as excinfo:
+            await websocket_connect(HTTPRequest(link_url, headers=headers))
+        assert excinfo.value.code == 403
+    await agents[0].stop_all()
@@ -0,0 +1,419 @@
+"""Kernels on remote worker nodes.
+
+A worker node runs an agent (``python -m nengonized_server.workers PORT
+[HOST]``) that starts kernels on request. The agent only listens on HOST
+and only accepts requests carrying the shared token from the
+``NENGONIZED_WORKER_TOKEN`` environment variable in the `TOKEN_HEADER`.
+`RemoteKernel` can be used in place of `Kernel` and asks an agent chosen
+by a `PlacementScheduler` to start the kernel.
+
+Kernels keep listening on the loopback interface of their node, since
+their GraphQL socket is not authenticated. Servers query them through
+the agent, which forwards the messages of its token protected
+``/kernels/ID/graphql`` websocket to the kernel.
+
+Remote kernels are leased: the server has to renew the lease of each of
+its kernels within the lease TTL, otherwise the agent stops the kernel.
+This way, kernels do not outlive a server that died.
+"""
+
+import asyncio
+import functools
+import hmac
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.web import Application, HTTPError, RequestHandler
+from tornado.websocket import WebSocketHandler
+import websockets
+
+from .kernel_logs import KernelLog
+from .kernel_management import ConnectedKernel, Kernel, KERNEL_LIMITS
+
+
+logger = logging.getLogger(__name__)
+
+TOKEN_HEADER = 'Nengonized-Worker-Token'
+DEFAULT_LEASE_TTL = 30.
+
+
+def node_resources():
+    try:
+        free_memory = (
+            os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))
+    except (AttributeError, ValueError, OSError):
+        free_memory = None
+    cpus = os.cpu_count() or 1
+    return {
+        'freeMemory': free_memory,
+        'freeCpus': max(0., cpus - os.getloadavg()[0]),
+    }
+
+
+class WorkerAgent(object):
+    """Starts and stops kernels on the local node for remote servers.
+
+    Kernels are created with `kernel_factory` (called with the model file
+    and further arguments). Their configuration is returned without the
+    local addresses of their GraphQL socket, which is only reachable
+    through the agent. Only requests carrying `token` are accepted.
+    Kernels whose lease was not renewed within `lease_ttl` seconds are
+    stopped while the agent is started.
+    """
+
+    def __init__(
+            self, token, kernel_factory=Kernel, resources=node_resources,
+            lease_ttl=DEFAULT_LEASE_TTL):
+        if not token:
+            raise ValueError("A worker token is required.")
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.token = token
+        self.kernel_factory = kernel_factory
+        self.resources = resources
+        self.lease_ttl = lease_ttl
+        self.kernels = {}
+        self.leases = {}
+        self._ids = itertools.count()
+        self._task = None
+
+    def is_authorized(self, token):
+        return token is not None and hmac.compare_digest(
+                token.encode(), self.token.encode())
+
+    def status(self):
+        return dict(self.resources(), kernels=len(self.kernels))
+
+    async def start_kernel(self, filename, source, args=()):
+        workdir = tempfile.mkdtemp(prefix='nengonized-')
+        path = os.path.join(workdir, os.path.basename(filename))
+        with open(path, 'w') as f:
+            f.write(source)
+        kernel = self.kernel_factory(path, *args)
+        try:
+            await kernel.__aenter__()
+        except Exception:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        kernel_id = str(next(self._ids))
+        self.kernels[kernel_id] = (kernel, workdir)
+        self.renew_lease(kernel_id)
+        self.logger.info("Started kernel %s for %s.", kernel_id, filename)
+        conf = {
+            k: v for k, v in kernel.conf.items()
+            if k not in ('graphql', 'framed', 'unix')}
+        return kernel_id, conf
+
+    def kernel_url(self, kernel_id):
+        """Returns the local websocket URL of a kernel's GraphQL socket."""
+        kernel, _ = self.kernels[kernel_id]
+        return ConnectedKernel._get_connection_string(
+                kernel.conf['graphql'][0])
+
+    def renew_lease(self, kernel_id):
+        self.leases[kernel_id] = time.monotonic() + self.lease_ttl
+
+    async def stop_kernel(self, kernel_id):
+        kernel, workdir = self.kernels.pop(kernel_id)
+        self.leases.pop(kernel_id, None)
+        try:
+            await kernel.__aexit__(None, None, None)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        self.logger.info("Stopped kernel %s.", kernel_id)
+
+    async def stop_all(self):
+        await asyncio.gather(*(
+            self.stop_kernel(kernel_id) for kernel_id in list(self.kernels)))
+
+    async def reap_expired(self):
+        now = time.monotonic()
+        expired = [
+            kernel_id for kernel_id, deadline in self.leases.items()
+            if deadline < now]
+        for kernel_id in expired:
+            self.logger.warning(
+                    "Lease of kernel %s expired, stopping it.", kernel_id)
+            await self.stop_kernel(kernel_id)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.lease_ttl / 4.)
+            try:
+                await self.reap_expired()
+            except Exception as err:
+                self.logger.error("Stopping expired kernels failed: %s", err)
+
+
+class AgentHandler(RequestHandler):
+    """Base class of agent handlers rejecting requests without the token."""
+
+    def initialize(self, agent):
+        self.agent = agent
+
+    def prepare(self):
+        token = self.request.headers.get(TOKEN_HEADER)
+        if not self.agent.is_authorized(token):
+            raise HTTPError(403)
+
+
+class StatusHandler(AgentHandler):
+    def get(self):
+        self.write(self.agent.status())
+
+
+class KernelsHandler(AgentHandler):
+    async def post(self):
+        try:
+            data = json.loads(self.request.body)
+            filename, source = data['filename'], data['source']
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(
+                    400, "Expected JSON body with filename and source.")
+        kernel_id, conf = await self.agent.start_kernel(
+                filename, source, data.get('args', ()))
+        self.write({
+            'id': kernel_id, 'conf': conf, 'leaseTtl': self.agent.lease_ttl})
+
+
+class KernelHandler(AgentHandler):
+    async def delete(self, kernel_id):
+        if kernel_id not in self.agent.kernels:
+            raise HTTPError(404)
+        await self.agent.stop_kernel(kernel_id)
+
+
+class LeaseHandler(AgentHandler):
+    def put(self, kernel_id):
+        if kernel_id not in self.agent.kernels:
+            raise HTTPError(404)
+        self.agent.renew_lease(kernel_id)
+
+
+class KernelLinkHandler(AgentHandler, WebSocketHandler):
+    """Forwards GraphQL queries to a kernel and sends back its responses."""
+
+    def initialize(self, agent):
+        super().initialize(agent)
+        self.kernel_link = None
+
+    def prepare(self):
+        super().prepare()
+        if self.path_args[0] not in self.agent.kernels:
+            raise HTTPError(404)
+
+    async def open(self, kernel_id):
+        try:
+            self.kernel_link = await websockets.connect(
+                    self.agent.kernel_url(kernel_id))
+        except (OSError, websockets.exceptions.WebSocketException) as err:
+            self.agent.logger.error(
+                    "Cannot connect to kernel %s: %s", kernel_id, err)
+            self.close(1011, "Kernel unreachable.")
+
+    async def on_message(self, message):
+        if self.kernel_link is None:
+            return
+        try:
+            await self.kernel_link.send(message)
+            self.write_message(await self.kernel_link.recv())
+        except websockets.exceptions.ConnectionClosed:
+            self.close(1011, "Kernel closed the connection.")
+
+    def on_close(self):
+        if self.kernel_link is not None:
+            asyncio.ensure_future(self.kernel_link.close())
+            self.kernel_link = None
+
+
+def make_worker_app(agent):
+    args = {'agent': agent}
+    return Application([
+        (r"/status", StatusHandler, args),
+        (r"/kernels", KernelsHandler, args),
+        (r"/kernels/([^/]+)", KernelHandler, args),
+        (r"/kernels/([^/]+)/lease", LeaseHandler, args),
+        (r"/kernels/([^/]+)/graphql", KernelLinkHandler, args),
+    ])
+
+
+class PlacementError(Exception):
+    pass
+
+
+class PlacementScheduler(object):
+    """Picks the worker node for a new kernel.
+
+    Nodes are given by the base URLs of their agents, which accept requests
+    carrying `token`. Among the reachable nodes with at least the
+    requested free memory, the one with the most free CPUs is chosen, and
+    of these the one with the most free memory.
+    """
+
+    def __init__(self, agents, token, client=None):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.agents = agents
+        self.token = token
+        self.client = client if client is not None else AsyncHTTPClient()
+
+    def fetch(self, url, **kwargs):
+        """Fetches `url` from an agent with the token added."""
+        return self.client.fetch(
+                url, headers={TOKEN_HEADER: self.token}, **kwargs)
+
+    async def node_status(self):
+        results = await asyncio.gather(*(
+            self.fetch(f'{agent}/status') for agent in self.agents),
+            return_exceptions=True)
+        status = {}
+        for agent, result in zip(self.agents, results):
+            if isinstance(result, Exception):
+                self.logger.warning("Worker %s unavailable: %s", agent, result)
+            else:
+                status[agent] = json.loads(result.body)
+        return status
+
+    async def place(self, memory=None):
+        candidates = [
+            (s['freeCpus'], s['freeMemory'] or 0, agent)
+            for agent, s in (await self.node_status()).items()
+            if memory is None or s['freeMemory'] is None or
+            s['freeMemory'] >= memory]
+        if not candidates:
+            raise PlacementError("No worker node can take the kernel.")
+        return max(candidates)[2]
+
+
+class RemoteKernel(object):
+    """Kernel started on a worker node chosen by `placement`.
+
+    Provides the same interface to `ConnectedKernel` as `Kernel`. The
+    model file is sent to the worker node, so it does not need access to
+    the server's file system. `memory` is the free memory in bytes the
+    node should have for the kernel. Queries go through the agent's link
+    given by ``proxy`` in the configuration, which requires the
+    `link_headers`.
+
+    The lease of the kernel is renewed at a third of the lease TTL given
+    by the agent. If renewing fails for longer than the TTL, the kernel is
+    considered crashed.
+    """
+
+    def __init__(self, filename, placement, memory=None):
+        self.logger = logger.getChild(f'RemoteKernel({id(self)})')
+        self.args = (filename,)
+        self.placement = placement
+        self.memory = memory
+        self.log = KernelLog(self.logger)
+        self.crash_callback = None
+        self.link_socket = None
+        self.link_headers = {TOKEN_HEADER: placement.token}
+        self.shared_buffers = None
+        self.agent = None
+        self.kernel_id = None
+        self.conf = None
+        self._heartbeat = None
+
+    async def __aenter__(self):
+        self.agent = await self.placement.place(memory=self.memory)
+        with open(self.args[0]) as f:
+            source = f.read()
+        response = await self.placement.fetch(
+                f'{self.agent}/kernels', method='POST', body=json.dumps({
+                    'filename': self.args[0], 'source': source}))
+        data = json.loads(response.body)
+        self.kernel_id = data['id']
+        self.conf = dict(data['conf'], proxy=(
+            'ws' + self.agent[len('http'):] +
+            f'/kernels/{self.kernel_id}/graphql'))
+        self._heartbeat = asyncio.get_running_loop().create_task(
+                self._renew_lease(self.kernel_id, data['leaseTtl']))
+        self.logger.info(
+                "Started kernel %s on %s with configuration %s.",
+                self.kernel_id, self.agent, self.conf)
+        return self
+
+    async def has_cached_model(self):
+        return False
+
+    async def _renew_lease(self, kernel_id, ttl):
+        url = f'{self.agent}/kernels/{kernel_id}/lease'
+        renewed = time.monotonic()
+        while time.monotonic() - renewed < ttl:
+            await asyncio.sleep(ttl / 3.)
+            try:
+                await self.placement.fetch(url, method='PUT', body='')
+            except HTTPClientError as err:
+                if err.code == 404:
+                    break
+                self.logger.warning("Could not renew lease: %s", err)
+            except OSError as err:
+                self.logger.warning("Could not renew lease: %s", err)
+            else:
+                renewed = time.monotonic()
+        self.logger.error("Lost the lease of kernel %s.", kernel_id)
+        self.kernel_id = None
+        if self.crash_callback is not None:
+            self.crash_callback('lease lost')
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            try:
+                await self._heartbeat
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat = None
+        if self.kernel_id is None:
+            return
+        try:
+            await self.placement.fetch(
+                    f'{self.agent}/kernels/{self.kernel_id}', method='DELETE')
+        except (HTTPClientError, OSError) as err:
+            self.logger.warning("Could not stop remote kernel: %s", err)
+        self.kernel_id = None
+
+
+async def serve(port, host, token):
+    agent = WorkerAgent(
+            token, kernel_factory=functools.partial(
+                Kernel, limits=KERNEL_LIMITS))
+    server = make_worker_app(agent).listen(port, address=host)
+    agent.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+        await agent.stop()
+        await agent.stop_all()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    token = os.environ.get('NENGONIZED_WORKER_TOKEN')
+    if not token:
+        sys.exit("NENGONIZED_WORKER_TOKEN must be set.")
+    port = int(sys.argv[1])
+    host = sys.argv[2] if len(sys.argv) > 2 else '127.0.0.1'
+    try:
+        asyncio.run(serve(port, host, token))
+    except KeyboardInterrupt:
+        pass
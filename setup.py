@@ -26,6 +26,7 @@ setup(
     long_description="TODO",
 
     packages=find_packages(),
+    package_data={'nengonized_server.gql': ['kernel_schema.json']},
     provides=['nengonized_server'],
 
     install_requires=['graphene', 'nengonized-kernel', 'tornado', 'websockets'],